@@ -1,12 +1,40 @@
+import hmac
 import os
+import time
 
-from flask import Flask, render_template, request, flash, redirect, session, g, abort, jsonify
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, abort, make_response, url_for)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 from itertools import chain
 
 from forms import UserAddForm, LoginForm, MessageForm, EditUserForm, CommentForm
 from models import db, connect_db, User, Message, Like, Comment
+from timeline import fan_out_message, home_timeline_ids, trim_all_timelines
+from pagination import PAGE_SIZE, decode_cursor, page_query, page_of
+from feeds import feed_query, hydrate, FeedStream
+from streaming import stream_template
+from comments import comment_page, serialize_comment_page
+from connections import (connection_page, load_connections, FOLLOWERS,
+                         FOLLOWING, MUTUAL)
+from viewer import ViewerState, load_viewer
+from search import search_index
+from identity import identity_cache, load_current_user
+from passwords import hasher, HasherBusy
+from instrumentation import sql_stats, query_budget
+from replicas import replicas, replica_reads
+from caching import init_caching, conditional, user_versions, message_stamp
+from compression import init_compression
+from assets import init_assets, build_assets
+from images import image_proxy, img_url
+import migrate
+from fastjson import JSONEncoder, json_response, timestamp_json
+from counters import (message_posted, message_commented, message_deleted,
+                      user_deleted, user_changed, reconcile_counters)
+from writebehind import write_behind, LIKE, FOLLOW
+from recommendations import (suggestions_for, load_suggestions,
+                             precompute_suggestions, SUGGESTIONS)
+from graph import social_graph
 
 CURR_USER_KEY = "curr_user"
 
@@ -17,13 +45,30 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
+# read replicas for the feed pages, if any (see replicas.py)
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if uri]
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "default_secret_key")
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+# bearer token the metrics scraper sends; /metrics is off without one
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.json_encoder = JSONEncoder
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+hasher.init_app(app)
+sql_stats.init_app(app)
+replicas.init_app(app)
+init_caching(app)
+init_compression(app)
+init_assets(app)
+image_proxy.init_app(app)
 
 
 ##############################################################################
@@ -32,14 +77,20 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    This is usually a cached snapshot; see identity.py.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_current_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
+    # filled in by routes that render follow / like buttons
+    g.viewer = ViewerState(g.user.id if g.user else None)
+
 
 def do_login(user):
     """Log in user."""
@@ -82,6 +133,7 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        search_index.index_user(user)
         do_login(user)
 
         return redirect("/")
@@ -101,6 +153,7 @@ def login():
                                  form.password.data)
 
         if user:
+            db.session.commit()  # in case the password was rehashed
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -121,45 +174,130 @@ def logout():
     return redirect('/')
 
 
+##############################################################################
+# Feed helpers
+
+
+def set_viewer(user_ids=(), message_ids=()):
+    """Load g.viewer for a page showing these users and messages."""
+
+    g.viewer = load_viewer(g.viewer.viewer_id, user_ids, message_ids)
+    return g.viewer
+
+
+def feed_cursor():
+    """Get the `before` cursor from the querystring (400 if it's garbage)."""
+
+    try:
+        return decode_cursor(request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+
+def in_order(query, model, ids):
+    """Load the `model` rows with these ids, keeping the order of `ids`."""
+
+    rows = {row.id: row for row in query.filter(model.id.in_(ids)).all()}
+
+    return [rows[id] for id in ids if id in rows]
+
+
+def render_feed(template, rows, has_more=None, **kwargs):
+    """Render a page of a feed.
+
+    `rows` is a query for the page's messages, newest first, with one extra
+    row if there's a following page (unless `has_more` says whether there
+    is; see page_query()).
+
+    Full pages are streamed as they're rendered (see streaming.py), unless
+    the STREAM_FEEDS setting is off. "Load more" requests (?partial=1) get
+    just the messages, with the cursor for the following page in the
+    X-Next-Cursor header.
+    """
+
+    user = kwargs.get('user')
+    partial = request.args.get('partial')
+
+    if not partial and app.config.get('STREAM_FEEDS', True):
+        viewer = set_viewer(user_ids=[user.id] if user else ())
+        feed = FeedStream(rows, viewer.viewer_id, has_more)
+
+        return stream_template(template, messages=feed, feed=feed, **kwargs)
+
+    messages = rows.all()
+    if has_more is None:
+        has_more = len(messages) > PAGE_SIZE
+        messages = messages[:PAGE_SIZE]
+    page = page_of(messages, has_more)
+
+    viewer = set_viewer(user_ids=[user.id] if user else (),
+                        message_ids=[msg.id for msg in page.items])
+
+    messages = hydrate(page.items, viewer)
+
+    if partial:
+        resp = make_response(render_template('_messages.html',
+                                             messages=messages))
+        if page.next_cursor:
+            resp.headers['X-Next-Cursor'] = page.next_cursor
+        return resp
+
+    return render_template(template, messages=messages, feed=page, **kwargs)
+
+
 ##############################################################################
 # Like routes
 
 @app.route('/like', methods=["POST"])
+@query_budget(4)
 def add_like():
+    """Like or unlike a message (written behind; see writebehind.py)."""
 
-    msg_id = request.json.get('msg-id')
-    is_existing = Like.query.filter_by(message_id=msg_id, user_id=g.user.id).first()
-    msg = Message.query.filter_by(id=msg_id).first_or_404()
+    if not g.user:
+        abort(401)
 
-    if is_existing is None:
-        like = Like(user_id=g.user.id, message_id=msg_id)
-        db.session.add(like)
-        db.session.commit()
-    else:
-        db.session.delete(is_existing)
-        db.session.commit()
+    try:
+        msg_id = int(request.json.get('msg-id'))
+    except (TypeError, ValueError):
+        abort(400)
+
+    likes = (db.session.query(Message.likes_count)
+             .filter(Message.id == msg_id)
+             .scalar())
+    if likes is None:
+        abort(404)
+
+    likes += write_behind.pending_delta(LIKE, msg_id)
+    was_liked = set_viewer(message_ids=[msg_id]).has_liked(msg_id)
+    liked, changed = write_behind.toggle(LIKE, g.user.id, msg_id, was_liked)
+    if changed:
+        likes += 1 if liked else -1
 
     resp = {
-        "likes": len(msg.likes),
-        "is-liked": msg.is_liked_by(g.user.id),
-        "msgId": msg.id,
-        "userImg": g.user.image_url
+        "likes": likes,
+        "is-liked": liked,
+        "msgId": msg_id,
+        "userImg": img_url(g.user.image_url, 'badge')
     }
-    return jsonify(resp)
+    return json_response(resp)
 
 
 @app.route('/likes')
+@query_budget(5)
+@replica_reads
 def render_likes_page():
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")    
 
-    liked_msg_id = [l.message_id for l in g.user.likes]
+    liked = (feed_query()
+             .join(Like, Like.message_id == Message.id)
+             .filter(Like.user_id == g.user.id))
 
-    messages = Message.query.filter(Message.id.in_(liked_msg_id)).order_by(Message.timestamp.desc()).all()
+    rows = page_query(liked, Message.timestamp, Message.id, feed_cursor())
 
-    return render_template('/users/likes.html', messages=messages, user=g.user)
+    return render_feed('/users/likes.html', rows, user=g.user)
 
 
 
@@ -170,82 +308,191 @@ def render_likes_page():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username (and bio);
+    results are ranked, and 'page' picks later pages of them. Without 'q',
+    users are listed by id, a page at a time after the id in 'after'.
     """
 
     search = request.args.get('q')
+    next_url = None
 
     if not search:
-        users = User.query.all()
+        after = request.args.get('after', 0, type=int)
+        users = (User
+                 .query
+                 .filter(User.id > after)
+                 .order_by(User.id)
+                 .limit(PAGE_SIZE + 1)
+                 .all())
+
+        if len(users) > PAGE_SIZE:
+            users = users[:PAGE_SIZE]
+            next_url = url_for('list_users', after=users[-1].id)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = max(request.args.get('page', 1, type=int), 1)
+        results = search_index.search_users(search, page, PAGE_SIZE)
+        users = in_order(User.query, User, results.ids)
+
+        if results.has_more:
+            next_url = url_for('list_users', q=search, page=page + 1)
+
+    set_viewer(user_ids=[user.id for user in users])
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html',
+                           users=users,
+                           search=search,
+                           next_url=next_url)
+
+
+@app.route('/users/autocomplete')
+def autocomplete_users():
+    """Usernames starting with the 'q' param, for the search box."""
+
+    matches = search_index.autocomplete(request.args.get('q', ''))
+
+    return json_response([{"id": id, "username": username}
+                          for id, username in matches])
 
 
 @app.route('/users/<int:user_id>')
+@query_budget(7)
+@replica_reads
 def users_show(user_id):
     """Show user profile."""
 
+    # everything the page shows bumps one of these versions (except liker
+    # badges' pictures, which are allowed to be briefly stale)
+    versions = user_versions(user_id, g.user.id if g.user else None)
+    if user_id not in versions:
+        abort(404)
+
+    # from this worker's follows graph, so possibly a few minutes behind
+    # (see graph.py); left out until the graph has loaded
+    followed_by = None
+    if g.user and g.user.id != user_id and social_graph.ready(app):
+        followed_by = len(social_graph.followees_following(g.user.id,
+                                                           user_id))
+
+    not_modified = conditional(sorted(versions.items()), followed_by)
+    if not_modified:
+        return not_modified
+
     user = User.query.get_or_404(user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-
-    return render_template('users/show.html', user=user, messages=messages)
+    messages = feed_query().filter(Message.user_id == user_id)
+    rows = page_query(messages, Message.timestamp, Message.id, feed_cursor())
 
+    return render_feed('users/show.html', rows, user=user,
+                       followed_by=followed_by)
 
-@app.route('/users/<int:user_id>/following')
-def show_following(user_id):
-    """Show list of people this user is following."""
 
+def render_connections(user_id, kind, template):
+    """Render a page of `user_id`'s followers / followees / mutual followers
+    (paged by the 'after' param; see connections.py)."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
+
+    versions = user_versions(user_id, g.user.id)
+    if user_id not in versions:
+        abort(404)
+
+    after = request.args.get('after', 0, type=int)
+    page = connection_page(kind, user_id, g.user.id, after)
+
+    not_modified = conditional(sorted(versions.items()), page.stamp)
+    if not_modified:
+        return not_modified
+
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    set_viewer(user_ids=[user_id])
+
+    next_url = None
+    if page.next_after:
+        next_url = url_for(request.endpoint, user_id=user_id,
+                           after=page.next_after)
+
+    return render_template(template,
+                           user=user,
+                           connections=load_connections(page),
+                           next_url=next_url)
+
+
+@app.route('/users/<int:user_id>/following')
+@query_budget(6)
+@replica_reads
+def show_following(user_id):
+    """Show list of people this user is following."""
+
+    return render_connections(user_id, FOLLOWING, 'users/following.html')
 
 
 @app.route('/users/<int:user_id>/followers')
+@query_budget(6)
+@replica_reads
 def users_followers(user_id):
     """Show list of followers of this user."""
 
+    return render_connections(user_id, FOLLOWERS, 'users/followers.html')
+
+
+@app.route('/users/<int:user_id>/mutual')
+@query_budget(6)
+@replica_reads
+def mutual_followers(user_id):
+    """Show list of people following both this user and the viewer."""
+
+    return render_connections(user_id, MUTUAL, 'users/mutual.html')
+
+
+@app.route('/users/suggestions')
+@query_budget(3)
+@replica_reads
+def who_to_follow():
+    """Suggest people to follow (see recommendations.py)."""
+
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    # extra, in case some have been followed since they were worked out
+    found = suggestions_for(app, g.user.id, 2 * SUGGESTIONS)
+
+    # follows this worker hasn't written yet (see writebehind.py)
+    buffered = write_behind.overlay(FOLLOW, g.user.id,
+                                    [id for id, _, _ in found])
+    skip = {id for id, following in buffered.items() if following}
+
+    return render_template('users/suggestions.html',
+                           suggestions=load_suggestions(g.user.id, found,
+                                                        skip))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@query_budget(4)
 def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
+    """Follow or unfollow a user (written behind; see writebehind.py)."""
 
-    followee = User.query.get(follow_id)
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    if g.user.is_following(followee):
-        g.user.following.remove(followee)
-    else:
-        g.user.following.append(followee)
-    db.session.commit()
+    if db.session.query(User.id).filter(User.id == follow_id).scalar() is None:
+        abort(404)
+
+    was_following = set_viewer(user_ids=[follow_id]).is_following(follow_id)
+    following, _ = write_behind.toggle(FOLLOW, g.user.id, follow_id,
+                                       was_following)
 
     load = {
-        "followeeId": followee.id,
-        "isFollowing": g.user.is_following(followee)
+        "followeeId": follow_id,
+        "isFollowing": following
     }
 
-    return jsonify(load)
+    return json_response(load)
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -257,7 +504,7 @@ def profile():
         flash("You must be logged in to view this page","danger")
         return redirect('/')
 
-    form = EditUserForm(obj=g.user)
+    form = EditUserForm(obj=g.user.row)
 
     if form.validate_on_submit():
         pw = form.password.data
@@ -267,7 +514,10 @@ def profile():
             for k, v in form.data.items():
                 if k != 'csrf_token' and k != 'password':
                     setattr(user, k, v)
+            user_changed(user.id)
             db.session.commit()
+            identity_cache.invalidate(user.id)
+            search_index.index_user(user)
             return redirect(f'/users/{g.user.id}')
         else:
             form.password.errors = ["invalid password"]
@@ -285,9 +535,20 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id = g.user.id
+    message_ids = [id for (id,) in (db.session
+                                    .query(Message.id)
+                                    .filter(Message.user_id == user_id))]
+
+    user_deleted(user_id)
+    db.session.delete(g.user.row)
     db.session.commit()
 
+    identity_cache.invalidate(user_id)
+
+    search_index.remove_user(user_id, message_ids)
+    social_graph.remove_user(user_id)
+
     return redirect("/signup")
 
 
@@ -295,22 +556,57 @@ def delete_user():
 # Comment routes:
 
 
+def post_comment(user_id, message_id, text):
+    """Add (and count) a comment. Returns its JSON (a comment as
+    serialize_comment_page() sends them, plus msg_id), or None if there's no
+    such message. (The async add_comment handler uses this too; see
+    asgi.py.)"""
+
+    comment = Comment(text=text, message_id=message_id, user_id=user_id)
+
+    try:
+        db.session.add(comment)
+        db.session.flush()
+    except IntegrityError:
+        # (no such message)
+        db.session.rollback()
+        return None
+
+    # (read now: committing expires it)
+    resp = {
+        'id': comment.id,
+        'text': comment.text,
+        'timestamp': timestamp_json(comment.timestamp),
+        'user_id': user_id,
+        'msg_id': message_id,
+    }
+
+    message_commented(message_id)
+    db.session.commit()
+    return resp
+
+
 @app.route('/messages/comments', methods=["POST"])
 def add_comment():
     """ add comment to message """
 
-    try:
-        msg_id = request.json.get('msgId')
-        text = request.json.get('text')
+    if not g.user:
+        abort(401)
 
-        comment = Comment(text=text, message_id=msg_id, user_id=g.user.id)
+    data = request.get_json(silent=True)
+    try:
+        msg_id = int(data.get('msgId'))
+        text = data.get('text')
+    except (AttributeError, TypeError, ValueError):
+        abort(400)
+    if not isinstance(text, str) or len(text) > 140:
+        abort(400)
 
-        db.session.add(comment)
-        db.session.commit()
-        return jsonify(comment.serialize())
+    comment = post_comment(g.user.id, msg_id, text)
+    if comment is None:
+        return json_response({'error': 'No such message'}, 404)
 
-    except IntegrityError as e:
-        return e
+    return json_response(comment)
 
 
 ##############################################################################
@@ -330,52 +626,140 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        fan_out_message(msg)
+        message_posted(g.user.id)
         db.session.commit()
 
+        identity_cache.invalidate(g.user.id)
+
+        search_index.index_message(msg)
+
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def search_messages():
+    """Messages matching the 'q' param, best match first, paged by 'page'."""
+
+    search = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    results = search_index.search_messages(search, page, PAGE_SIZE)
+
+    messages = in_order(feed_query(), Message, results.ids)
+    viewer = set_viewer(message_ids=results.ids)
+    next_url = None
+
+    if results.has_more:
+        next_url = url_for('search_messages', q=search, page=page + 1)
+
+    return render_template('messages/search.html',
+                           messages=hydrate(messages, viewer),
+                           search=search,
+                           next_url=next_url)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET", "POST"])
+@query_budget(5)
+@replica_reads
 def messages_show(message_id):
-    """Show a message."""
-
-    if g.user:
-        if request.method == "POST":
-            msg = Message.query.get(message_id)
-            serialized_msg = msg.serialize()
+    """Show a message: a page, or JSON with its first page of comments.
 
-            serialized_msg['comments'] = [c.serialize() for c in msg.comments]
-            return jsonify(serialized_msg)
+    The JSON is for GET requests that prefer it (POST still works too).
+    """
 
-        msg = Message.query.get_or_404(message_id)
-        return render_template('messages/show.html', message=msg)
+    if g.user:
+        wants_json = (request.accept_mimetypes
+                      .best_match(['text/html', 'application/json'])
+                      == 'application/json')
+
+        if request.method == "POST" or wants_json:
+            stamp = message_stamp(message_id)
+            if stamp is None:
+                abort(404)
+
+            if request.method == "GET":
+                not_modified = conditional(stamp)
+                if not_modified:
+                    return not_modified
+
+            msg = feed_query().filter(Message.id == message_id).one()
+
+            # the first page of comments; the modal fetches the rest from
+            # message_comments as it's scrolled
+            resp = serialize_comment_page(comment_page(message_id))
+            resp.update(id=msg.id,
+                        text=msg.text,
+                        user_id=msg.user_id,
+                        username=msg.user.username,
+                        timestamp=timestamp_json(msg.timestamp))
+            return json_response(resp)
+
+        msg = feed_query().filter(Message.id == message_id).first_or_404()
+        viewer = set_viewer(user_ids=[msg.user_id], message_ids=[msg.id])
+
+        return render_template('messages/show.html',
+                               message=hydrate([msg], viewer)[0])
     else:
         flash ('You must be logged in to view this content', 'danger')
         return render_template('home-anon.html')
 
 
+@app.route('/messages/<int:message_id>/comments')
+@query_budget(3)
+@replica_reads
+def message_comments(message_id):
+    """A page of a message's comments as JSON, older than the 'before'
+    cursor."""
+
+    if not g.user:
+        abort(401)
+
+    stamp = message_stamp(message_id)
+    if stamp is None:
+        abort(404)
+
+    not_modified = conditional(stamp)
+    if not_modified:
+        return not_modified
+
+    page = comment_page(message_id, feed_cursor())
+    return json_response(serialize_comment_page(page))
+
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
-    msg = Message.query.get(message_id)
-
-    if msg.user_id != g.user.id:
-        flash("Access unauthorized.", "danger")
-        return redirect('/401'), 401
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    msg = Message.query.get_or_404(message_id)
+
+    if msg.user_id != g.user.id:
+        abort(403)
+
+    delete_message(msg)
+
+    return json_response(message_id)
+
+
+def delete_message(msg):
+    """Delete (and uncount) a message, and drop it from the caches. (The
+    async messages_destroy handler uses this too; see asgi.py.)"""
+
+    message_deleted(msg)
     db.session.delete(msg)
     db.session.commit()
 
-    return jsonify(message_id)
+    identity_cache.invalidate(msg.user_id)
+
+    search_index.remove_message(msg.id)
 
 
 
@@ -384,20 +768,34 @@ def messages_destroy(message_id):
 
 
 @app.route('/')
+@query_budget(6)
+@replica_reads
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followees
+    - logged in: most recent messages of followees, a page at a time
     """
 
     if g.user:
-        following_users_id = [u.id for u in g.user.following]
-        following_users_id.append(g.user.id)
+        # home timelines are materialized on write; see timeline.py
+        message_ids = home_timeline_ids(g.user.id,
+                                        PAGE_SIZE + 1,
+                                        before=feed_cursor())
 
-        messages = Message.query.filter(Message.user_id.in_(following_users_id)).order_by(Message.timestamp.desc()).all()
+        if not message_ids:
+            # (new users, and anyone who follows nobody): nothing to query
+            if request.args.get('partial'):
+                return render_template('_messages.html', messages=[])
+            return render_template('home.html', messages=[],
+                                   feed=page_of([], has_more=False))
 
-        return render_template('home.html', messages=messages)
+        rows = (feed_query()
+                .filter(Message.id.in_(message_ids[:PAGE_SIZE]))
+                .order_by(Message.timestamp.desc(), Message.id.desc()))
+
+        return render_feed('home.html', rows,
+                           has_more=len(message_ids) > PAGE_SIZE)
 
     else:
         return render_template('home-anon.html')
@@ -408,19 +806,102 @@ def show_401(error):
     return 'oof', 401
 
 
+@app.errorhandler(HasherBusy)
+def show_hasher_busy(error):
+    return 'Too many people are logging in right now; try again shortly.', 503
+
+
+##############################################################################
+# Metrics
+
+
+@app.route('/metrics')
+def metrics():
+    """This worker's SQL, password hashing, write-behind, follow graph,
+    image cache and read replica stats, for Prometheus (which has to send
+    the METRICS_TOKEN as a bearer token)."""
+
+    token = app.config.get('METRICS_TOKEN')
+    if not token:
+        abort(404)
+
+    sent = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(sent.encode(), f"Bearer {token}".encode()):
+        abort(401)
+
+    extra = [(f"warbler_{prefix}_{name}",
+              f"{label} {name.replace('_', ' ')}.",
+              value)
+             for prefix, label, stats in [
+                 ('password_hasher', "Password hasher", hasher.stats()),
+                 ('write_behind', "Write-behind toggles",
+                  write_behind.stats()),
+                 ('follow_graph', "Follow graph", social_graph.stats()),
+                 ('image_cache', "Image cache", image_proxy.stats()),
+                 ('replicas', "Read replica", replicas.stats()),
+             ]
+             for name, value in stats.items()]
+
+    return (sql_stats.prometheus(extra=extra), 200,
+            {'Content-Type': 'text/plain; version=0.0.4'})
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# CLI commands
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recount the denormalized user/message counters."""
+
+    fixed_users, fixed_messages = reconcile_counters()
+    db.session.commit()
+
+    print(f"fixed {fixed_users} users, {fixed_messages} messages")
+
+
+@app.cli.command('trim-timelines')
+def trim_timelines_command():
+    """Cut home timelines back to TIMELINE_LENGTH entries (run it
+    periodically)."""
+
+    trimmed = trim_all_timelines()
+    print(f"trimmed {trimmed} timelines")
+
+
+@app.cli.command('precompute-suggestions')
+def precompute_suggestions_command():
+    """Store who-to-follow suggestions for every user."""
+
+    started = time.monotonic()
+    stored = precompute_suggestions()
+    db.session.commit()
+
+    print(f"stored {stored} suggestions in "
+          f"{time.monotonic() - started:.1f}s")
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply any schema migrations not yet applied (see migrate.py)."""
+
+    applied = migrate.upgrade()
+    print(f"applied {len(applied)} migrations")
+
+
+@app.cli.command('schema-version')
+def schema_version_command():
+    """List the schema migrations, and which have been applied."""
+
+    done = migrate.applied_versions(db.engine) or set()
+    for migration in migrate.discover():
+        state = 'applied' if migration.version in done else 'pending'
+        print(f"{migration.version:04d} {migration.name}: {state}")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Bundle, minify and precompress the JS and CSS."""
+
+    for name, filename in build_assets(app).items():
+        print(f"{name} -> {filename}")
@@ -0,0 +1,529 @@
+"""Async serving for the AJAX endpoints.
+
+A sync gunicorn worker holds one request at a time, so while a like waits on
+the database every other click queued behind it waits too. Served as
+
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker
+
+(as the Procfile does), each worker runs an event loop instead, and answers
+the JSON endpoints the page's scripts call
+
+    add_like            POST /like
+    add_follow          POST /users/follow/<id>
+    add_comment         POST /messages/comments
+    messages_destroy    POST /messages/<id>/delete
+    messages_show       POST /messages/<id>
+
+with asyncpg, from a pool of up to ASYNC_POOL_SIZE connections per worker,
+so it can have as many of them waiting on Postgres at once as the pool
+allows. Everything else (the HTML pages, GETs, static files) goes to the
+Flask app as before, through asgiref's WSGI adapter, which runs each of
+those requests on a thread from the event loop's default executor, so a
+worker can have several of them under way at once.
+
+The handlers read with asyncpg, but write through the same code as the Flask
+routes (app.post_comment(), app.delete_message(), and like / follow toggles
+through the write-behind buffer, writebehind.py), run on a thread, so the
+counters, caches and search index are kept the same way. Their SQL, both
+kinds, is counted in the endpoint's stats (instrumentation.py) as the Flask
+routes' is. Anything they don't handle themselves (no logged-in user,
+a message to like, show or delete that isn't there, someone else's message,
+a malformed body) is passed on to the Flask route, so errors, flashes and
+redirects come out the same. So does every request when asyncpg isn't
+installed or the database isn't Postgres.
+
+Flask's contexts belong to the thread, not the task. Code run on a thread
+(in_thread()) gets an app context; the handlers themselves only enter one,
+a request context built from the real request's scope for url_for(),
+between awaits. Neither runs the Flask request hooks: the handlers record
+the request's SQL and keep writers on the primary themselves.
+"""
+
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import re
+import sys
+import time
+from types import SimpleNamespace
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import g
+from itsdangerous import BadSignature
+from werkzeug.http import dump_cookie, parse_cookie
+
+from app import app, CURR_USER_KEY, delete_message, post_comment
+from caching import PRIVATE_REVALIDATE
+from comments import COMMENTS_PAGE_SIZE, serialize_comment_page
+from fastjson import dumps, timestamp_json
+from identity import Identity, IDENTITY_FIELDS, identity_cache
+from images import img_url
+from instrumentation import RequestQueries, sql_stats
+from models import Message
+from pagination import page_of
+from replicas import SESSION_KEY
+from writebehind import write_behind, LIKE, FOLLOW
+
+# connections per worker
+ASYNC_POOL_SIZE = 20
+
+log = logging.getLogger('warbler.asgi')
+
+# the RequestQueries of the request a handler is answering
+request_queries = contextvars.ContextVar('request_queries', default=None)
+
+# ... and its ASGI scope
+request_scope = contextvars.ContextVar('request_scope', default=None)
+
+# (method, path, handler name); path groups are passed as int arguments
+ROUTES = [
+    ('POST', r'/like', 'add_like'),
+    ('POST', r'/users/follow/(?P<follow_id>\d+)', 'add_follow'),
+    ('POST', r'/messages/comments', 'add_comment'),
+    ('POST', r'/messages/(?P<message_id>\d+)/delete', 'messages_destroy'),
+    ('POST', r'/messages/(?P<message_id>\d+)', 'messages_show'),
+]
+
+IDENTITY_SQL = f"SELECT {', '.join(IDENTITY_FIELDS)} FROM users WHERE id = $1"
+
+LIKE_STATE_SQL = """
+    SELECT likes_count,
+           EXISTS (SELECT 1 FROM likes
+                   WHERE user_id = $2 AND message_id = $1) AS liked
+    FROM messages WHERE id = $1
+"""
+
+# (in `follows`, followee_id is the follower; see models.py)
+FOLLOW_STATE_SQL = """
+    SELECT EXISTS (SELECT 1 FROM follows
+                   WHERE followee_id = $2 AND follower_id = $1) AS following
+    FROM users WHERE id = $1
+"""
+
+MESSAGE_SQL = """
+    SELECT messages.id, messages.text, messages.user_id, messages.timestamp,
+           users.username
+    FROM messages JOIN users ON users.id = messages.user_id
+    WHERE messages.id = $1
+"""
+
+COMMENT_PAGE_SQL = """
+    SELECT comments.id, comments.text, comments.timestamp, comments.user_id,
+           users.username, users.image_url
+    FROM comments JOIN users ON users.id = comments.user_id
+    WHERE comments.message_id = $1
+    ORDER BY comments.timestamp DESC, comments.id DESC
+    LIMIT $2
+"""
+
+
+def async_dsn(uri):
+    """SQLALCHEMY_DATABASE_URI as a DSN for asyncpg (None if it isn't
+    Postgres)."""
+
+    scheme, _, rest = uri.partition('://')
+    if scheme.split('+')[0] not in ('postgres', 'postgresql'):
+        return None
+    return f'postgresql://{rest}'
+
+
+def wsgi_environ(scope):
+    """A WSGI environ for the request in ASGI `scope` (without its body)."""
+
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin-1')
+        if name in environ:
+            value = f'{environ[name]},{value}'
+        environ[name] = value
+
+    return environ
+
+
+def json_body(body):
+    """A JSON object request body as a dict, or None."""
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+async def read_body(receive):
+    """The whole request body (None if the client went away)."""
+
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def replay(body, receive):
+    """A receive() that gives a body we've already read once more."""
+
+    pending = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def replayed():
+        if pending:
+            return pending.pop()
+        return await receive()
+
+    return replayed
+
+
+class AsyncApp:
+    """The ASGI app: async handlers for ROUTES, Flask for the rest."""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.flask = WsgiToAsgi(flask_app)
+        self.pool = None
+        self.routes = [(method, re.compile(path), getattr(self, name))
+                       for method, path, name in ROUTES]
+
+        flask_app.config.setdefault('ASYNC_POOL_SIZE', ASYNC_POOL_SIZE)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        route = self.pool and scope['type'] == 'http' and self.route(scope)
+        if route:
+            handler, kwargs = route
+            queries = self.start_queries(handler.__name__)
+            request_scope.set(scope)
+            session = self.session(scope)
+            user = await self.current_user(session)
+
+            if user is not None:
+                body = await read_body(receive)
+                if body is None:
+                    return
+
+                data = await handler(user, body, **kwargs)
+                if data is not None:
+                    status = 200
+                    if isinstance(data, tuple):
+                        data, status = data
+                    await self.respond(send, data, session, status)
+                    sql_stats.record(queries, scope['method'], status)
+                    return
+
+                receive = replay(body, receive)
+
+        await self.flask(scope, receive, send)
+
+    def route(self, scope):
+        """(handler, path arguments) for the request, or None."""
+
+        for method, path, handler in self.routes:
+            match = path.fullmatch(scope['path'])
+            if match and scope['method'] == method:
+                return handler, {name: int(value)
+                                 for name, value in match.groupdict().items()}
+        return None
+
+    ##########################################################################
+    # SQL
+
+    def start_queries(self, endpoint):
+        """Count this request's SQL against `endpoint` (a Flask endpoint,
+        for its stats and query budget)."""
+
+        queries = RequestQueries()
+        queries.endpoint = endpoint
+        queries.budget = getattr(self.app.view_functions.get(endpoint),
+                                 'query_budget', None)
+        request_queries.set(queries)
+        return queries
+
+    async def query(self, method, statement, *args):
+        """`await conn.<method>(statement, *args)` on a pooled connection,
+        counted in the request's stats."""
+
+        async with self.pool.acquire() as conn:
+            started = time.perf_counter()
+            result = await getattr(conn, method)(statement, *args)
+            seconds = time.perf_counter() - started
+
+        queries = request_queries.get()
+        if queries is not None:
+            queries.record(statement, seconds)
+
+        return result
+
+    async def in_thread(self, function, *args):
+        """Run `function` on a worker thread, for sync code that may block
+        (on the database, or a lock held while it's used), in an app context
+        whose SQL is counted in this request's stats."""
+
+        queries = request_queries.get()
+
+        def run():
+            with self.app.app_context():
+                if queries is not None:
+                    g.sql_queries = queries
+                return function(*args)
+
+        return await asyncio.get_running_loop().run_in_executor(None, run)
+
+    ##########################################################################
+    # Startup and shutdown
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        """Open this worker's connection pool (if we can)."""
+
+        dsn = async_dsn(self.app.config['SQLALCHEMY_DATABASE_URI'])
+        if asyncpg is None or dsn is None:
+            log.warning("async endpoints need asyncpg and Postgres; "
+                        "serving everything through Flask")
+            return
+
+        self.pool = await asyncpg.create_pool(
+            dsn, min_size=1, max_size=self.app.config['ASYNC_POOL_SIZE'])
+
+    async def shutdown(self):
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            await pool.close()
+
+    ##########################################################################
+    # Sessions and responses
+
+    def session(self, scope):
+        """The Flask session from the request's cookie, as a dict."""
+
+        header = b'; '.join(value for name, value in scope['headers']
+                            if name == b'cookie').decode('latin-1')
+        cookie = parse_cookie(header).get(
+            self.app.config['SESSION_COOKIE_NAME'])
+        if not cookie:
+            return {}
+
+        interface = self.app.session_interface
+        serializer = interface.get_signing_serializer(self.app)
+        max_age = int(self.app.permanent_session_lifetime.total_seconds())
+        try:
+            return serializer.loads(cookie, max_age=max_age)
+        except BadSignature:
+            return {}
+
+    def session_cookie(self, data):
+        """A Set-Cookie value for session `data`, as Flask would write it."""
+
+        app = self.app
+        interface = app.session_interface
+        session = interface.session_class(data)
+
+        return dump_cookie(
+            app.config['SESSION_COOKIE_NAME'],
+            interface.get_signing_serializer(app).dumps(dict(session)),
+            expires=interface.get_expiration_time(app, session),
+            domain=interface.get_cookie_domain(app),
+            path=interface.get_cookie_path(app),
+            secure=interface.get_cookie_secure(app),
+            httponly=interface.get_cookie_httponly(app),
+            samesite=interface.get_cookie_samesite(app))
+
+    async def respond(self, send, data, session, status=200):
+        """Send `data` as JSON. These are all writes, so (as
+        replicas.remember_writes() does) a user with read replicas
+        configured is kept on the primary for a while after a success."""
+
+        body = dumps(data)
+        headers = [(b'content-type', b'application/json'),
+                   (b'content-length', str(len(body)).encode()),
+                   (b'cache-control', PRIVATE_REVALIDATE.encode())]
+
+        if status == 200 and self.app.config['SQLALCHEMY_REPLICA_URIS']:
+            session = dict(session)
+            session[SESSION_KEY] = (
+                time.time() + self.app.config['REPLICA_STICKY_SECONDS'])
+            headers += [(b'set-cookie',
+                         self.session_cookie(session).encode('latin-1')),
+                        (b'vary', b'Cookie')]
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def url_context(self):
+        """A request context for url_for(), from the request being answered
+        (so links get its script root). Don't await inside it."""
+
+        return self.app.request_context(wsgi_environ(request_scope.get()))
+
+    async def current_user(self, session):
+        """The logged-in user's Identity (see identity.py), or None."""
+
+        user_id = session.get(CURR_USER_KEY)
+        if user_id is None:
+            return None
+
+        identity = identity_cache.get(user_id)
+        if identity is None:
+            row = await self.query('fetchrow', IDENTITY_SQL, user_id)
+            if row is None:
+                return None
+
+            identity = Identity(**dict(row.items()))
+            identity_cache.put(identity)
+
+        return identity
+
+    ##########################################################################
+    # Handlers: each returns the JSON to send (or, as Flask views can, a
+    # (JSON, status) tuple), or None to have Flask answer
+
+    async def add_like(self, user, body):
+        """Like or unlike a message (written behind)."""
+
+        try:
+            msg_id = int(json_body(body).get('msg-id'))
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+        row = await self.query('fetchrow', LIKE_STATE_SQL, msg_id, user.id)
+        if row is None:
+            return None
+
+        likes = row['likes_count'] + write_behind.pending_delta(LIKE, msg_id)
+        was_liked = write_behind.overlay(LIKE, user.id, [msg_id]).get(
+            msg_id, row['liked'])
+
+        # (with a WRITE_BEHIND_WINDOW of 0 this writes it there and then)
+        liked, changed = await self.in_thread(write_behind.toggle, LIKE,
+                                              user.id, msg_id, was_liked)
+        if changed:
+            likes += 1 if liked else -1
+
+        with self.url_context():
+            user_img = img_url(user.image_url, 'badge')
+
+        return {
+            "likes": likes,
+            "is-liked": liked,
+            "msgId": msg_id,
+            "userImg": user_img,
+        }
+
+    async def add_follow(self, user, body, follow_id):
+        """Follow or unfollow a user (written behind)."""
+
+        row = await self.query('fetchrow', FOLLOW_STATE_SQL, follow_id,
+                               user.id)
+        if row is None:
+            return None
+
+        was_following = write_behind.overlay(FOLLOW, user.id,
+                                             [follow_id]).get(
+            follow_id, row['following'])
+        following, _ = await self.in_thread(write_behind.toggle, FOLLOW,
+                                            user.id, follow_id,
+                                            was_following)
+
+        return {
+            "followeeId": follow_id,
+            "isFollowing": following,
+        }
+
+    async def add_comment(self, user, body):
+        """Comment on a message."""
+
+        data = json_body(body)
+        try:
+            msg_id = int(data.get('msgId'))
+            text = data.get('text')
+        except (AttributeError, TypeError, ValueError):
+            return None
+        if not isinstance(text, str) or len(text) > 140:
+            return None
+
+        comment = await self.in_thread(post_comment, user.id, msg_id, text)
+        if comment is None:
+            return {'error': 'No such message'}, 404
+
+        return comment
+
+    async def messages_destroy(self, user, body, message_id):
+        """Delete one of the user's messages."""
+
+        return await self.in_thread(self._destroy, user.id, message_id)
+
+    @staticmethod
+    def _destroy(user_id, message_id):
+        msg = Message.query.get(message_id)
+        if msg is None or msg.user_id != user_id:
+            return None
+
+        delete_message(msg)
+        return message_id
+
+    async def messages_show(self, user, body, message_id):
+        """A message, with its first page of comments."""
+
+        msg = await self.query('fetchrow', MESSAGE_SQL, message_id)
+        if msg is None:
+            return None
+        rows = await self.query('fetch', COMMENT_PAGE_SQL, message_id,
+                                COMMENTS_PAGE_SIZE + 1)
+
+        rows = [SimpleNamespace(**dict(row.items())) for row in rows]
+        page = page_of(rows[:COMMENTS_PAGE_SIZE],
+                       has_more=len(rows) > COMMENTS_PAGE_SIZE)
+
+        with self.url_context():
+            resp = serialize_comment_page(page)
+
+        resp.update(id=msg['id'],
+                    text=msg['text'],
+                    user_id=msg['user_id'],
+                    username=msg['username'],
+                    timestamp=timestamp_json(msg['timestamp']))
+        return resp
+
+
+application = AsyncApp(app)
@@ -0,0 +1,234 @@
+"""Bundled, minified static assets with content-hashed filenames.
+
+BUNDLES lists the JS / CSS files each bundle is built from. `flask
+build-assets` (or the first page rendered, if it hasn't been run) minifies
+and concatenates them into static/dist/<name>.<hash>.<ext>, next to gzip and
+brotli compressed copies, and maps each bundle's name to its file in
+static/dist/manifest.json.
+
+Templates link them with asset_url('app.js'). They're served from /assets/,
+which sends the smallest precompressed copy the client accepts and caches
+them as immutable: a new build gets new filenames, so repeat visits never
+download (or revalidate) an asset again until it changes.
+
+url("/static/...") references in CSS are rewritten with their ?v=<hash>,
+so images they use are cached the same way (see caching.py).
+
+JS is minified with rjsmin.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import brotli
+import rjsmin
+from flask import current_app, request, send_from_directory, url_for
+
+from caching import IMMUTABLE, file_hash
+
+# bundle name -> source files, relative to the static folder
+BUNDLES = {
+    'app.js': ['app.js'],
+    'app.css': ['stylesheets/style.css'],
+}
+
+# built files go in this subfolder of the static folder
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+# slow settings are fine: assets are compressed once per build
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+# (suffix, Content-Encoding) of the precompressed copies, best first
+VARIANTS = [('.br', 'br'), ('.gz', 'gzip')]
+
+# (mtime, manifest) of the manifest last read
+_manifest = None
+
+
+def init_assets(app):
+    """Serve built assets from /assets/, and give templates asset_url()."""
+
+    app.add_url_rule('/assets/<path:filename>', 'asset', send_asset)
+    app.add_template_global(asset_url)
+
+
+##############################################################################
+# Building
+
+
+def minify_css(css):
+    """Strip comments and the whitespace CSS doesn't need."""
+
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r' ?([{};,>]) ?', r'\1', css)
+    css = re.sub(r': ', ':', css)
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    """Strip comments and the whitespace JS doesn't need."""
+
+    return rjsmin.jsmin(js)
+
+
+def version_css_urls(css, static_folder, static_url_path):
+    """Add ?v=<content hash> to url("/static/...") references."""
+
+    def versioned(match):
+        quote, filename = match.group(1), match.group(2)
+        path = os.path.join(static_folder, filename)
+        if not os.path.isfile(path):
+            return match.group(0)
+        return (f'url({quote}{static_url_path}/{filename}'
+                f'?v={file_hash(path)}{quote})')
+
+    pattern = (r'url\(([\'"]?)' + re.escape(static_url_path)
+               + r'/([^\'")?#]+)\1\)')
+    return re.sub(pattern, versioned, css)
+
+
+def _write(path, data):
+    """Write `path` atomically (other workers may be reading it)."""
+
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def build_bundle(name, sources, static_folder, static_url_path):
+    """The minified contents of bundle `name`."""
+
+    parts = []
+    for source in sources:
+        with open(os.path.join(static_folder, source), encoding='UTF-8') as f:
+            parts.append(f.read())
+
+    if name.endswith('.css'):
+        css = minify_css('\n'.join(parts))
+        return version_css_urls(css, static_folder, static_url_path)
+
+    # (";" so a file without a trailing semicolon can't run into the next)
+    return ';\n'.join(minify_js(part) for part in parts)
+
+
+def build_assets(app):
+    """Build every bundle and its compressed copies, write the manifest,
+    and delete files left over from older builds. Returns the manifest."""
+
+    dist = os.path.join(app.static_folder, DIST)
+    os.makedirs(dist, exist_ok=True)
+
+    previous = read_manifest(dist) or {}
+    manifest = {}
+
+    for name, sources in BUNDLES.items():
+        data = build_bundle(name, sources, app.static_folder,
+                            app.static_url_path).encode('UTF-8')
+
+        stem, ext = os.path.splitext(name)
+        filename = f'{stem}.{hashlib.md5(data).hexdigest()[:12]}{ext}'
+        manifest[name] = filename
+
+        path = os.path.join(dist, filename)
+        if os.path.exists(path):
+            continue
+
+        _write(path, data)
+        _write(path + '.gz', gzip.compress(data, GZIP_LEVEL))
+        _write(path + '.br', brotli.compress(data, quality=BROTLI_QUALITY))
+
+    _write(os.path.join(dist, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('UTF-8'))
+
+    # keep the last build's files, for pages rendered before this one
+    keep = {MANIFEST}
+    for filename in (*manifest.values(), *previous.values()):
+        keep.update(filename + suffix for suffix in ('', '.gz', '.br'))
+
+    for filename in os.listdir(dist):
+        if filename not in keep and not filename.endswith('.tmp'):
+            os.remove(os.path.join(dist, filename))
+
+    return manifest
+
+
+##############################################################################
+# Linking and serving
+
+
+def read_manifest(dist):
+    """The manifest in the `dist` folder, or None if there isn't one."""
+
+    try:
+        with open(os.path.join(dist, MANIFEST), encoding='UTF-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _stale(app, built_at):
+    """Has a bundle's source changed since the manifest was written?"""
+
+    return any(os.stat(os.path.join(app.static_folder, source)).st_mtime
+               > built_at
+               for sources in BUNDLES.values() for source in sources)
+
+
+def manifest():
+    """{bundle name: built filename}, building the bundles if they haven't
+    been (or, in debug mode, if their sources have changed)."""
+
+    global _manifest
+
+    app = current_app
+    path = os.path.join(app.static_folder, DIST, MANIFEST)
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        mtime = None
+
+    if mtime is None or (app.debug and _stale(app, mtime)):
+        _manifest = (None, build_assets(app))
+
+    elif _manifest is None or _manifest[0] != mtime:
+        _manifest = (mtime, read_manifest(os.path.dirname(path)))
+
+    return _manifest[1]
+
+
+def asset_url(name):
+    """The URL of bundle `name` (e.g. 'app.js'), for templates."""
+
+    return url_for('asset', filename=manifest()[name])
+
+
+def send_asset(filename):
+    """A built asset, precompressed if the client accepts it. Its name
+    includes its hash, so it can be cached forever."""
+
+    dist = os.path.join(current_app.static_folder, DIST)
+    mimetype = mimetypes.guess_type(filename)[0]
+
+    for suffix, encoding in VARIANTS:
+        if (request.accept_encodings[encoding]
+                and os.path.isfile(os.path.join(dist, filename + suffix))):
+            response = send_from_directory(dist, filename + suffix,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+
+    else:
+        response = send_from_directory(dist, filename, mimetype=mimetype)
+
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response
@@ -0,0 +1,91 @@
+"""Per-worker indexes loaded from the database in the background.
+
+The search index (search.py) and the follows graph (graph.py) each keep a
+whole table in memory in every worker. BackgroundIndex is what they share:
+ready() starts loading the index in a thread the first time it's asked, and
+reloading it once it's `rebuild_interval` seconds old, and callers carry on
+without it meanwhile. A load that fails is only tried again RETRY_AFTER
+seconds later, so while the database is down each worker tries once in a
+while rather than on every request.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from flask import current_app
+
+from models import db
+
+# after a failed load, wait this long (seconds) before trying again
+RETRY_AFTER = 60
+
+log = logging.getLogger('warbler.background')
+
+
+class BackgroundIndex:
+    """An index loaded by rebuild() in a background thread.
+
+    Subclasses define rebuild(), which sets built_at once the new index is
+    in place, and `loaded`; and may define load_failed(), to drop anything
+    a failed rebuild() left half done.
+    """
+
+    def __init__(self, name, rebuild_interval):
+        self.name = name
+        self.rebuild_interval = rebuild_interval
+
+        self.lock = threading.RLock()
+        self.built_at = None
+        self.failed_at = None
+        self.building = None
+        self.pid = None
+
+    @property
+    def loaded(self):
+        raise NotImplementedError
+
+    def rebuild(self):
+        raise NotImplementedError
+
+    def load_failed(self):
+        pass
+
+    def ready(self, app=None):
+        """Is the index loaded? Starts loading it (in the background) if it
+        never has been, or reloading it if it's out of date, unless a load
+        failed less than RETRY_AFTER seconds ago."""
+
+        now = time.monotonic()
+        stale = (self.built_at is None
+                 or now - self.built_at > self.rebuild_interval)
+        failed = (self.failed_at is not None
+                  and now - self.failed_at < RETRY_AFTER)
+
+        if stale and not failed:
+            with self.lock:
+                # (re)started lazily so each forked worker gets its own
+                if self.building is None or self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    self.building = threading.Thread(
+                        target=self._build_in,
+                        args=(app or current_app._get_current_object(),),
+                        name=self.name, daemon=True)
+                    self.building.start()
+
+        return self.loaded
+
+    def _build_in(self, app):
+        with app.app_context():
+            try:
+                self.rebuild()
+                self.failed_at = None
+            except Exception:
+                with self.lock:
+                    self.load_failed()
+                self.failed_at = time.monotonic()
+                log.exception("loading the %s failed", self.name)
+            finally:
+                db.session.remove()
+                self.building = None
@@ -0,0 +1,76 @@
+"""Benchmark password checking: logins/sec, and logins/sec per core.
+
+Checks one bcrypt hash over and over from a number of concurrent "requests",
+first inline (like the old code) and then through PasswordHasher's process
+pool at each pool size up to the number of CPUs.
+
+Run from the repo root like:
+
+    python benchmarks/bench_passwords.py --rounds 12 --logins 64
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import PasswordHasher  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+
+
+def bench(workers, rounds, logins, concurrency):
+    """Return (logins/sec, peak queue depth) for a pool of `workers`."""
+
+    hashed = PasswordHasher(rounds=rounds, workers=0).hash(PASSWORD)
+    hasher = PasswordHasher(rounds=rounds, workers=workers,
+                            max_queued=concurrency)
+
+    # warm up (and start the pool) before timing
+    hasher.check(hashed, PASSWORD)
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(concurrency) as requests:
+        results = list(requests.map(lambda _: hasher.check(hashed, PASSWORD),
+                                    range(logins)))
+
+    elapsed = time.perf_counter() - start
+    assert all(results)
+
+    peak_queued = hasher.stats()['peak_queued']
+    hasher.shutdown()
+
+    return logins / elapsed, peak_queued
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12,
+                        help="bcrypt work factor (default 12)")
+    parser.add_argument('--logins', type=int, default=32,
+                        help="logins to time per pool size (default 32)")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="concurrent requests (default 8)")
+    args = parser.parse_args()
+
+    cpus = os.cpu_count()
+    sizes = sorted({1, 2, cpus // 2, cpus} - {0})
+
+    print(f"bcrypt cost {args.rounds}, {args.logins} logins, "
+          f"{args.concurrency} concurrent, {cpus} CPUs")
+    print(f"{'pool':>8} {'logins/sec':>12} {'per core':>10} "
+          f"{'peak queue':>11}")
+
+    for workers in [0] + [size for size in sizes if size <= cpus]:
+        rate, peak = bench(workers, args.rounds, args.logins, args.concurrency)
+        label = workers or "inline"
+        print(f"{label:>8} {rate:>12.1f} {rate / max(workers, 1):>10.1f} "
+              f"{peak:>11}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,687 @@
+"""Benchmark the main routes against a seeded dataset.
+
+Generates (and caches) a dataset of each requested size with
+generator/create_csvs.py, loads it with loader.bulk_load(), then replays a
+weighted mix of requests from random logged-in users:
+
+    homepage            GET  /
+    users_show          GET  /users/<id>
+    render_likes_page   GET  /likes
+    messages_show       GET  /messages/<id>
+    add_like            POST /like
+    add_follow          POST /users/follow/<id>
+
+either in-process through Flask's test client or over HTTP against a local
+gunicorn (`--target async` serves asgi.py instead, with the AJAX endpoints
+on asyncpg). Reports throughput, p50/p95/p99 latency, bytes on the wire (with
+--accept-encoding, default "br, gzip"), and SQL statements and CPU time per
+request (in-process; gunicorn's CPU time is only totalled, from /proc) for
+each route, and saves everything as JSON under
+benchmarks/results/, named after the current commit, so runs can be compared:
+
+    python benchmarks/bench_routes.py --users 1000,10000 --target both
+    python benchmarks/bench_routes.py --skip-seed \
+        --compare benchmarks/results/<earlier>.json
+
+--ajax-capacity instead replays only the AJAX endpoints (likes, follows,
+comments and the message modal's POST), at rising concurrency (--levels),
+against a single gunicorn worker: a sync one, as deployed today, and then
+an async one (asgi.py). For each it reports the most concurrent requests
+the worker held with no errors and p95 latency within --latency-budget:
+
+    python benchmarks/bench_routes.py --skip-seed --ajax-capacity
+
+The database (--database-url, default postgresql:///warbler-bench) is dropped
+and re-created when seeding, so don't point this at one you care about.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from random import Random
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_DATABASE_URL = 'postgresql:///warbler-bench'
+
+DEFAULT_ACCEPT_ENCODING = 'br, gzip'
+
+# relative weights of each route in the replayed mix
+MIX = {
+    'homepage': 30,
+    'users_show': 20,
+    'render_likes_page': 10,
+    'messages_show': 20,
+    'add_like': 15,
+    'add_follow': 5,
+}
+
+# the AJAX endpoints, for --ajax-capacity
+AJAX_MIX = {
+    'add_like': 50,
+    'add_follow': 15,
+    'add_comment': 10,
+    'message_json': 25,
+}
+
+DEFAULT_LEVELS = '1,8,32,128,512'
+
+# p95 (ms) a concurrency level must stay within to count as held
+DEFAULT_LATENCY_BUDGET = 500
+
+PERCENTILES = (50, 95, 99)
+
+
+##############################################################################
+# Dataset
+
+
+def git_commit():
+    """(commit hash, whether the tree has uncommitted changes)."""
+
+    def git(*args):
+        result = subprocess.run(['git', *args], cwd=ROOT, check=True,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        return result.stdout.decode().strip()
+
+    try:
+        return git('rev-parse', 'HEAD'), bool(git('status', '--porcelain'))
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+
+def generate(users, seed, data_dir):
+    """CSVs for `users` users, generated once and cached in `data_dir`."""
+
+    out = os.path.join(data_dir, f"users{users}-seed{seed}")
+
+    if not os.path.exists(os.path.join(out, 'comments.csv')):
+        subprocess.run([sys.executable,
+                        os.path.join(ROOT, 'generator', 'create_csvs.py'),
+                        '--users', str(users),
+                        '--seed', str(seed),
+                        '--out', out],
+                       check=True)
+
+    return out
+
+
+def seed_database(app, directory):
+    from loader import bulk_load
+
+    with app.app_context():
+        bulk_load(directory)
+
+
+def dataset_size(app):
+    """(number of users, number of messages) in the database."""
+
+    from models import db
+
+    with app.app_context():
+        return tuple(db.session.execute(
+            "SELECT (SELECT max(id) FROM users), "
+            "(SELECT max(id) FROM messages)").first())
+
+
+##############################################################################
+# Requests
+
+
+def session_cookie(app, user_id):
+    """A Cookie header logging `user_id` in, the way Flask would sign it."""
+
+    from app import CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+    return f"{cookie_name}={serializer.dumps({CURR_USER_KEY: user_id})}"
+
+
+def make_request(route, rng, users, messages):
+    """(method, path, JSON body or None) for one request to `route`."""
+
+    if route == 'homepage':
+        return 'GET', '/', None
+    if route == 'users_show':
+        return 'GET', f"/users/{rng.randint(1, users)}", None
+    if route == 'render_likes_page':
+        return 'GET', '/likes', None
+    if route == 'messages_show':
+        return 'GET', f"/messages/{rng.randint(1, messages)}", None
+    if route == 'add_like':
+        return 'POST', '/like', {'msg-id': rng.randint(1, messages)}
+    if route == 'add_follow':
+        return 'POST', f"/users/follow/{rng.randint(1, users)}", None
+    if route == 'add_comment':
+        return 'POST', '/messages/comments', {
+            'msgId': rng.randint(1, messages), 'text': 'benchmarking'}
+    if route == 'message_json':
+        return 'POST', f"/messages/{rng.randint(1, messages)}", None
+
+    raise ValueError(f"unknown route {route}")
+
+
+def plan_requests(count, mix, seed, users, messages):
+    """A reproducible list of (route, user id, method, path, body)."""
+
+    rng = Random(seed)
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+
+    planned = []
+    for route in rng.choices(routes, weights, k=count):
+        user_id = rng.randint(1, users)
+        planned.append((route, user_id) + make_request(route, rng, users,
+                                                       messages))
+    return planned
+
+
+class InProcess:
+    """Sends requests through the Flask test client, counting SQL and CPU
+    time."""
+
+    name = 'in-process'
+
+    def __init__(self, app, accept_encoding):
+        from sqlalchemy import event
+        from models import db
+
+        self.app = app
+        self.accept_encoding = accept_encoding
+        self.local = threading.local()
+
+        with app.app_context():
+            self.engine = db.engine
+        event.listen(self.engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.statements = getattr(self.local, 'statements', 0) + 1
+
+    def send(self, method, path, body, cookie):
+        """Returns (status, SQL statements run, bytes, CPU seconds)."""
+
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.app.test_client(use_cookies=False)
+            self.local.client = client
+
+        self.local.statements = 0
+        cpu = time.thread_time()
+        resp = client.open(path, method=method, json=body,
+                           headers={'Cookie': cookie,
+                                    'Accept-Encoding': self.accept_encoding})
+        size = len(resp.get_data())
+        cpu = time.thread_time() - cpu
+
+        return resp.status_code, self.local.statements, size, cpu
+
+    def cpu_seconds(self):
+        return None
+
+    def close(self):
+        from sqlalchemy import event
+
+        event.remove(self.engine, 'before_cursor_execute', self.count)
+
+
+class Gunicorn:
+    """Sends requests over HTTP to a gunicorn serving the app."""
+
+    name = 'gunicorn'
+    command = ['app:app']
+
+    def __init__(self, database_url, workers, port, accept_encoding):
+        self.port = port or free_port()
+        self.local = threading.local()
+        self.accept_encoding = accept_encoding
+
+        env = dict(os.environ, DATABASE_URL=database_url)
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', *self.command,
+             '--bind', f"127.0.0.1:{self.port}",
+             '--workers', str(workers),
+             '--log-level', 'warning'],
+            cwd=ROOT, env=env)
+
+        wait_for_port(self.port, self.process)
+
+    def send(self, method, path, body, cookie):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(
+                '127.0.0.1', self.port, timeout=60)
+
+        headers = {'Cookie': cookie, 'Accept-Encoding': self.accept_encoding}
+        data = None
+        if body is not None:
+            data = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        try:
+            conn.request(method, path, data, headers)
+            resp = conn.getresponse()
+            size = len(resp.read())
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            raise
+
+        return resp.status, None, size, None
+
+    def cpu_seconds(self):
+        """CPU time used by gunicorn and its workers so far (None if /proc
+        isn't there to ask)."""
+
+        pids = {self.process.pid}
+        ticks = 0
+
+        try:
+            for entry in os.listdir('/proc'):
+                if not entry.isdigit():
+                    continue
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        # (the command name can contain spaces)
+                        fields = f.read().rsplit(')', 1)[1].split()
+                except OSError:
+                    continue
+                # fields from state (3rd) on: ppid is 4th, utime / stime
+                # 14th and 15th
+                if int(entry) in pids or int(fields[1]) in pids:
+                    ticks += int(fields[11]) + int(fields[12])
+        except OSError:
+            return None
+
+        return ticks / os.sysconf('SC_CLK_TCK')
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class AsyncGunicorn(Gunicorn):
+    """Sends requests over HTTP to a gunicorn with uvicorn workers serving
+    asgi.py."""
+
+    name = 'async'
+    command = ['asgi:application',
+               '--worker-class', 'uvicorn.workers.UvicornWorker']
+
+
+TARGETS = {target.name: target for target in (Gunicorn, AsyncGunicorn)}
+
+
+def make_target(name, app, args, workers):
+    if name == 'in-process':
+        return InProcess(app, args.accept_encoding)
+    return TARGETS[name](args.database_url, workers, args.port,
+                         args.accept_encoding)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("gunicorn exited before it started serving")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+
+    raise RuntimeError(f"gunicorn didn't start listening on port {port}")
+
+
+##############################################################################
+# Running and reporting
+
+
+def replay(target, planned, cookies, concurrency):
+    """Send the planned requests; returns ([samples], elapsed seconds).
+
+    Each sample is (route, seconds, status, statements, bytes, CPU seconds).
+    """
+
+    def send(request):
+        route, user_id, method, path, body = request
+        start = time.perf_counter()
+        try:
+            status, statements, size, cpu = target.send(method, path, body,
+                                                        cookies[user_id])
+        except (http.client.HTTPException, OSError):
+            status, statements, size, cpu = None, None, None, None
+        return (route, time.perf_counter() - start, status, statements,
+                size, cpu)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        samples = list(pool.map(send, planned))
+
+    return samples, time.perf_counter() - start
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def summarize(samples, elapsed, cpu_seconds=None):
+    """Per-route (and overall) stats for one run. `cpu_seconds` is the
+    server's total, if it was only measured in total."""
+
+    def stats(group):
+        latencies = sorted(sample[1] * 1000 for sample in group)
+        errors = sum(1 for sample in group
+                     if sample[2] is None or sample[2] >= 400)
+
+        summary = {
+            'requests': len(group),
+            'errors': errors,
+            'throughput': len(group) / elapsed if elapsed else None,
+            'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        }
+        for pct in PERCENTILES:
+            summary[f"p{pct}_ms"] = percentile(latencies, pct)
+        summary['statements'] = mean(sample[3] for sample in group)
+        summary['bytes'] = mean(sample[4] for sample in group)
+        summary['cpu_ms'] = mean(sample[5] and sample[5] * 1000
+                                 for sample in group)
+        return summary
+
+    routes = {}
+    for sample in samples:
+        routes.setdefault(sample[0], []).append(sample)
+
+    overall = stats(samples)
+    if cpu_seconds is not None and samples:
+        overall['cpu_ms'] = cpu_seconds * 1000 / len(samples)
+
+    return {
+        'elapsed': elapsed,
+        'overall': overall,
+        'routes': {route: stats(group)
+                   for route, group in sorted(routes.items())},
+    }
+
+
+def fmt(value, spec):
+    return '-' if value is None else format(value, spec)
+
+
+def print_run(run):
+    print(f"\n{run['users']} users, {run['messages']} messages; "
+          f"{run['target']}, concurrency {run['concurrency']}, "
+          f"{run['elapsed']:.1f}s")
+    print(f"{'route':<18} {'reqs':>6} {'errs':>5} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'SQL/req':>8} "
+          f"{'KB/resp':>8} {'CPU ms':>8}")
+
+    rows = list(run['routes'].items()) + [('(all)', run['overall'])]
+    for route, stats in rows:
+        print(f"{route:<18} {stats['requests']:>6} {stats['errors']:>5} "
+              f"{fmt(stats['throughput'], '.1f'):>8} "
+              f"{fmt(stats['p50_ms'], '.1f'):>8} "
+              f"{fmt(stats['p95_ms'], '.1f'):>8} "
+              f"{fmt(stats['p99_ms'], '.1f'):>8} "
+              f"{fmt(stats['statements'], '.1f'):>8} "
+              f"{fmt(stats['bytes'] and stats['bytes'] / 1024, '.2f'):>8} "
+              f"{fmt(stats['cpu_ms'], '.2f'):>8}")
+
+
+def compare(results, path):
+    """Print p95 / throughput changes against an earlier results file."""
+
+    with open(path) as f:
+        before = json.load(f)
+
+    def key(run):
+        return run['users'], run['target'], run['concurrency']
+
+    earlier = {key(run): run for run in before['runs']}
+    print(f"\ncompared with {before['commit'][:10]} ({path}):")
+
+    for run in results['runs']:
+        old = earlier.get(key(run))
+        if old is None:
+            continue
+
+        print(f"{run['users']} users, {run['target']}:")
+        rows = list(run['routes'].items()) + [('(all)', run['overall'])]
+        for route, stats in rows:
+            old_stats = (old['overall'] if route == '(all)'
+                         else old['routes'].get(route))
+            if not old_stats or not old_stats['p95_ms']:
+                continue
+
+            line = (f"  {route:<18} p95 {old_stats['p95_ms']:.1f} -> "
+                    f"{stats['p95_ms']:.1f} ms "
+                    f"({stats['p95_ms'] / old_stats['p95_ms'] - 1:+.0%}), "
+                    f"req/s {old_stats['throughput']:.1f} -> "
+                    f"{stats['throughput']:.1f}")
+
+            # (results from before these were measured don't have them)
+            for name, unit in [('bytes', 'B'), ('cpu_ms', 'ms CPU')]:
+                if old_stats.get(name) and stats.get(name):
+                    line += (f", {old_stats[name]:.1f} -> "
+                             f"{stats[name]:.1f} {unit}")
+            print(line)
+
+
+def save(results, results_dir):
+    os.makedirs(results_dir, exist_ok=True)
+
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    path = os.path.join(results_dir, f"{stamp}-{results['commit'][:10]}.json")
+
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    return path
+
+
+def parse_mix(text):
+    """'homepage=5,add_like=1' -> {'homepage': 5, 'add_like': 1}."""
+
+    mix = {}
+    for part in text.split(','):
+        route, _, weight = part.partition('=')
+        if route not in MIX and route not in AJAX_MIX:
+            raise argparse.ArgumentTypeError(f"unknown route {route!r}")
+        mix[route] = float(weight or 1)
+    return mix
+
+
+def ajax_capacity(app, args, users, messages, results):
+    """Find how many concurrent AJAX requests one sync and one async worker
+    hold; returns {target: the highest level held}."""
+
+    levels = [int(level) for level in args.levels.split(',')]
+    held = {}
+
+    for name in ('gunicorn', 'async'):
+        target = make_target(name, app, args, workers=1)
+        held[name] = 0
+
+        try:
+            warmup = plan_requests(args.warmup, AJAX_MIX, args.seed - 1,
+                                   users, messages)
+            cookies = {user_id: session_cookie(app, user_id)
+                       for _, user_id, *_ in warmup}
+            replay(target, warmup, cookies, 1)
+
+            for level in levels:
+                planned = plan_requests(max(args.requests, level * 4),
+                                        AJAX_MIX, args.seed + level,
+                                        users, messages)
+                cookies.update((user_id, session_cookie(app, user_id))
+                               for _, user_id, *_ in planned
+                               if user_id not in cookies)
+
+                samples, elapsed = replay(target, planned, cookies, level)
+                run = dict(users=users, messages=messages, target=name,
+                           concurrency=level, **summarize(samples, elapsed))
+                results['runs'].append(run)
+                print_run(run)
+
+                overall = run['overall']
+                if (overall['errors']
+                        or overall['p95_ms'] > args.latency_budget):
+                    # (past what it can hold; more only takes longer)
+                    break
+                held[name] = level
+
+        finally:
+            target.close()
+
+    print(f"\nconcurrent AJAX requests one worker holds "
+          f"(no errors, p95 <= {args.latency_budget:g} ms):")
+    for name, level in held.items():
+        most = level == levels[-1]
+        print(f"  {name:<10} {level}{'+' if most else ''}")
+
+    return held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', default='1000',
+                        help="dataset sizes to run against, comma separated "
+                             "(default 1000)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for the dataset and the request mix")
+    parser.add_argument('--skip-seed', action='store_true',
+                        help="run against whatever is already in the database")
+    parser.add_argument('--database-url',
+                        default=os.environ.get('BENCH_DATABASE_URL',
+                                               DEFAULT_DATABASE_URL))
+    parser.add_argument('--data-dir',
+                        default=os.path.join(ROOT, 'benchmarks', 'data'),
+                        help="where generated CSVs are cached")
+    parser.add_argument('--target',
+                        choices=['in-process', 'gunicorn', 'async', 'both'],
+                        default='in-process',
+                        help="where to send requests; 'both' is in-process "
+                             "and gunicorn (default in-process)")
+    parser.add_argument('--requests', type=int, default=1000,
+                        help="timed requests per run (default 1000)")
+    parser.add_argument('--warmup', type=int, default=100,
+                        help="untimed requests first (default 100)")
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=2,
+                        help="gunicorn workers (default 2)")
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--accept-encoding', default=DEFAULT_ACCEPT_ENCODING,
+                        help="Accept-Encoding to send (default \"br, gzip\"; "
+                             "'' for uncompressed responses)")
+    parser.add_argument('--mix', type=parse_mix, default=MIX,
+                        help="route weights, like homepage=3,add_like=1")
+    parser.add_argument('--results-dir',
+                        default=os.path.join(ROOT, 'benchmarks', 'results'))
+    parser.add_argument('--ajax-capacity', action='store_true',
+                        help="compare how many concurrent AJAX requests one "
+                             "sync and one async worker hold, instead")
+    parser.add_argument('--levels', default=DEFAULT_LEVELS,
+                        help="concurrency levels for --ajax-capacity "
+                             f"(default {DEFAULT_LEVELS})")
+    parser.add_argument('--latency-budget', type=float,
+                        default=DEFAULT_LATENCY_BUDGET,
+                        help="p95 ms a level must stay within to count as "
+                             f"held (default {DEFAULT_LATENCY_BUDGET})")
+    parser.add_argument('--compare', metavar='RESULTS_JSON',
+                        help="an earlier results file to compare against")
+    args = parser.parse_args()
+
+    # app.py reads DATABASE_URL when it's imported
+    os.environ['DATABASE_URL'] = args.database_url
+    from app import app
+
+    commit, dirty = git_commit()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'started': datetime.utcnow().isoformat(),
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split('://')[0],
+        'mix': AJAX_MIX if args.ajax_capacity else args.mix,
+        'accept_encoding': args.accept_encoding,
+        'seed': args.seed,
+        'runs': [],
+    }
+
+    targets = (['in-process', 'gunicorn'] if args.target == 'both'
+               else [args.target])
+    sizes = ([None] if args.skip_seed
+             else [int(n) for n in args.users.split(',')])
+
+    for size in sizes:
+        if size is not None:
+            seed_database(app, generate(size, args.seed, args.data_dir))
+
+        users, messages = dataset_size(app)
+
+        if args.ajax_capacity:
+            results.setdefault('capacity', []).append(dict(
+                users=users, latency_budget=args.latency_budget,
+                held=ajax_capacity(app, args, users, messages, results)))
+            continue
+
+        warmup = plan_requests(args.warmup, args.mix, args.seed - 1,
+                               users, messages)
+        planned = plan_requests(args.requests, args.mix, args.seed,
+                                users, messages)
+        cookies = {user_id: session_cookie(app, user_id)
+                   for _, user_id, *_ in warmup + planned}
+
+        for name in targets:
+            target = make_target(name, app, args, args.workers)
+            try:
+                replay(target, warmup, cookies, args.concurrency)
+                cpu_before = target.cpu_seconds()
+                samples, elapsed = replay(target, planned, cookies,
+                                          args.concurrency)
+                cpu_after = target.cpu_seconds()
+            finally:
+                target.close()
+
+            cpu_seconds = (cpu_after - cpu_before
+                           if cpu_before is not None and cpu_after is not None
+                           else None)
+            run = dict(users=users, messages=messages, target=name,
+                       concurrency=args.concurrency,
+                       **summarize(samples, elapsed, cpu_seconds))
+            results['runs'].append(run)
+            print_run(run)
+
+    print(f"\nsaved {save(results, args.results_dir)}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
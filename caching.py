@@ -0,0 +1,187 @@
+"""HTTP caching.
+
+Static files are linked with a ?v=<content hash> query string (added to every
+url_for('static', ...) automatically); a request carrying the current hash
+is cached for a year as immutable, anything else has to revalidate.
+
+Dynamic pages are private and revalidated on every view. Routes whose output
+is cheap to fingerprint call conditional() with a "stamp" before doing any
+real work: the ETag is a hash of the stamp, the URL, the viewer and the
+templates / static files, and if the browser already has that version it
+gets a 304 straight away, without rendering or hydrating anything.
+
+Stamps come from User.version (bumped by counters.py whenever something a
+user's pages show changes) and the message counters, fetched in a single
+query each by the functions below (or, for follows lists, by the page query
+itself; see connections.py), plus the viewer's own toggles that are still
+buffered, which those versions don't reflect yet (writebehind.py).
+"""
+
+import hashlib
+import os
+import time
+
+from flask import current_app, g, request, session
+from sqlalchemy import select
+
+from models import db, User, Message, Comment
+from writebehind import write_behind
+
+# Cache-Control for static files requested with their current hash
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# ... and for everything else
+REVALIDATE = 'no-cache'
+PRIVATE_REVALIDATE = 'private, no-cache'
+
+# message JSON shows commenters' names and pictures, which aren't in its
+# stamp; it's re-sent at least this often (seconds) so edits to them show
+COMMENTERS_MAX_AGE = 5 * 60
+
+users = User.__table__
+messages = Message.__table__
+comments = Comment.__table__
+
+# filename -> (mtime, hash)
+_static_versions = {}
+_release = None
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()[:12]
+
+
+def static_version(filename):
+    """Short content hash of a file in the static folder (None if missing)."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+
+    cached = _static_versions.get(filename)
+    if cached is None or cached[0] != mtime:
+        cached = _static_versions[filename] = (mtime, file_hash(path))
+
+    return cached[1]
+
+
+def release():
+    """Hash of every template and static file: it changes when a deploy
+    could change how a page renders, which invalidates all ETags."""
+
+    global _release
+
+    if _release is None or current_app.debug:
+        digest = hashlib.md5()
+        for folder in (current_app.template_folder, current_app.static_folder):
+            folder = os.path.join(current_app.root_path, folder)
+            for root, dirs, files in os.walk(folder):
+                # (static/dist is built from the other files; see assets.py)
+                dirs[:] = sorted(name for name in dirs if name != 'dist')
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    digest.update(path[len(folder):].encode('UTF-8'))
+                    digest.update(file_hash(path).encode('UTF-8'))
+        _release = digest.hexdigest()[:12]
+
+    return _release
+
+
+def init_caching(app):
+    """Install the static URL hashing and the caching policy on `app`."""
+
+    app.url_defaults(add_static_version)
+    app.after_request(add_cache_headers)
+
+
+def add_static_version(endpoint, values):
+    """url_defaults: static URLs carry their content hash."""
+
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = static_version(values['filename'])
+        if version:
+            values['v'] = version
+
+
+def conditional(*stamp):
+    """ETag this response from `stamp`; a 304 response if the client's
+    copy is current, else None (and the route carries on).
+
+    Pages with pending flashed messages are never served as 304, since the
+    flashes have to be rendered (and so consumed).
+    """
+
+    if '_flashes' in session:
+        return None
+
+    viewer_id = g.user.id if g.user else None
+    key = repr((release(), request.endpoint, request.full_path,
+                request.accept_mimetypes.best, viewer_id, stamp,
+                write_behind.stamp(viewer_id) if viewer_id else None))
+    g.etag = hashlib.md5(key.encode('UTF-8')).hexdigest()
+
+    if request.if_none_match.contains_weak(g.etag):
+        return current_app.response_class(status=304)
+
+    return None
+
+
+def add_cache_headers(response):
+    """after_request: the caching policy for every response."""
+
+    if request.endpoint == 'static':
+        filename = (request.view_args or {}).get('filename')
+        current = (filename
+                   and request.args.get('v') == static_version(filename))
+        response.headers['Cache-Control'] = (IMMUTABLE if current
+                                             else REVALIDATE)
+        return response
+
+    etag = g.get('etag')
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag, weak=True)
+        response.vary.update(('Cookie', 'Accept'))
+
+    response.headers.setdefault('Cache-Control', PRIVATE_REVALIDATE)
+    return response
+
+
+##############################################################################
+# Stamps
+
+
+def user_versions(*user_ids):
+    """{user id: version} for the users that exist."""
+
+    ids = [user_id for user_id in user_ids if user_id is not None]
+    rows = db.session.execute(select([users.c.id, users.c.version])
+                              .where(users.c.id.in_(ids)))
+    return dict(rows.fetchall())
+
+
+def message_stamp(message_id):
+    """What a message's JSON depends on, or None if there's no message.
+
+    Comments can't be edited, so the count and the newest comment (one
+    probe of ix_comments_message_id) cover them. Commenters' names and
+    pictures aren't covered: they show within COMMENTERS_MAX_AGE.
+    """
+
+    newest = (select([comments.c.id])
+              .where(comments.c.message_id == messages.c.id)
+              .order_by(comments.c.timestamp.desc(), comments.c.id.desc())
+              .limit(1)
+              .as_scalar())
+
+    query = (select([messages.c.comments_count, users.c.version, newest])
+             .select_from(messages.join(users,
+                                        users.c.id == messages.c.user_id))
+             .where(messages.c.id == message_id))
+    row = db.session.execute(query).first()
+    if row is None:
+        return None
+
+    return tuple(row) + (int(time.time() // COMMENTERS_MAX_AGE),)
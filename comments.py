@@ -0,0 +1,56 @@
+"""Comment threads for the comment modal, a page at a time.
+
+A thread is read newest first with a keyset cursor (see pagination.py), with
+each comment's author joined into the same query. Pages are sent compactly:
+comments carry only their author's id, and each author's name and picture
+are sent once per page in a separate `users` map.
+"""
+
+from models import db, User, Comment
+from pagination import paginate
+from fastjson import timestamp_json
+from images import img_url
+
+COMMENTS_PAGE_SIZE = 20
+
+
+def comment_page(message_id, cursor=None, per_page=COMMENTS_PAGE_SIZE):
+    """A Page of `message_id`'s comments (rows with their author's name and
+    picture), newest first, after `cursor`."""
+
+    query = (db.session
+             .query(Comment.id,
+                    Comment.text,
+                    Comment.timestamp,
+                    Comment.user_id,
+                    User.username,
+                    User.image_url)
+             .join(User, User.id == Comment.user_id)
+             .filter(Comment.message_id == message_id))
+
+    return paginate(query, Comment.timestamp, Comment.id, cursor, per_page)
+
+
+def serialize_comment_page(page):
+    """{comments, users, next_cursor} for a comment_page()."""
+
+    users = {}
+    comments = []
+
+    for row in page.items:
+        comments.append({
+            'id': row.id,
+            'text': row.text,
+            'timestamp': timestamp_json(row.timestamp),
+            'user_id': row.user_id,
+        })
+        users[row.user_id] = {
+            'username': row.username,
+            'image_url': img_url(row.image_url, 'badge'),
+        }
+
+    return {
+        'comments': comments,
+        'users': users,
+        'next_cursor': page.next_cursor,
+    }
@@ -0,0 +1,150 @@
+"""Response compression.
+
+HTML and JSON responses (and the other COMPRESSED_TYPES) of at least
+COMPRESS_MIN_SIZE bytes are compressed for clients that accept it: with
+brotli if the client prefers or accepts it, otherwise gzip.
+
+HTML pages that echo a query parameter back (the search pages show 'q')
+are sent uncompressed: pages carry CSRF tokens, and the compressed size of
+a page with both would let an attacker who can make the browser send
+requests guess a token a character at a time (BREACH). See UNCOMPRESSED_ARGS.
+
+Streamed pages (see streaming.py) are compressed as they're sent, with the
+compressor flushed after each piece, so they still arrive a piece at a time.
+Their size isn't known up front, so they're always compressed.
+
+Files served with direct_passthrough (static files) are left alone.
+"""
+
+import zlib
+
+import brotli
+from flask import request
+
+COMPRESS_MIN_SIZE = 1024
+
+COMPRESSED_TYPES = {
+    'text/html',
+    'text/plain',
+    'text/css',
+    'application/json',
+    'application/javascript',
+}
+
+# query parameters that HTML pages show back to the user
+UNCOMPRESSED_ARGS = {'q'}
+
+# fast settings: these are compressed on every request
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+class GzipCompressor:
+    """gzip, a piece at a time."""
+
+    def __init__(self):
+        # (31 window bits: a gzip header and trailer around the deflate data)
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    """brotli, a piece at a time."""
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+COMPRESSORS = {'gzip': GzipCompressor, 'br': BrotliCompressor}
+
+
+def init_compression(app):
+    """Compress `app`'s responses. Register it after the other
+    after_request functions, so it runs first (they run in reverse)."""
+
+    app.after_request(compress_response)
+
+
+def choose_encoding(accept_encodings):
+    """The best encoding of ours in an Accept-Encoding header, or None."""
+
+    # ties go to the first, and brotli's smaller
+    return accept_encodings.best_match(['br', 'gzip'])
+
+
+def compress(data, encoding):
+    """`data` compressed in one go."""
+
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.finish()
+
+
+def _compress_stream(body, encoding, charset):
+    compressor = COMPRESSORS[encoding]()
+
+    try:
+        for piece in body:
+            if isinstance(piece, str):
+                piece = piece.encode(charset)
+
+            data = compressor.compress(piece) + compressor.flush()
+            if data:
+                yield data
+
+        yield compressor.finish()
+
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def compress_response(response):
+    """after_request: compress the response, if it's worth it."""
+
+    if (response.status_code < 200
+            or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSED_TYPES):
+        return response
+
+    if (response.mimetype == 'text/html'
+            and not UNCOMPRESSED_ARGS.isdisjoint(request.args)):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding,
+                                             response.charset)
+        response.headers.pop('Content-Length', None)
+
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,107 @@
+"""Follower / following / mutual-follower lists, a page at a time.
+
+A page is one query over `follows`, keyset-paged by the listed users' ids,
+that also works out for each listed user whether the viewer follows them
+("you follow") and whether they follow the viewer ("follows you"). The
+mutual-followers list is the followers list filtered on "follows you": people
+who follow both the profile's owner and the viewer.
+
+The page query only returns ids, versions and flags, which is enough for an
+ETag (see caching.py); the User rows are loaded afterwards if the page has to
+be rendered.
+"""
+
+from sqlalchemy import select, and_, exists
+
+from models import db, User, FollowersFollowee
+from pagination import PAGE_SIZE
+from writebehind import write_behind, FOLLOW
+
+FOLLOWERS = 'followers'
+FOLLOWING = 'following'
+MUTUAL = 'mutual'
+
+users = User.__table__
+follows = FollowersFollowee.__table__
+
+
+class Connection:
+    """A user on a follows list, with their relationship to the viewer."""
+
+    def __init__(self, user, you_follow, follows_you):
+        self.user = user
+        self.you_follow = you_follow
+        self.follows_you = follows_you
+
+    def __repr__(self):
+        return (f"<Connection #{self.user.id}: you follow {self.you_follow}, "
+                f"follows you {self.follows_you}>")
+
+
+class ConnectionPage:
+    """One page of a follows list: (id, version, you follow, follows you)
+    rows, and the id to page on from, if there's more."""
+
+    def __init__(self, rows, next_after):
+        self.rows = rows
+        self.next_after = next_after
+
+    @property
+    def stamp(self):
+        return tuple(self.rows)
+
+
+def _follows(follower_id, followee_id):
+    # (in `follows`, followee_id is the follower; see models.py)
+    edge = follows.alias()
+    return exists().where(and_(edge.c.followee_id == follower_id,
+                               edge.c.follower_id == followee_id))
+
+
+def connection_page(kind, user_id, viewer_id, after=0, per_page=PAGE_SIZE):
+    """The ConnectionPage of `user_id`'s `kind` list after the id `after`."""
+
+    # (in `follows`, followee_id is the follower; see models.py)
+    if kind == FOLLOWING:
+        listed, owner = follows.c.follower_id, follows.c.followee_id
+    else:
+        listed, owner = follows.c.followee_id, follows.c.follower_id
+
+    you_follow = _follows(viewer_id, users.c.id)
+    follows_you = _follows(users.c.id, viewer_id)
+
+    conditions = [owner == user_id, users.c.id > after]
+    if kind == MUTUAL:
+        conditions.append(follows_you)
+
+    query = (select([users.c.id,
+                     users.c.version,
+                     you_follow.label('you_follow'),
+                     follows_you.label('follows_you')])
+             .select_from(follows.join(users, users.c.id == listed))
+             .where(and_(*conditions))
+             .order_by(users.c.id)
+             .limit(per_page + 1))
+
+    rows = [(id, version, bool(you), bool(them))
+            for id, version, you, them in db.session.execute(query)]
+
+    # follows this worker hasn't written yet (see writebehind.py)
+    buffered = write_behind.overlay(FOLLOW, viewer_id,
+                                    [row[0] for row in rows])
+    rows = [(id, version, buffered.get(id, you), them)
+            for id, version, you, them in rows]
+
+    next_after = rows[per_page - 1][0] if len(rows) > per_page else None
+    return ConnectionPage(rows[:per_page], next_after)
+
+
+def load_connections(page):
+    """The page's Connections, with their User rows, in one query."""
+
+    ids = [row[0] for row in page.rows]
+    found = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+
+    return [Connection(found[id], you_follow, follows_you)
+            for id, _, you_follow, follows_you in page.rows
+            if id in found]
@@ -0,0 +1,225 @@
+"""Denormalized counters on User and Message.
+
+The user stats (messages, followers, following, likes) and per-message like /
+comment counts are stored on the rows themselves, so pages can show them
+without loading the relationships. Every write that changes one of them calls
+a function here in the same transaction; the updates are `col = col + n`
+statements, so concurrent requests can't lose increments.
+
+Changing a user's counters also bumps their `version` (see caching.py), as
+does anything else that changes what their profile shows.
+
+reconcile_counters() recounts everything from scratch and fixes any drift.
+"""
+
+from collections import Counter
+
+from sqlalchemy import select, func, and_, or_, bindparam
+
+from models import db, User, Message, Like, Comment, FollowersFollowee
+
+users = User.__table__
+messages = Message.__table__
+likes = Like.__table__
+comments = Comment.__table__
+follows = FollowersFollowee.__table__
+
+
+def _add(table, where, **deltas):
+    """Add `deltas` to counter columns on the rows of `table` matching
+    `where`."""
+
+    values = {table.c[name]: table.c[name] + delta
+              for name, delta in deltas.items()}
+
+    if table is users:
+        values[users.c.version] = users.c.version + 1
+
+    db.session.execute(table.update().where(where).values(values))
+
+
+def _author_of(message_id):
+    return (select([messages.c.user_id])
+            .where(messages.c.id == message_id)
+            .as_scalar())
+
+
+def user_changed(user_id):
+    """Something shown on `user_id`'s pages changed; bump their version."""
+
+    _add(users, users.c.id == user_id)
+
+
+def message_posted(user_id, delta=1):
+    """`user_id` posted (or with delta=-1, lost) a message."""
+
+    _add(users, users.c.id == user_id, messages_count=delta)
+
+
+def _add_each(table, name, deltas):
+    """Add deltas[row id] to column `name`, for many rows in one
+    executemany."""
+
+    params = [{'row_id': row_id, 'delta': delta}
+              for row_id, delta in deltas.items() if delta]
+    if not params:
+        return
+
+    values = {table.c[name]: table.c[name] + bindparam('delta')}
+    if table is users:
+        values[users.c.version] = users.c.version + 1
+
+    db.session.execute(table.update()
+                       .where(table.c.id == bindparam('row_id'))
+                       .values(values),
+                       params)
+
+
+def likes_changed(changes):
+    """Likes were added / removed: {(user_id, message_id): +1 or -1}."""
+
+    if not changes:
+        return
+
+    by_user = Counter()
+    by_message = Counter()
+    for (user_id, message_id), delta in changes.items():
+        by_user[user_id] += delta
+        by_message[message_id] += delta
+
+    _add_each(users, 'likes_count', by_user)
+    _add_each(messages, 'likes_count', by_message)
+
+    # the authors' profiles show the like counts
+    authors = select([messages.c.user_id]).where(
+        messages.c.id.in_(list(by_message)))
+    _add(users, users.c.id.in_(authors))
+
+
+def follows_changed(changes):
+    """Follows were added / removed: {(user_id, followee_id): +1 or -1}."""
+
+    if not changes:
+        return
+
+    following = Counter()
+    followers = Counter()
+    for (user_id, followee_id), delta in changes.items():
+        following[user_id] += delta
+        followers[followee_id] += delta
+
+    _add_each(users, 'following_count', following)
+    _add_each(users, 'followers_count', followers)
+
+
+def message_commented(message_id, delta=1):
+    """Someone commented on `message_id`."""
+
+    _add(messages, messages.c.id == message_id, comments_count=delta)
+    _add(users, users.c.id == _author_of(message_id))
+
+
+def message_deleted(msg):
+    """Update counters for a message that's about to be deleted."""
+
+    message_posted(msg.user_id, -1)
+
+    likers = select([likes.c.user_id]).where(likes.c.message_id == msg.id)
+    _add(users, users.c.id.in_(likers), likes_count=-1)
+
+
+def user_deleted(user_id):
+    """Update other rows' counters for a user that's about to be deleted."""
+
+    # (in `follows`, followee_id is the follower; see models.py)
+    followees = select([follows.c.follower_id]).where(
+        follows.c.followee_id == user_id)
+    _add(users, users.c.id.in_(followees), followers_count=-1)
+
+    followers = select([follows.c.followee_id]).where(
+        follows.c.follower_id == user_id)
+    _add(users, users.c.id.in_(followers), following_count=-1)
+
+    liked = select([likes.c.message_id]).where(likes.c.user_id == user_id)
+    _add(messages, messages.c.id.in_(liked), likes_count=-1)
+    liked_authors = select([messages.c.user_id]).where(
+        messages.c.id.in_(liked))
+    _add(users, and_(users.c.id.in_(liked_authors), users.c.id != user_id))
+
+    # other people's likes of this user's messages
+    likes_of_theirs = (select([func.count()])
+                       .select_from(likes.join(
+                           messages, messages.c.id == likes.c.message_id))
+                       .where(and_(likes.c.user_id == users.c.id,
+                                   messages.c.user_id == user_id))
+                       .as_scalar())
+    likers = (select([likes.c.user_id])
+              .select_from(likes.join(
+                  messages, messages.c.id == likes.c.message_id))
+              .where(messages.c.user_id == user_id))
+    db.session.execute(users.update()
+                       .where(and_(users.c.id.in_(likers),
+                                   users.c.id != user_id))
+                       .values(likes_count=(users.c.likes_count
+                                            - likes_of_theirs),
+                               version=users.c.version + 1))
+
+    # this user's comments on other people's messages
+    their_comments = (select([func.count()])
+                      .where(and_(comments.c.message_id == messages.c.id,
+                                  comments.c.user_id == user_id))
+                      .as_scalar())
+    commented = select([comments.c.message_id]).where(
+        comments.c.user_id == user_id)
+    commented_authors = select([messages.c.user_id]).where(
+        messages.c.id.in_(commented))
+    _add(users, and_(users.c.id.in_(commented_authors),
+                     users.c.id != user_id))
+    db.session.execute(messages.update()
+                       .where(and_(messages.c.id.in_(commented),
+                                   messages.c.user_id != user_id))
+                       .values(comments_count=(messages.c.comments_count
+                                               - their_comments)))
+
+
+def _count(table, column, match):
+    """Correlated count(*) of `table` rows where `column` == `match`."""
+
+    return (select([func.count()])
+            .select_from(table)
+            .where(column == match)
+            .as_scalar())
+
+
+def reconcile_counters():
+    """Recount every counter, fixing any that have drifted.
+
+    Returns (number of users fixed, number of messages fixed).
+    """
+
+    user_counts = {
+        'messages_count': _count(messages, messages.c.user_id, users.c.id),
+        'followers_count': _count(follows, follows.c.follower_id, users.c.id),
+        'following_count': _count(follows, follows.c.followee_id, users.c.id),
+        'likes_count': _count(likes, likes.c.user_id, users.c.id),
+    }
+
+    message_counts = {
+        'likes_count': _count(likes, likes.c.message_id, messages.c.id),
+        'comments_count': _count(comments, comments.c.message_id,
+                                 messages.c.id),
+    }
+
+    fixed_users = db.session.execute(
+        users.update()
+        .where(or_(*[users.c[name] != count
+                     for name, count in user_counts.items()]))
+        .values(dict(user_counts, version=users.c.version + 1)))
+
+    fixed_messages = db.session.execute(
+        messages.update()
+        .where(or_(*[messages.c[name] != count
+                     for name, count in message_counts.items()]))
+        .values(message_counts))
+
+    return fixed_users.rowcount, fixed_messages.rowcount
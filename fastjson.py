@@ -0,0 +1,56 @@
+"""Fast, compact JSON for the AJAX endpoints.
+
+jsonify() goes through Flask's JSONEncoder, which writes datetimes as HTTP
+dates ("Thu, 18 Oct 2018 12:00:00 GMT") by way of a Python callback, and
+escapes anything non-ASCII. json_response() instead encodes with orjson
+(several times faster), without whitespace, as UTF-8, and with datetimes as
+compact ISO 8601 to the second ("2018-10-18T12:00:00"; they're UTC).
+
+JSONEncoder writes datetimes the same way, for anything that still goes
+through jsonify().
+"""
+
+from datetime import datetime
+
+import orjson
+from flask import current_app
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+
+def timestamp_json(timestamp):
+    """Timestamps as compact ISO 8601, to the second."""
+
+    return timestamp.isoformat(timespec='seconds')
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return timestamp_json(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+
+    raise TypeError(f"{type(obj).__name__} isn't JSON serializable")
+
+
+def dumps(obj):
+    """`obj` as compact UTF-8 JSON bytes."""
+
+    return orjson.dumps(obj, default=_default,
+                        option=(orjson.OPT_OMIT_MICROSECONDS
+                                | orjson.OPT_NON_STR_KEYS))
+
+
+def json_response(obj, status=200):
+    """A JSON response of `obj` (jsonify(), but faster and smaller)."""
+
+    return current_app.response_class(dumps(obj), status=status,
+                                      mimetype='application/json')
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    """Flask's JSON encoder, with compact ISO 8601 timestamps."""
+
+    def default(self, o):
+        if isinstance(o, datetime):
+            return timestamp_json(o)
+        return super().default(o)
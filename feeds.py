@@ -0,0 +1,164 @@
+"""Batched hydration of feed pages.
+
+Rendering a message in _messages.html needs its author, like and comment
+counts, whether the viewer liked it and a few liker avatars. Loading those
+through the ORM relationships costs several queries per message; hydrate()
+loads them for a whole page in a fixed number of queries instead. (The counts
+are denormalized onto the message row; see counters.py. Like counts include
+this worker's likes that haven't been written yet, as the liked flags do;
+see writebehind.py.)
+
+Pages that are streamed (see streaming.py) use a FeedStream, which does the
+same a chunk of messages at a time as the page is rendered.
+"""
+
+from collections import defaultdict
+
+from sqlalchemy import select, func
+from sqlalchemy.orm import joinedload
+
+from models import db, User, Message, Like
+from pagination import PAGE_SIZE, encode_cursor
+from viewer import load_viewer
+from writebehind import write_behind, LIKE
+
+# most liker avatars shown under a message
+LIKER_BADGES = 10
+
+# messages read and hydrated at a time by a FeedStream
+STREAM_CHUNK = PAGE_SIZE
+
+
+class FeedItem:
+    """A message with everything _messages.html shows about it."""
+
+    def __init__(self, message, liked=False, likers=()):
+        self.message = message
+        self.id = message.id
+        self.text = message.text
+        self.timestamp = message.timestamp
+        self.user_id = message.user_id
+        self.user = message.user
+        self.like_count = (message.likes_count
+                           + write_behind.pending_delta(LIKE, message.id))
+        self.comment_count = message.comments_count
+        self.liked = liked
+        self.likers = list(likers)
+
+        # last of a FeedStream's chunk: send the page so far after this one
+        self.flush_after = False
+
+    def __repr__(self):
+        return f"<FeedItem #{self.id}: {self.like_count} likes>"
+
+
+class Liker:
+    """Just enough of a user to draw their badge."""
+
+    def __init__(self, id, image_url):
+        self.id = id
+        self.image_url = image_url
+
+
+def feed_query():
+    """Message query with authors joined in, for building feeds."""
+
+    return Message.query.options(joinedload(Message.user))
+
+
+def _likers(ids):
+    """{message_id: [Liker, ...]}, at most LIKER_BADGES per message."""
+
+    ranked = (select([Like.message_id,
+                      Like.user_id,
+                      func.row_number().over(
+                          partition_by=Like.message_id,
+                          order_by=Like.user_id).label('rank')])
+              .where(Like.message_id.in_(ids))
+              .alias('ranked_likes'))
+
+    rows = db.session.execute(
+        select([ranked.c.message_id, User.id, User.image_url])
+        .select_from(ranked.join(User, User.id == ranked.c.user_id))
+        .where(ranked.c.rank <= LIKER_BADGES)
+        .order_by(ranked.c.message_id, ranked.c.rank))
+
+    likers = defaultdict(list)
+    for message_id, user_id, image_url in rows:
+        likers[message_id].append(Liker(user_id, image_url))
+
+    return likers
+
+
+def hydrate(messages, viewer=None):
+    """Turn a page of messages into FeedItems.
+
+    Messages should come from feed_query() so their authors are already
+    loaded, and `viewer` is the page's ViewerState (see viewer.py); liker
+    avatars are fetched here in one query.
+    """
+
+    ids = [msg.id for msg in messages]
+
+    if not ids:
+        return []
+
+    likers = _likers(ids)
+
+    return [FeedItem(msg,
+                     liked=viewer is not None and viewer.has_liked(msg),
+                     likers=likers.get(msg.id, ()))
+            for msg in messages]
+
+
+class FeedStream:
+    """A page of a feed that's read and hydrated while it's rendered.
+
+    Iterating it runs `query` (newest first, with one extra row to tell
+    whether there's a following page, unless `has_more` says) on a
+    server-side cursor, and yields FeedItems hydrated STREAM_CHUNK at a time,
+    so only one chunk's messages are held at once. The last item of each
+    chunk is marked flush_after. next_cursor is set once it's been iterated.
+    """
+
+    def __init__(self, query, viewer_id=None, has_more=None,
+                 per_page=PAGE_SIZE, chunk=STREAM_CHUNK):
+        self.query = query
+        self.viewer_id = viewer_id
+        self.has_more = has_more
+        self.per_page = per_page
+        self.chunk = chunk
+        self.next_cursor = None
+
+    def __iter__(self):
+        chunk = []
+        last = None
+        count = 0
+        has_more = bool(self.has_more)
+
+        for msg in self.query.yield_per(self.chunk):
+            if count == self.per_page:
+                # the extra row
+                has_more = True
+                continue
+
+            chunk.append(msg)
+            last = msg
+            count += 1
+
+            if len(chunk) == self.chunk:
+                yield from self._hydrate(chunk)
+                chunk = []
+
+        if chunk:
+            yield from self._hydrate(chunk)
+
+        if has_more and last is not None:
+            self.next_cursor = encode_cursor(last.timestamp, last.id)
+
+    def _hydrate(self, messages):
+        viewer = load_viewer(self.viewer_id,
+                             message_ids=[msg.id for msg in messages])
+        items = hydrate(messages, viewer)
+        items[-1].flush_after = True
+        return items
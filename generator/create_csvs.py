@@ -2,76 +2,279 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows -- e.g. for load testing:
+
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 2000000 --processes 8 \
+        --out /data/big
+
+It needs no network access, and the same --seed always gives the same files.
+Popularity and activity follow power laws: most users post, follow and get
+followed a little, and a few do so a lot. Users are split into contiguous
+shards written by separate processes, then stitched together in order.
+
+Ids aren't written; seed.py (loader.py) numbers rows by line, so user N is
+line N of users.csv and messages are numbered in the order written here.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import shutil
+import sys
+from array import array
+from bisect import bisect
+from itertools import accumulate
+from multiprocessing import Pool
+from random import Random
+
+from helpers import (get_random_datetime, get_random_text, power_law,
+                     FIRST_NAMES, WORDS, DOMAINS, CITIES, IMAGE_URLS,
+                     HEADER_IMAGE_URLS)
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio',
+                     'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['followee_id', 'follower_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
+COMMENTS_CSV_HEADERS = ['text', 'timestamp', 'user_id', 'message_id']
+
+HEADERS = {
+    'users': USERS_CSV_HEADERS,
+    'messages': MESSAGES_CSV_HEADERS,
+    'follows': FOLLOWS_CSV_HEADERS,
+    'likes': LIKES_CSV_HEADERS,
+    'comments': COMMENTS_CSV_HEADERS,
+}
 
 NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
-
-fake = Faker()
-
-# Generate random profile image URLs to use for users
-
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
-
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
-
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followee, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(followee_id=followee, follower_id=follower))
+
+# averages per user
+MESSAGES_PER_USER = 3.3
+FOLLOWS_PER_USER = 16.7
+LIKES_PER_USER = 5
+COMMENTS_PER_USER = 1
+
+# bcrypt hash of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# each worker's copy of the Plan (see _init_plan)
+PLAN = None
+
+
+def rng_for(seed, kind, user_id):
+    """Random stream for one user and one kind of data."""
+
+    return Random(f"{seed}:{kind}:{user_id}")
+
+
+class Plan:
+    """Per-user numbers every shard needs to agree on.
+
+    - cumulative popularity, so anyone can pick a user to follow / like in
+      proportion to how popular they are
+    - how many messages each user writes, and so which message ids are theirs
+    """
+
+    def __init__(self, args):
+        self.args = args
+        n = args.users
+
+        popularity = (
+            rng_for(args.seed, 'popularity', user_id).paretovariate(1.2)
+            for user_id in range(1, n + 1))
+        self.cumulative_popularity = array('d', accumulate(popularity))
+
+        self.message_counts = array('l', (
+            power_law(rng_for(args.seed, 'activity', user_id),
+                      args.messages_per_user,
+                      alpha=1.8)
+            for user_id in range(1, n + 1)))
+
+        # message ids of user N are
+        # first_message[N - 1] + 1 ... first_message[N]
+        self.first_message = array('q', [0])
+        self.first_message.extend(accumulate(self.message_counts))
+
+    @property
+    def total_messages(self):
+        return self.first_message[-1]
+
+    def popular_user(self, rng):
+        """Pick a user id, weighted by popularity."""
+
+        total = self.cumulative_popularity[-1]
+        return bisect(self.cumulative_popularity, rng.random() * total) + 1
+
+    def popular_message(self, rng, attempts=10):
+        """Pick a message id by a popular author, or None if we can't."""
+
+        for _ in range(attempts):
+            author = self.popular_user(rng)
+            count = self.message_counts[author - 1]
+            if count:
+                return (self.first_message[author - 1]
+                        + rng.randrange(count) + 1)
+
+        return None
+
+
+def user_row(rng, user_id):
+    first = rng.choice(FIRST_NAMES)
+
+    return dict(
+        email=f"{first}{user_id}@{rng.choice(DOMAINS)}",
+        username=f"{first}{rng.choice(WORDS)}{user_id}",
+        image_url=rng.choice(IMAGE_URLS),
+        password=PASSWORD,
+        bio=get_random_text(rng, 60),
+        header_image_url=rng.choice(HEADER_IMAGE_URLS),
+        location=rng.choice(CITIES),
+    )
+
+
+def distinct(pick, count, exclude=None):
+    """Up to `count` distinct non-None values from calling `pick()`."""
+
+    found = set()
+
+    for _ in range(count * 3):
+        if len(found) == count:
+            break
+
+        value = pick()
+        if value is not None and value != exclude:
+            found.add(value)
+
+    return sorted(found)
+
+
+def _init_plan(plan):
+    """Pool initializer: hand each worker the parent's Plan. (Passed rather
+    than inherited, so it works under spawn / forkserver too.)"""
+
+    global PLAN
+    PLAN = plan
+
+
+def write_shard(shard):
+    """Write part files for users start..end-1; returns the row counts."""
+
+    index, start, end = shard
+    plan = PLAN
+    args = plan.args
+    n = args.users
+
+    files = {kind: open(part_path(args.out, kind, index), 'w', newline='')
+             for kind in HEADERS}
+    writers = {kind: csv.DictWriter(files[kind], fieldnames=headers)
+               for kind, headers in HEADERS.items()}
+    counts = dict.fromkeys(HEADERS, 0)
+
+    def write(kind, **row):
+        writers[kind].writerow(row)
+        counts[kind] += 1
+
+    for user_id in range(start, end):
+        rng = rng_for(args.seed, 'user', user_id)
+        write('users', **user_row(rng, user_id))
+
+        rng = rng_for(args.seed, 'messages', user_id)
+        for _ in range(plan.message_counts[user_id - 1]):
+            write('messages',
+                  text=get_random_text(rng, MAX_WARBLER_LENGTH),
+                  timestamp=get_random_datetime(rng),
+                  user_id=user_id)
+
+        # in `follows`, followee_id is the user doing the following
+        rng = rng_for(args.seed, 'follows', user_id)
+        count = power_law(rng, args.follows_per_user, cap=n - 1)
+        for followee in distinct(lambda: plan.popular_user(rng), count,
+                                 exclude=user_id):
+            write('follows', followee_id=user_id, follower_id=followee)
+
+        rng = rng_for(args.seed, 'likes', user_id)
+        count = power_law(rng, args.likes_per_user,
+                          cap=plan.total_messages)
+        for message_id in distinct(lambda: plan.popular_message(rng), count):
+            write('likes', user_id=user_id, message_id=message_id)
+
+        rng = rng_for(args.seed, 'comments', user_id)
+        for _ in range(power_law(rng, args.comments_per_user)):
+            message_id = plan.popular_message(rng)
+            if message_id is not None:
+                write('comments',
+                      text=get_random_text(rng, MAX_WARBLER_LENGTH),
+                      timestamp=get_random_datetime(rng),
+                      user_id=user_id,
+                      message_id=message_id)
+
+    for f in files.values():
+        f.close()
+
+    return counts
+
+
+def part_path(out, kind, index):
+    return os.path.join(out, f"{kind}.part{index:04d}.csv")
+
+
+def stitch(out, shards):
+    """Concatenate each kind's part files, in shard order, under one header."""
+
+    for kind, headers in HEADERS.items():
+        with open(os.path.join(out, f"{kind}.csv"), 'w', newline='') as whole:
+            csv.writer(whole).writerow(headers)
+
+            for index, _, _ in shards:
+                path = part_path(out, kind, index)
+                with open(path, newline='') as part:
+                    shutil.copyfileobj(part, whole)
+                os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages-per-user', type=float,
+                        default=MESSAGES_PER_USER)
+    parser.add_argument('--follows-per-user', type=float,
+                        default=FOLLOWS_PER_USER)
+    parser.add_argument('--likes-per-user', type=float,
+                        default=LIKES_PER_USER)
+    parser.add_argument('--comments-per-user', type=float,
+                        default=COMMENTS_PER_USER)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--shard-size', type=int, default=10000,
+                        help="users per unit of work (default 10000)")
+    parser.add_argument('--out', default='generator')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    plan = Plan(args)
+
+    shards = [(index, start, min(start + args.shard_size, args.users + 1))
+              for index, start in enumerate(range(1, args.users + 1,
+                                                  args.shard_size))]
+
+    totals = dict.fromkeys(HEADERS, 0)
+
+    with Pool(args.processes, initializer=_init_plan,
+              initargs=(plan,)) as pool:
+        for done, counts in enumerate(pool.imap(write_shard, shards), 1):
+            for kind, count in counts.items():
+                totals[kind] += count
+            print(f"shard {done}/{len(shards)}: "
+                  + ", ".join(f"{count} {kind}"
+                              for kind, count in totals.items()),
+                  file=sys.stderr, flush=True)
+
+    stitch(args.out, shards)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,117 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything here takes an explicit `random.Random`, so the same seed always
+produces the same data.
+"""
 
+from datetime import datetime, timedelta
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+# a fixed end date (rather than "now") keeps seeded runs reproducible
+END_DATE = datetime(2019, 6, 1)
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+WORDS = """
+    able about above across after again against air all almost alone along
+    already also always among animal answer anyone area arm around art ask
+    away back ball bank base beach bear beat bed before begin behind best
+    better bird black blue board boat body book both box boy bread break
+    bring brother build business call camera car card care carry case cat
+    catch cause center chair chance change child city class clear close
+    coffee cold color come common community computer cook cool corner could
+    country course cover cut dance dark day deal deep dinner dog door dream
+    drink drive early earth east easy eat edge energy enjoy enough evening
+    event every eye face fact fall family far farm fast father feel field
+    fight film find fine fire first fish floor flower fly follow food foot
+    forest forget free fresh friend front fruit fun future game garden glass
+    go gold good green group grow guess hair half hand happy hard head hear
+    heart heat help here high hill history hold home hope horse hot hour
+    house idea island job join just keep key kid kind king kitchen know lake
+    land large last late laugh learn leave letter life light like line list
+    listen little live long look lose loud love low lunch machine make many
+    map market may meet memory middle milk mind minute miss money month moon
+    morning mother mountain move movie music name nature near never new news
+    next nice night noise north note nothing now ocean office old open orange
+    other outside page paint paper park party pass past path people perfect
+    phone picture piece place plan plant play please point pool poor power
+    pretty problem pull push quick quiet race rain read ready real reason red
+    remember rest rich ride right river road rock room round rule run safe
+    sail salt same sand save say school sea season seat second see send set
+    shape share ship shoe shop short show side sign simple sing sister sit
+    sky sleep slow small smile snow soft song soon sound south space speak
+    spring square stand star start station stay step still stone stop story
+    street strong study summer sun sure sweet swim table talk tea team tell
+    thank thing think through time today together tomorrow tonight town train
+    travel tree trip true try turn under until up use valley very visit voice
+    wait walk wall want warm watch water wave way weather week welcome west
+    wheel white wind window winter wish wonder wood word work world write
+    yard year yellow yes young
+""".split()
 
-    return datetime.fromtimestamp(random_timestamp)
+FIRST_NAMES = """
+    alex amy anna ben beth cara chris dana dan eli emma erin finn gina grace
+    hana ian ivy jack jade james jen joe kai kate leo lily luis maya max mia
+    nina noah omar owen pat paul quinn ray rosa ruth sam sara sean tara tom
+    una vic wes will yara zoe
+""".split()
+
+DOMAINS = ["example.com", "example.org", "example.net", "mail.test"]
+
+CITIES = """
+    Ashford Bayview Brookfield Cedarville Clearwater Fairview Franklin
+    Georgetown Greenville Hillcrest Kingston Lakewood Madison Maplewood
+    Midway Milford Newport Oakdale Riverside Salem Springfield Summit
+    Westfield Woodland
+""".split()
+
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+HEADER_IMAGE_URLS = [
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/"
+    f"tumblr_{name}_1280.jpg"
+    for name in [
+        "mopq8fyQwI1st5lhmo1", "mnh0n9pHJW1st5lhmo1", "mp6s7lR1lS1st5lhmo1",
+        "mopqdfx05t1st5lhmo1", "mp6scv2xrZ1st5lhmo1", "mpp6w0dxAm1st5lhmo1",
+        "mo2xijE2nr1st5lhmo1", "mo2x80NkDu1st5lhmo1", "mp6sasSvPZ1st5lhmo1",
+        "mp6s32zb6l1st5lhmo1", "mopqc3ZZcz1st5lhmo1", "mo1h6tGOZf1st5lhmo1",
+    ]
+]
+
+
+def get_random_datetime(rng, year_gap=2, end=END_DATE):
+    """Get a random datetime within the `year_gap` years before `end`."""
+
+    span = timedelta(days=365 * year_gap).total_seconds()
+    return end - timedelta(seconds=rng.uniform(0, span))
+
+
+def get_random_text(rng, max_length):
+    """Get a sentence or few of random words, at most `max_length` long."""
+
+    words = []
+    length = 0
+    target = rng.randint(max_length // 5, max_length)
+
+    while True:
+        word = rng.choice(WORDS)
+        if length + len(word) + 1 > target:
+            break
+        words.append(word)
+        length += len(word) + 1
+
+    text = " ".join(words) or rng.choice(WORDS)
+    return text[0].upper() + text[1:max_length - 1] + "."
+
+
+def power_law(rng, mean, alpha=2.0, cap=None):
+    """A whole number drawn from a Pareto distribution with roughly `mean`.
+
+    Most draws are small and a few are huge, like real follower counts or
+    posting activity.
+    """
+
+    # Pareto(alpha) has mean alpha / (alpha - 1); scale to the mean we want
+    value = round(rng.paretovariate(alpha) * mean * (alpha - 1) / alpha)
+    return min(value, cap) if cap is not None else value
@@ -0,0 +1,379 @@
+"""In-memory index of the follows graph.
+
+Each worker keeps the whole `follows` table in memory in both directions (who
+each user follows, and who follows them) as CSR arrays: a user's neighbours
+are a sorted run of a flat array('i') of user ids, starting at offsets[user
+id]. That's 4 bytes per edge per direction plus 8 per user id, rather than a
+User object (or even a set entry) per edge, and answers
+
+- is_following(): a binary search
+- following_count() / followers_count(): a subtraction
+- following_ids() / followers_ids(): sorted, paged by id like the follows
+  pages (connections.py)
+- common_followers() / followees_following(): a merge of two sorted runs
+- users() / most_followed()
+
+without touching the database. It can be up to REBUILD_INTERVAL seconds out
+of date (see below), so it serves what can stand that: the who-to-follow
+suggestions (recommendations.py) and the "followed by N people you follow"
+line on profiles. The follow buttons and follows pages, which mustn't be,
+ask the database (viewer.py, connections.py), and the profile counts come
+from the counter columns (counters.py), which are exact and already loaded.
+
+The arrays can't be changed in place, so follows / unfollows go into a
+per-user overlay of added and removed ids, which is folded into new arrays
+when the graph is next reloaded (early, once it holds COMPACT_AFTER
+changes).
+
+The graph is loaded in a background thread the first time ready() is called
+(see background.py; until then, callers ask the database or leave out what
+they'd have shown), then kept up to date with this worker's follows /
+unfollows (writebehind.py) and deleted users. Follows written by *other*
+workers are picked up when it's reloaded, every REBUILD_INTERVAL seconds, so
+anything that writes should still check the database (as add_follow does,
+through load_viewer()).
+"""
+
+import logging
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from heapq import merge, nlargest
+from itertools import chain, islice
+
+from sqlalchemy import select
+
+from background import BackgroundIndex
+from models import db, FollowersFollowee
+
+# reload the graph from the database this often (seconds), to pick up
+# follows written by other workers
+REBUILD_INTERVAL = 10 * 60
+
+# reload the graph early (folding the overlay into new arrays) once the
+# overlay holds this many changes
+COMPACT_AFTER = 10000
+
+log = logging.getLogger('warbler.graph')
+
+follows = FollowersFollowee.__table__
+
+
+def intersect(first, second):
+    """The items in both of two increasing iterables, in order."""
+
+    first, second = iter(first), iter(second)
+
+    try:
+        a, b = next(first), next(second)
+        while True:
+            if a < b:
+                a = next(first)
+            elif b < a:
+                b = next(second)
+            else:
+                yield a
+                a, b = next(first), next(second)
+
+    except StopIteration:
+        return
+
+
+class Adjacency:
+    """One direction of the graph: sorted neighbour ids per node in CSR
+    arrays, plus the edges added / removed since they were built."""
+
+    def __init__(self, sources=(), targets=()):
+        self.added = defaultdict(set)
+        self.removed = defaultdict(set)
+        self._build(sources, targets)
+
+    def _build(self, sources, targets):
+        """Build the arrays from parallel sequences of edges (any order)."""
+
+        size = max(sources, default=-1) + 2
+
+        # counting sort by source
+        offsets = array('q', bytes(8 * size))
+        for source in sources:
+            offsets[source + 1] += 1
+        for node in range(1, size):
+            offsets[node] += offsets[node - 1]
+
+        ends = array('q', offsets)
+        neighbours = array('i', bytes(4 * len(targets)))
+        for source, target in zip(sources, targets):
+            neighbours[ends[source]] = target
+            ends[source] += 1
+
+        for node in range(size - 1):
+            start, end = offsets[node], offsets[node + 1]
+            if end - start > 1:
+                neighbours[start:end] = array('i',
+                                              sorted(neighbours[start:end]))
+
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.added.clear()
+        self.removed.clear()
+        self.changes = 0
+
+    def _run(self, node):
+        """(start, end) of `node`'s neighbours in the arrays."""
+
+        if 0 <= node < len(self.offsets) - 1:
+            return self.offsets[node], self.offsets[node + 1]
+        return 0, 0
+
+    def _in_arrays(self, node, target):
+        start, end = self._run(node)
+        i = bisect_left(self.neighbours, target, start, end)
+        return i < end and self.neighbours[i] == target
+
+    def contains(self, node, target):
+        if target in self.added.get(node, ()):
+            return True
+        return (target not in self.removed.get(node, ())
+                and self._in_arrays(node, target))
+
+    def degree(self, node):
+        start, end = self._run(node)
+        return (end - start
+                + len(self.added.get(node, ()))
+                - len(self.removed.get(node, ())))
+
+    def neighbours_of(self, node, after=None):
+        """Iterator over `node`'s neighbours (those > `after`), in order."""
+
+        start, end = self._run(node)
+        if after is not None:
+            start = bisect_right(self.neighbours, after, start, end)
+        found = self.neighbours[start:end]
+
+        removed = self.removed.get(node)
+        if removed:
+            found = (target for target in found if target not in removed)
+
+        added = self.added.get(node)
+        if added:
+            return merge(found, sorted(target for target in added
+                                       if after is None or target > after))
+
+        return iter(found)
+
+    def add(self, node, target):
+        removed = self.removed.get(node)
+        if removed and target in removed:
+            removed.discard(target)
+        elif not self._in_arrays(node, target):
+            self.added[node].add(target)
+        self.changes += 1
+
+    def remove(self, node, target):
+        added = self.added.get(node)
+        if added and target in added:
+            added.discard(target)
+        elif self._in_arrays(node, target):
+            self.removed[node].add(target)
+        self.changes += 1
+
+    def nodes(self):
+        """Ids of the nodes with any neighbours."""
+
+        return [node for node in chain(range(len(self.offsets) - 1),
+                                       (node for node in self.added
+                                        if node >= len(self.offsets) - 1))
+                if self.degree(node)]
+
+    @property
+    def nbytes(self):
+        return (self.offsets.itemsize * len(self.offsets)
+                + self.neighbours.itemsize * len(self.neighbours))
+
+
+class SocialGraph(BackgroundIndex):
+    """This worker's index of the follows graph, loaded lazily (see
+    background.py) and kept up to date. Queries need it loaded (see
+    ready())."""
+
+    def __init__(self):
+        super().__init__('social-graph', REBUILD_INTERVAL)
+        self.following = None
+        self.followers = None
+        self._most_followed = None
+
+        # follows / unfollows, and deleted users, applied while the graph is
+        # being reloaded
+        self.missed = None
+        self.missed_users = None
+
+    @property
+    def loaded(self):
+        return self.following is not None
+
+    def load_failed(self):
+        self.missed = self.missed_users = None
+
+    def rebuild(self):
+        """Load the whole follows graph from the database."""
+
+        started = time.monotonic()
+        users, followees = array('i'), array('i')
+
+        with self.lock:
+            self.missed = {}
+            self.missed_users = set()
+
+        # (in `follows`, followee_id is the follower; see models.py)
+        rows = db.session.execute(
+            select([follows.c.followee_id, follows.c.follower_id])
+            .execution_options(stream_results=True))
+        for user_id, followee_id in rows:
+            users.append(user_id)
+            followees.append(followee_id)
+
+        following = Adjacency(users, followees)
+        followers = Adjacency(followees, users)
+
+        with self.lock:
+            # the load may have started before some of these were committed
+            self.following, self.followers = following, followers
+            self._apply(self.missed)
+            for user_id in self.missed_users:
+                self._remove_user(user_id)
+            self.missed = self.missed_users = None
+
+            self._most_followed = None
+            self.built_at = time.monotonic()
+
+        log.info("loaded %d follows in %.2fs",
+                 len(users), self.built_at - started)
+
+    def follows_changed(self, changes):
+        """Apply {(user id, followee id): +1 / -1} follows / unfollows
+        (after they've been committed)."""
+
+        with self.lock:
+            if self.missed is not None:
+                self.missed.update(changes)
+
+            if self.loaded:
+                self._apply(changes)
+
+    def _apply(self, changes):
+        for (user_id, followee_id), delta in changes.items():
+            if delta > 0:
+                self.following.add(user_id, followee_id)
+                self.followers.add(followee_id, user_id)
+            else:
+                self.following.remove(user_id, followee_id)
+                self.followers.remove(followee_id, user_id)
+
+        if self.following.changes + self.followers.changes > COMPACT_AFTER:
+            # (rather than compacting here, holding the lock for a walk of
+            # the whole graph, have ready() reload it in the background)
+            self.built_at = None
+
+    def remove_user(self, user_id):
+        """Drop a deleted user's follows."""
+
+        with self.lock:
+            if self.missed_users is not None:
+                self.missed_users.add(user_id)
+
+            if self.loaded:
+                self._remove_user(user_id)
+
+    def _remove_user(self, user_id):
+        changes = {(user_id, followee_id): -1
+                   for followee_id in self.following.neighbours_of(user_id)}
+        changes.update({(follower_id, user_id): -1
+                        for follower_id
+                        in self.followers.neighbours_of(user_id)})
+        self._apply(changes)
+
+    def is_following(self, user_id, other_id):
+        """Does `user_id` follow `other_id`?"""
+
+        with self.lock:
+            return self.following.contains(user_id, other_id)
+
+    def following_count(self, user_id):
+        with self.lock:
+            return self.following.degree(user_id)
+
+    def followers_count(self, user_id):
+        with self.lock:
+            return self.followers.degree(user_id)
+
+    def following_ids(self, user_id, after=None, limit=None):
+        """Ids of the people `user_id` follows, in order, after `after`."""
+
+        with self.lock:
+            return list(islice(self.following.neighbours_of(user_id, after),
+                               limit))
+
+    def followers_ids(self, user_id, after=None, limit=None):
+        """Ids of `user_id`'s followers, in order, after `after`."""
+
+        with self.lock:
+            return list(islice(self.followers.neighbours_of(user_id, after),
+                               limit))
+
+    def common_followers(self, user_id, other_id, after=None, limit=None):
+        """Ids of the people following both users, in order, after `after`."""
+
+        with self.lock:
+            return list(islice(
+                intersect(self.followers.neighbours_of(user_id, after),
+                          self.followers.neighbours_of(other_id, after)),
+                limit))
+
+    def followees_following(self, user_id, other_id, limit=None):
+        """Ids of the people `user_id` follows who follow `other_id`, in
+        order."""
+
+        with self.lock:
+            return list(islice(
+                intersect(self.following.neighbours_of(user_id),
+                          self.followers.neighbours_of(other_id)),
+                limit))
+
+    def users(self):
+        """Ids of everyone who follows or is followed by anyone."""
+
+        with self.lock:
+            return sorted(set(self.following.nodes())
+                          | set(self.followers.nodes()))
+
+    def most_followed(self, limit):
+        """The `limit` most-followed user ids, most followed first (worked
+        out once per load of the graph)."""
+
+        with self.lock:
+            if self._most_followed is None or len(self._most_followed) < limit:
+                self._most_followed = nlargest(
+                    limit, self.followers.nodes(),
+                    key=lambda id: (self.followers.degree(id), -id))
+            return self._most_followed[:limit]
+
+    def stats(self):
+        """Size of the graph, for monitoring."""
+
+        with self.lock:
+            if not self.loaded:
+                return {'loaded': 0, 'follows': 0, 'bytes': 0, 'overlay': 0}
+
+            overlay = (sum(map(len, self.following.added.values()))
+                       - sum(map(len, self.following.removed.values())))
+
+            return {
+                'loaded': 1,
+                'follows': len(self.following.neighbours) + overlay,
+                'bytes': self.following.nbytes + self.followers.nbytes,
+                'overlay': self.following.changes + self.followers.changes,
+            }
+
+
+social_graph = SocialGraph()
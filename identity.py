@@ -0,0 +1,159 @@
+"""Cached snapshots of logged-in users.
+
+Loading the current user's row on every request is a database round-trip even
+for AJAX calls that only need their id. Each worker instead keeps a small LRU
+cache of Identity snapshots (id, username, images and counters) that expire
+after IDENTITY_TTL seconds; g.user is a CurrentUser wrapping one, and the full
+User row is only loaded if a route asks for something the snapshot lacks.
+
+Routes that change what's in a snapshot call identity_cache.invalidate().
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from models import User
+
+IDENTITY_CACHE_SIZE = 10000
+
+# seconds a snapshot is trusted for; bounds how stale counters can be when
+# they're changed by another worker
+IDENTITY_TTL = 30
+
+IDENTITY_FIELDS = (
+    'id',
+    'username',
+    'image_url',
+    'header_image_url',
+    'messages_count',
+    'followers_count',
+    'following_count',
+    'likes_count',
+)
+
+
+class Identity:
+    """The bits of a User that most requests need."""
+
+    __slots__ = IDENTITY_FIELDS
+
+    def __init__(self, **fields):
+        for name in IDENTITY_FIELDS:
+            setattr(self, name, fields[name])
+
+    @classmethod
+    def of(cls, user):
+        """Snapshot a User."""
+
+        return cls(**{name: getattr(user, name) for name in IDENTITY_FIELDS})
+
+    def __repr__(self):
+        return f"<Identity #{self.id}: {self.username}>"
+
+
+class IdentityCache:
+    """Per-worker LRU cache of Identity snapshots with a TTL."""
+
+    def __init__(self, size=IDENTITY_CACHE_SIZE, ttl=IDENTITY_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, user_id):
+        """The cached Identity for `user_id`, or None if missing / expired."""
+
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+
+            identity, expires = entry
+            if time.monotonic() > expires:
+                del self.entries[user_id]
+                return None
+
+            self.entries.move_to_end(user_id)
+            return identity
+
+    def put(self, identity):
+        """Cache `identity`, evicting the least recently used if full."""
+
+        with self.lock:
+            self.entries[identity.id] = (identity, time.monotonic() + self.ttl)
+            self.entries.move_to_end(identity.id)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        """Forget these users (their profile or counters changed)."""
+
+        with self.lock:
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+identity_cache = IdentityCache()
+
+
+class CurrentUser:
+    """g.user: an Identity, with the full User row loaded on demand.
+
+    Attributes in IDENTITY_FIELDS come from the snapshot; anything else
+    (email, relationships, ...) is read from the row, which is loaded the
+    first time it's needed.
+    """
+
+    def __init__(self, identity):
+        self._identity = identity
+        self._row = None
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    @property
+    def row(self):
+        """The full User row for this user."""
+
+        if self._row is None:
+            self._row = User.query.get(self._identity.id)
+        return self._row
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        if name in IDENTITY_FIELDS:
+            return getattr(self._identity, name)
+
+        return getattr(self.row, name)
+
+
+def load_current_user(user_id):
+    """A CurrentUser for `user_id`, from the cache if we can; None if no such
+    user."""
+
+    identity = identity_cache.get(user_id)
+
+    if identity is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+
+        identity = Identity.of(user)
+        identity_cache.put(identity)
+
+        current = CurrentUser(identity)
+        current._row = user
+        return current
+
+    return CurrentUser(identity)
@@ -0,0 +1,519 @@
+"""Image proxy for user pictures, with resized copies cached on disk.
+
+User.image_url and header_image_url point anywhere on the web, often at
+full-size photos, and pages show dozens of them at 20-70px. Templates link
+them through the img_url filter instead:
+
+    <img src="{{ user.image_url|img_url('badge') }}">
+
+which points at /images/<variant>/<signature>?url=<original>. The first
+request for it fetches the original (on one of FETCH_THREADS background
+threads) and stores a copy resized to the variant's size with Pillow, and
+every request after that is served from disk and cached by the browser for
+good. A request doesn't wait more than MISS_WAIT seconds for the fetch: past
+that it gets the default picture, uncached, until the copy is stored.
+
+The signature is an HMAC of the variant and URL, so the proxy only fetches
+images the app linked to. Those are still URLs users typed in, so addresses
+on private networks (including redirects to them) are refused, unless
+IMAGE_PROXY_ALLOW_PRIVATE is set. The connection is made to the very address
+that was checked, so a host can't resolve to a public address for the check
+and a private one for the fetch. A fetch gets FETCH_DEADLINE seconds in all.
+
+The disk cache (IMAGE_CACHE_DIR) is kept under IMAGE_CACHE_SIZE bytes by
+deleting the least recently used files. Pictures that can't be fetched are
+replaced by the default ones, and not retried for FAILURE_TTL seconds (up to
+MAX_FAILED of them are remembered).
+"""
+
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from functools import partial
+from urllib.parse import urlsplit
+
+from PIL import Image, ImageOps
+from flask import abort, current_app, redirect, request, send_file, url_for
+
+from caching import IMMUTABLE
+
+# variant -> (width, height, crop to fill?); twice the largest size each
+# is shown at, for high-DPI screens
+VARIANTS = {
+    'badge': (96, 96, True),
+    'avatar': (400, 400, True),
+    'header': (1500, 500, False),
+}
+
+# stand-ins for pictures that can't be fetched
+DEFAULT_IMAGES = {
+    'badge': 'images/default-pic.png',
+    'avatar': 'images/default-pic.png',
+    'header': 'images/warbler-hero.jpg',
+}
+
+IMAGE_CACHE_SIZE = 256 * 1024 * 1024
+
+# originals bigger than this aren't fetched
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+# seconds for each connect / read, and for the whole fetch
+FETCH_TIMEOUT = 5
+FETCH_DEADLINE = 15
+
+# bytes to read at a time
+FETCH_CHUNK = 64 * 1024
+
+# don't retry a failed fetch for this long (seconds)
+FAILURE_TTL = 5 * 60
+
+# most failed fetches to remember
+MAX_FAILED = 10000
+
+# fetches at once, per worker
+FETCH_THREADS = 4
+
+# seconds a request waits for its picture to be fetched
+MISS_WAIT = 2
+
+# bump a cached file's access time at most this often (seconds)
+TOUCH_AFTER = 60 * 60
+
+# evict down to this fraction of IMAGE_CACHE_SIZE
+EVICT_TO = 0.9
+
+JPEG_QUALITY = 85
+
+# leading bytes -> mimetype
+IMAGE_TYPES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'RIFF', 'image/webp'),
+]
+
+log = logging.getLogger('warbler.images')
+
+
+class FetchError(Exception):
+    """The original image couldn't be fetched or read."""
+
+
+def image_type(data):
+    """The mimetype of image `data`, from its first few bytes, or None."""
+
+    for magic, mimetype in IMAGE_TYPES:
+        if data.startswith(magic):
+            if mimetype == 'image/webp' and data[8:12] != b'WEBP':
+                continue
+            return mimetype
+    return None
+
+
+def check_scheme(url):
+    """The parts of `url`; FetchError unless it's http(s)."""
+
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise FetchError(f"not an http(s) URL: {url}")
+    return parts
+
+
+def check_host(url, allow_private=False):
+    """The address to connect to for `url`; FetchError unless `url` is
+    http(s) on a public address. (None if private addresses are allowed:
+    connect however the host resolves.)"""
+
+    parts = check_scheme(url)
+
+    if allow_private:
+        return None
+
+    try:
+        addresses = socket.getaddrinfo(
+            parts.hostname,
+            parts.port or (443 if parts.scheme == 'https' else 80),
+            proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError, ValueError) as e:
+        raise FetchError(f"can't resolve {parts.hostname}: {e}")
+
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if not address.is_global:
+            raise FetchError(f"{parts.hostname} is a private address")
+
+    return addresses[0][4][0]
+
+
+class _Pinned:
+    """An HTTP(S)Connection made to `address`, whatever the host resolves to
+    by now. (The Host header, SNI and certificate check still use the host.)"""
+
+    def __init__(self, *args, address=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if address is not None:
+            self._create_connection = (
+                lambda host_port, *args:
+                socket.create_connection((address, host_port[1]), *args))
+
+
+class _PinnedHTTPConnection(_Pinned, http.client.HTTPConnection):
+    pass
+
+
+class _PinnedHTTPSConnection(_Pinned, http.client.HTTPSConnection):
+    pass
+
+
+class _CheckedHTTPHandler(urllib.request.HTTPHandler):
+    """Connect (to redirects too) only at addresses check_host() allows."""
+
+    def __init__(self, allow_private):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def http_open(self, req):
+        address = check_host(req.full_url, self.allow_private)
+        return self.do_open(partial(_PinnedHTTPConnection, address=address),
+                            req)
+
+
+class _CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+    """Connect (to redirects too) only at addresses check_host() allows."""
+
+    def __init__(self, allow_private):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def https_open(self, req):
+        address = check_host(req.full_url, self.allow_private)
+        return self.do_open(partial(_PinnedHTTPSConnection, address=address),
+                            req, context=self._context)
+
+
+class _CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    """Follow redirects only to http(s) URLs."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_scheme(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch(url, allow_private=False):
+    """The bytes of the image at `url`."""
+
+    deadline = time.monotonic() + FETCH_DEADLINE
+
+    check_scheme(url)
+    opener = urllib.request.build_opener(
+        # (a proxy would connect wherever it liked)
+        urllib.request.ProxyHandler({}),
+        _CheckedHTTPHandler(allow_private),
+        _CheckedHTTPSHandler(allow_private),
+        _CheckedRedirects())
+    req = urllib.request.Request(url, headers={'User-Agent': 'warbler-images'})
+
+    try:
+        with opener.open(req, timeout=FETCH_TIMEOUT) as response:
+            # read1(): whatever has arrived, rather than waiting for a whole
+            # chunk, so a trickle can't outlast the deadline
+            data = bytearray()
+            while len(data) <= MAX_IMAGE_BYTES:
+                if time.monotonic() > deadline:
+                    raise FetchError(f"fetching {url} took too long")
+                chunk = response.read1(FETCH_CHUNK)
+                if not chunk:
+                    break
+                data += chunk
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        raise FetchError(f"fetching {url} failed: {e}")
+
+    data = bytes(data)
+
+    if len(data) > MAX_IMAGE_BYTES:
+        raise FetchError(f"{url} is too big")
+    if image_type(data) is None:
+        raise FetchError(f"{url} isn't an image we know")
+
+    return data
+
+
+def resize(data, variant):
+    """`data` resized for `variant` (as JPEG, or PNG if it's transparent)."""
+
+    width, height, crop = VARIANTS[variant]
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+
+        if crop:
+            image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        else:
+            image.thumbnail((width, height), Image.LANCZOS)
+
+        output = io.BytesIO()
+        if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+            image.save(output, 'PNG', optimize=True)
+        else:
+            image.convert('RGB').save(output, 'JPEG', quality=JPEG_QUALITY,
+                                      optimize=True, progressive=True)
+
+    except Exception as e:
+        # (anything from a truncated file to a decompression bomb)
+        raise FetchError(f"can't resize image: {e}")
+
+    return output.getvalue()
+
+
+class ImageProxy:
+    """The /images/ route and its disk cache."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.evicted = 0
+
+        # cache key -> when to try fetching it again, oldest first
+        self.failed = {}
+
+        # cache key -> Future of its fetch, so concurrent misses fetch once
+        self.fetching = {}
+        self.pool = None
+        self.pid = None
+
+    def init_app(self, app):
+        app.config.setdefault('IMAGE_CACHE_DIR',
+                              os.path.join(app.instance_path, 'images'))
+        app.config.setdefault('IMAGE_CACHE_SIZE', IMAGE_CACHE_SIZE)
+        app.config.setdefault('IMAGE_PROXY_ALLOW_PRIVATE', False)
+
+        app.add_url_rule('/images/<variant>/<signature>', 'image',
+                         self.serve)
+        app.add_template_filter(img_url)
+
+    @property
+    def folder(self):
+        return current_app.config['IMAGE_CACHE_DIR']
+
+    def signature(self, variant, url):
+        key = current_app.config['SECRET_KEY'].encode('UTF-8')
+        message = f'{variant}\0{url}'.encode('UTF-8')
+        return hmac.new(key, message, hashlib.sha256).hexdigest()[:16]
+
+    def path(self, variant, url):
+        key = hashlib.sha256(f'{variant}\0{url}'.encode('UTF-8')).hexdigest()
+        return os.path.join(self.folder, key[:2], key)
+
+    def serve(self, variant, signature):
+        """/images/<variant>/<signature>?url=...: the resized picture."""
+
+        url = request.args.get('url', '')
+        if (variant not in VARIANTS
+                or not hmac.compare_digest(signature,
+                                           self.signature(variant, url))):
+            abort(404)
+
+        path = self.path(variant, url)
+
+        try:
+            self.touch(path)
+            self.hits += 1
+        except FileNotFoundError:
+            self.misses += 1
+            loading = self.load(variant, url, path)
+
+            try:
+                stored = (loading is not None
+                          and loading.result(timeout=MISS_WAIT))
+            except TimeoutError:
+                # the default for now, but the picture next time
+                response = redirect(url_for('static',
+                                            filename=DEFAULT_IMAGES[variant]))
+                response.headers['Cache-Control'] = 'no-store'
+                return response
+
+            if not stored:
+                response = redirect(url_for('static',
+                                            filename=DEFAULT_IMAGES[variant]))
+                response.headers['Cache-Control'] = (
+                    f'public, max-age={FAILURE_TTL}')
+                return response
+
+        with open(path, 'rb') as f:
+            mimetype = image_type(f.read(12))
+
+        response = send_file(path, mimetype=mimetype, conditional=True)
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+    def touch(self, path):
+        """Mark a cached file as used (for the LRU), at most every
+        TOUCH_AFTER seconds."""
+
+        stat = os.stat(path)
+        now = time.time()
+        if now - stat.st_atime > TOUCH_AFTER:
+            os.utime(path, (now, stat.st_mtime))
+
+    def load(self, variant, url, path):
+        """Start fetching, resizing and storing a picture in the background
+        (unless that's already under way); a Future of whether it was
+        stored, or None if it failed lately."""
+
+        with self.lock:
+            if self.failed.get(path, 0) > time.monotonic():
+                return None
+
+            loading = self.fetching.get(path)
+            if loading is None:
+                # (started lazily so each forked worker gets its own)
+                if self.pool is None or self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    self.pool = ThreadPoolExecutor(
+                        FETCH_THREADS, thread_name_prefix='image-fetch')
+
+                loading = self.fetching[path] = self.pool.submit(
+                    self._load_in, current_app._get_current_object(),
+                    variant, url, path)
+
+            return loading
+
+    def _load_in(self, app, variant, url, path):
+        with app.app_context():
+            try:
+                return self._load(variant, url, path)
+            finally:
+                with self.lock:
+                    self.fetching.pop(path, None)
+
+    def _load(self, variant, url, path):
+        # (another worker may have stored it meanwhile)
+        if os.path.exists(path):
+            return True
+
+        try:
+            data = resize(fetch(url, current_app.config[
+                'IMAGE_PROXY_ALLOW_PRIVATE']), variant)
+        except FetchError as e:
+            log.info("%s", e)
+            with self.lock:
+                self.failures += 1
+                self.remember_failure(path)
+            return False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+        with self.lock:
+            self.failed.pop(path, None)
+            self.stored(path, len(data))
+
+        return True
+
+    def remember_failure(self, path):
+        """Don't fetch `path` again for FAILURE_TTL seconds; forget failures
+        that have expired, or are past the newest MAX_FAILED. (Call with the
+        lock held.)"""
+
+        now = time.monotonic()
+
+        # (all expire FAILURE_TTL after they're added, so oldest first)
+        self.failed.pop(path, None)
+        self.failed[path] = now + FAILURE_TTL
+
+        for old, until in list(self.failed.items()):
+            if until > now and len(self.failed) <= MAX_FAILED:
+                break
+            del self.failed[old]
+
+    def _files(self):
+        """[(access time, size, path)] of everything in the cache."""
+
+        files = []
+        for root, dirs, names in os.walk(self.folder):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_atime, stat.st_size, path))
+        return files
+
+    def stored(self, new_path, size):
+        """Account for a newly stored file, evicting the least recently used
+        others if the cache is now too big. (Call with the lock held.)"""
+
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self._files())
+        else:
+            self.size += size
+
+        limit = current_app.config['IMAGE_CACHE_SIZE']
+        if self.size <= limit:
+            return
+
+        # (other workers share the folder, so count it again)
+        files = sorted(self._files())
+        self.size = sum(size for _, size, _ in files)
+
+        for _, size, path in files:
+            if self.size <= limit * EVICT_TO:
+                break
+            if path == new_path:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            self.evicted += 1
+
+    def stats(self):
+        """Cache hits and size, for monitoring."""
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'failures': self.failures,
+            'evicted': self.evicted,
+            'bytes': self.size or 0,
+        }
+
+
+image_proxy = ImageProxy()
+
+
+def img_url(url, variant='badge'):
+    """Template filter: the proxy URL for picture `url` at `variant`'s size.
+
+    Pictures in the static folder are linked directly."""
+
+    if not url:
+        return url
+
+    static = current_app.static_url_path + '/'
+    if url.startswith(static):
+        return url_for('static', filename=url[len(static):])
+
+    return url_for('image', variant=variant,
+                   signature=image_proxy.signature(variant, url), url=url)
@@ -0,0 +1,356 @@
+"""Per-request SQL instrumentation.
+
+SQLAlchemy engine events time every statement a request runs. When the
+request finishes, SQLStats records for its endpoint:
+
+- how many statements it ran, and how long they took in total
+- the slowest one
+- statements repeated REPEATED_STATEMENTS or more times (once literals and
+  parameters are stripped), which usually means an N+1 loop
+
+and writes one JSON log line to the "warbler.sql" logger. The running totals
+are served in Prometheus' text format by the /metrics route. They're per
+worker process, like PasswordHasher.stats().
+
+Routes can declare how many statements they should need with
+@query_budget(n). Going over it is logged as a warning and counted, and
+tests can fail on it with sql_stats.assert_within_budget().
+"""
+
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+
+from flask import (current_app, g, request, has_app_context,
+                   has_request_context)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# a statement run this many times in one request is flagged as repeated
+REPEATED_STATEMENTS = 3
+
+# upper bounds of the statements-per-request histogram
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+# how much of the slowest statement goes in the log line
+LOGGED_STATEMENT_LENGTH = 500
+
+log = logging.getLogger('warbler.sql')
+
+PARAMETERS = re.compile(r"%\(\w+\)s|%s|\?|(?<![:\w]):\w+")
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+LISTS = re.compile(r"\(\?(?:\s*,\s*\?)+\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """`statement` with parameters, literals and IN lists made generic."""
+
+    statement = PARAMETERS.sub('?', statement)
+    statement = LITERALS.sub('?', statement)
+    statement = LISTS.sub('(...)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+
+def query_budget(statements):
+    """Declare the most SQL statements a route should run.
+
+    Goes under @app.route, so the route registers the marked function.
+    """
+
+    def decorator(view):
+        view.query_budget = statements
+        return view
+
+    return decorator
+
+
+class RequestQueries:
+    """The statements run while handling one request."""
+
+    def __init__(self):
+        self.endpoint = None
+        self.budget = None
+        self.statements = 0
+        self.seconds = 0.0
+        self.slowest = (0.0, None)
+        self.fingerprints = Counter()
+
+    def record(self, statement, seconds):
+        self.statements += 1
+        self.seconds += seconds
+        self.fingerprints[fingerprint(statement)] += 1
+
+        if seconds >= self.slowest[0]:
+            self.slowest = (seconds, statement)
+
+    def repeated(self):
+        """[(fingerprint, times run)] for statements run suspiciously often."""
+
+        return [(statement, count)
+                for statement, count in self.fingerprints.most_common()
+                if count >= REPEATED_STATEMENTS]
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.statements > self.budget
+
+    def __repr__(self):
+        return (f"<RequestQueries {self.endpoint}: {self.statements} "
+                f"statements, {self.seconds * 1000:.1f}ms>")
+
+
+class EndpointStats:
+    """Running totals for one endpoint."""
+
+    def __init__(self):
+        self.requests = 0
+        self.statements = 0
+        self.seconds = 0.0
+        self.max_statements = 0
+        self.repeated = 0
+        self.over_budget = 0
+        self.buckets = [0] * len(STATEMENT_BUCKETS)
+
+    def add(self, queries):
+        self.requests += 1
+        self.statements += queries.statements
+        self.seconds += queries.seconds
+        self.max_statements = max(self.max_statements, queries.statements)
+        self.repeated += bool(queries.repeated())
+        self.over_budget += queries.over_budget
+
+        for i, bound in enumerate(STATEMENT_BUCKETS):
+            if queries.statements <= bound:
+                self.buckets[i] += 1
+
+
+class SQLStats:
+    """Hooks SQLAlchemy and Flask together to measure each request's SQL."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.endpoints = {}
+        self.captured = None
+
+    def init_app(self, app):
+        # every engine, so it doesn't matter which one a session is bound to
+        event.listen(Engine, 'before_cursor_execute', self.before_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_execute)
+        event.listen(Engine, 'handle_error', self.execute_failed)
+
+        # call this before registering other before_request functions, so
+        # their statements are counted too
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    @staticmethod
+    def before_execute(conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('sql_stats_started', []).append(
+            time.perf_counter())
+
+    @staticmethod
+    def after_execute(conn, cursor, statement, parameters, context,
+                      executemany):
+        seconds = time.perf_counter() - conn.info['sql_stats_started'].pop()
+
+        if has_request_context():
+            if 'sql_queries' not in g:
+                g.sql_queries = RequestQueries()
+            g.sql_queries.record(statement, seconds)
+
+        elif has_app_context() and 'sql_queries' in g:
+            # (an async handler's work on a thread; see asgi.py)
+            g.sql_queries.record(statement, seconds)
+
+    @staticmethod
+    def execute_failed(exception_context):
+        started = exception_context.connection.info.get('sql_stats_started')
+        if started:
+            started.pop()
+
+    @staticmethod
+    def start_request():
+        # g can outlive a request (e.g. in an app context held by a test)
+        g.sql_queries = RequestQueries()
+
+    def finish_request(self, response):
+        """after_request: add this request to the totals and log it.
+
+        A streamed body (see streaming.py) runs more statements while it's
+        sent, after this; the request is recorded once it's been sent.
+        """
+
+        queries = g.get('sql_queries') or RequestQueries()
+        queries.endpoint = request.endpoint or '(unmatched)'
+
+        view = current_app.view_functions.get(request.endpoint)
+        queries.budget = getattr(view, 'query_budget', None)
+
+        method, status = request.method, response.status_code
+
+        if not response.is_streamed or response.direct_passthrough:
+            self.record(queries, method, status)
+            return response
+
+        recorded = []
+
+        def record():
+            if not recorded:
+                recorded.append(True)
+                self.record(queries, method, status)
+
+        # when it's all been sent, or if it's abandoned
+        response.response = self._then(response.response, record)
+        response.call_on_close(record)
+        return response
+
+    @staticmethod
+    def _then(body, callback):
+        yield from body
+        callback()
+
+    def record(self, queries, method, status):
+        """Add a finished request's RequestQueries to the totals, and log
+        it."""
+
+        with self.lock:
+            stats = self.endpoints.setdefault(queries.endpoint,
+                                              EndpointStats())
+            stats.add(queries)
+
+            if self.captured is not None:
+                self.captured.append(queries)
+
+        self.log(queries, method, status)
+
+    @staticmethod
+    def log(queries, method, status):
+        repeated = queries.repeated()
+        seconds, slowest = queries.slowest
+
+        line = {
+            'endpoint': queries.endpoint,
+            'method': method,
+            'status': status,
+            'statements': queries.statements,
+            'db_ms': round(queries.seconds * 1000, 2),
+            'slowest_ms': round(seconds * 1000, 2),
+            'slowest': slowest and slowest[:LOGGED_STATEMENT_LENGTH],
+            'repeated': [{'statement': statement, 'count': count}
+                         for statement, count in repeated],
+            'budget': queries.budget,
+        }
+
+        level = (logging.WARNING if repeated or queries.over_budget
+                 else logging.INFO)
+        log.log(level, json.dumps(line))
+
+    def clear(self):
+        with self.lock:
+            self.endpoints.clear()
+
+    def prometheus(self, extra=()):
+        """The totals (plus any `extra` gauges) in Prometheus text format.
+
+        `extra` is [(name, help, value)].
+        """
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+
+            lines = []
+
+            def metric(name, kind, help, values):
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in values:
+                    lines.append(f"{name}{labels} {value}")
+
+            def per_endpoint(attribute):
+                return [(f'{{endpoint="{endpoint}"}}',
+                         getattr(stats, attribute))
+                        for endpoint, stats in endpoints]
+
+            metric('warbler_requests_total', 'counter',
+                   "Requests handled, by endpoint.",
+                   per_endpoint('requests'))
+            metric('warbler_sql_statements_total', 'counter',
+                   "SQL statements run, by endpoint.",
+                   per_endpoint('statements'))
+            metric('warbler_sql_seconds_total', 'counter',
+                   "Seconds spent running SQL, by endpoint.",
+                   per_endpoint('seconds'))
+            metric('warbler_sql_statements_max', 'gauge',
+                   "Most SQL statements run by one request, by endpoint.",
+                   per_endpoint('max_statements'))
+            metric('warbler_sql_repeated_requests_total', 'counter',
+                   "Requests that repeated a statement (likely N+1), "
+                   "by endpoint.",
+                   per_endpoint('repeated'))
+            metric('warbler_sql_over_budget_total', 'counter',
+                   "Requests that ran more statements than their route's "
+                   "query budget, by endpoint.",
+                   per_endpoint('over_budget'))
+
+            buckets = []
+            for endpoint, stats in endpoints:
+                for bound, count in zip(STATEMENT_BUCKETS,
+                                        stats.buckets):
+                    buckets.append(
+                        (f'_bucket{{endpoint="{endpoint}",le="{bound}"}}',
+                         count))
+                buckets += [
+                    (f'_bucket{{endpoint="{endpoint}",le="+Inf"}}',
+                     stats.requests),
+                    (f'_sum{{endpoint="{endpoint}"}}', stats.statements),
+                    (f'_count{{endpoint="{endpoint}"}}', stats.requests),
+                ]
+            metric('warbler_sql_statements_per_request', 'histogram',
+                   "SQL statements run per request.", buckets)
+
+        for name, help, value in extra:
+            metric(name, 'gauge', help, [('', value)])
+
+        return '\n'.join(lines) + '\n'
+
+    @contextmanager
+    def assert_within_budget(self, budget=None):
+        """Fail if a request in the block runs too many statements.
+
+        The limit is `budget` if given, otherwise the route's declared
+        query_budget. Yields the list of RequestQueries collected.
+        """
+
+        captured = []
+        with self.lock:
+            self.captured = captured
+
+        try:
+            yield captured
+
+        finally:
+            with self.lock:
+                self.captured = None
+
+        for queries in captured:
+            limit = queries.budget if budget is None else budget
+            if limit is None:
+                raise AssertionError(
+                    f"{queries.endpoint} has no query budget to check")
+
+            if queries.statements > limit:
+                statements = '\n  '.join(
+                    f"{count}x {statement}"
+                    for statement, count in queries.fingerprints.items())
+                raise AssertionError(
+                    f"{queries.endpoint} ran {queries.statements} SQL "
+                    f"statements (budget {limit}):\n  {statements}")
+
+
+sql_stats = SQLStats()
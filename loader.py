@@ -0,0 +1,345 @@
+"""Streaming bulk loader for the seed CSVs.
+
+seed.py used to read each CSV whole and insert it through the ORM in a single
+transaction. bulk_load() streams each file instead, CHUNK_ROWS rows at a time:
+
+- On Postgres each chunk goes in with COPY; elsewhere with the driver's
+  executemany.
+- Each chunk commits together with a row in `bulk_load_progress`, so a load
+  that dies can be resumed from the last committed chunk (resume=True).
+- On Postgres, secondary indexes, unique and foreign key constraints are
+  dropped before loading and re-created afterwards (much faster than
+  maintaining them row by row). Their definitions are saved in the database
+  first, so a resumed load still restores them.
+- Rows without an `id` column in the CSV get their line number as id, so
+  re-trying a chunk can't shift the ids other files refer to.
+- A CSV whose header names a column its table doesn't have is rejected
+  before anything is loaded (the names go into the SQL).
+
+Afterwards the counters and home timelines are rebuilt.
+"""
+
+import csv
+import io
+import os
+import sys
+import time
+
+from sqlalchemy import MetaData, Table, Column, Integer, BigInteger, Text
+
+import migrate
+from models import db
+from counters import reconcile_counters
+from timeline import rebuild_timelines
+
+CHUNK_ROWS = 10000
+
+# CSVs are loaded in this order (so foreign keys point at loaded rows); any
+# that don't exist are skipped
+LOAD_ORDER = ['users', 'messages', 'follows', 'likes', 'comments']
+
+# the loader's own bookkeeping, kept out of db.metadata so create_all() /
+# drop_all() leave it alone
+bookkeeping = MetaData()
+
+progress = Table(
+    'bulk_load_progress', bookkeeping,
+    Column('source', Text, primary_key=True),
+    Column('rows_loaded', BigInteger, nullable=False),
+)
+
+deferred = Table(
+    'bulk_load_deferred', bookkeeping,
+    Column('position', Integer, primary_key=True),
+    Column('drop_sql', Text, nullable=False),
+    Column('create_sql', Text, nullable=False),
+)
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def is_postgres(engine):
+    return engine.dialect.name == 'postgresql'
+
+
+##############################################################################
+# Deferring indexes and constraints (Postgres only)
+
+DEFERRABLE_CONSTRAINTS_SQL = """
+    SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid),
+           contype
+      FROM pg_constraint
+     WHERE conrelid::regclass::text = ANY(%(tables)s)
+       AND contype IN ('u', 'f')
+"""
+
+DEFERRABLE_INDEXES_SQL = """
+    SELECT indexname, indexdef
+      FROM pg_indexes
+     WHERE schemaname = current_schema()
+       AND tablename = ANY(%(tables)s)
+       AND indexname NOT IN (SELECT conname FROM pg_constraint)
+"""
+
+
+def find_deferrable(conn, tables):
+    """[(drop_sql, create_sql)] for secondary indexes and constraints.
+
+    Ordered so that running the create statements in order works: indexes and
+    unique constraints before the foreign keys that might need them.
+    """
+
+    cursor = conn.connection.cursor()
+
+    cursor.execute(DEFERRABLE_INDEXES_SQL, {'tables': tables})
+    statements = [(f'DROP INDEX "{name}"', definition)
+                  for name, definition in cursor.fetchall()]
+
+    cursor.execute(DEFERRABLE_CONSTRAINTS_SQL, {'tables': tables})
+    constraints = sorted(cursor.fetchall(), key=lambda row: row[3] == 'f')
+
+    for table, name, definition, _ in constraints:
+        statements.append(
+            (f'ALTER TABLE {table} DROP CONSTRAINT "{name}"',
+             f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'))
+
+    return statements
+
+
+def drop_deferrable(engine, tables):
+    """Save, then drop, the indexes / constraints we'll re-create later."""
+
+    with engine.begin() as conn:
+        statements = find_deferrable(conn, tables)
+
+        conn.execute(deferred.insert(), [
+            {'position': i, 'drop_sql': drop, 'create_sql': create}
+            for i, (drop, create) in enumerate(statements)])
+
+        # drop foreign keys first, since they may depend on the others
+        for drop, _ in reversed(statements):
+            conn.execute(drop)
+
+    log(f"deferred {len(statements)} indexes / constraints")
+
+
+def restore_deferrable(engine):
+    """Re-create everything drop_deferrable() dropped."""
+
+    with engine.begin() as conn:
+        rows = conn.execute(deferred.select().order_by(deferred.c.position))
+
+        for row in rows.fetchall():
+            start = time.perf_counter()
+            conn.execute(row.create_sql)
+            log(f"  {row.create_sql} ({time.perf_counter() - start:.1f}s)")
+
+        conn.execute(deferred.delete())
+
+
+##############################################################################
+# Loading
+
+
+def read_chunks(path, skip, chunk_rows):
+    """Yield (columns, first line number, rows) chunks of a CSV.
+
+    The first `skip` data rows are skipped (they were loaded already).
+    """
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+
+        for _ in range(skip):
+            next(reader)
+
+        line = skip + 1
+        chunk = []
+
+        for row in reader:
+            chunk.append(row)
+
+            if len(chunk) == chunk_rows:
+                yield columns, line, chunk
+                line += len(chunk)
+                chunk = []
+
+        if chunk:
+            yield columns, line, chunk
+
+
+def check_columns(table, columns, source):
+    """Raise ValueError unless `columns` are all columns of `table`."""
+
+    unknown = [name for name in columns if name not in table.c]
+    if unknown:
+        raise ValueError(f"{source}: {table.name} has no column(s) "
+                         f"{', '.join(map(repr, unknown))}")
+    if len(set(columns)) != len(columns):
+        raise ValueError(f"{source}: repeated column in {columns!r}")
+
+
+def read_header(path):
+    with open(path, newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def with_ids(table, columns, first_line, rows):
+    """Add line-number ids to rows of tables that need them."""
+
+    if 'id' not in table.c or 'id' in columns:
+        return columns, rows
+
+    return (['id'] + columns,
+            [[str(first_line + i)] + row for i, row in enumerate(rows)])
+
+
+def copy_rows(conn, table, columns, rows):
+    """Postgres: send rows with COPY ... FROM STDIN."""
+
+    check_columns(table, columns, table.name)
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    column_list = ', '.join(columns)
+    conn.connection.cursor().copy_expert(
+        f"COPY {table.name} ({column_list}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
+
+
+PLACEHOLDERS = {
+    'qmark': lambda i, name: '?',
+    'format': lambda i, name: '%s',
+    'pyformat': lambda i, name: '%s',
+    'numeric': lambda i, name: f':{i + 1}',
+    'named': lambda i, name: f':{name}',
+}
+
+
+def executemany_rows(conn, table, columns, rows):
+    """Anything else: a plain DB-API executemany of the raw strings."""
+
+    check_columns(table, columns, table.name)
+
+    paramstyle = conn.dialect.paramstyle
+    placeholders = ', '.join(PLACEHOLDERS[paramstyle](i, name)
+                             for i, name in enumerate(columns))
+    sql = (f"INSERT INTO {table.name} ({', '.join(columns)}) "
+           f"VALUES ({placeholders})")
+
+    # empty fields mean NULL, as they do for COPY
+    def nullify(value):
+        return None if value == '' else value
+
+    if paramstyle == 'named':
+        params = [{name: nullify(value) for name, value in zip(columns, row)}
+                  for row in rows]
+    else:
+        params = [[nullify(value) for value in row] for row in rows]
+
+    conn.connection.cursor().executemany(sql, params)
+
+
+def load_file(engine, table, path, chunk_rows):
+    """Stream one CSV into `table`, resuming after any committed chunks."""
+
+    source = os.path.basename(path)
+    write_rows = copy_rows if is_postgres(engine) else executemany_rows
+
+    with engine.connect() as conn:
+        done = conn.execute(progress.select()
+                            .where(progress.c.source == source)).first()
+
+    loaded = done.rows_loaded if done else 0
+    if loaded:
+        log(f"{source}: resuming after {loaded} rows")
+
+    start = time.perf_counter()
+    started_at = loaded
+
+    for columns, first_line, rows in read_chunks(path, loaded, chunk_rows):
+        columns, rows = with_ids(table, columns, first_line, rows)
+
+        with engine.begin() as conn:
+            write_rows(conn, table, columns, rows)
+
+            loaded += len(rows)
+            conn.execute(progress.delete()
+                         .where(progress.c.source == source))
+            conn.execute(progress.insert().values(source=source,
+                                                  rows_loaded=loaded))
+
+        elapsed = time.perf_counter() - start
+        rate = (loaded - started_at) / elapsed if elapsed else 0
+        log(f"{source}: {loaded} rows ({rate:,.0f} rows/sec)")
+
+    return loaded - started_at
+
+
+def reset_sequences(engine, tables):
+    """Postgres: move id sequences past the ids we loaded explicitly."""
+
+    with engine.begin() as conn:
+        for table in tables:
+            if 'id' in table.c:
+                conn.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', "
+                    f"'id'), COALESCE((SELECT max(id) FROM {table.name}), 0) "
+                    f"+ 1, false)")
+
+
+def bulk_load(directory, resume=False, chunk_rows=CHUNK_ROWS):
+    """Load <table>.csv files from `directory` into a (fresh) database.
+
+    Unless `resume`, all tables are dropped and re-created first.
+    """
+
+    engine = db.engine
+    tables = [db.metadata.tables[name] for name in LOAD_ORDER
+              if os.path.exists(os.path.join(directory, f"{name}.csv"))]
+
+    for table in tables:
+        source = f"{table.name}.csv"
+        check_columns(table, read_header(os.path.join(directory, source)),
+                      source)
+
+    if not resume:
+        db.drop_all()
+        bookkeeping.drop_all(bind=engine)
+        db.create_all()
+        bookkeeping.create_all(bind=engine)
+        migrate.stamp(engine)
+
+        if is_postgres(engine):
+            drop_deferrable(engine, [table.name for table in tables])
+
+    start = time.perf_counter()
+    total = 0
+
+    for table in tables:
+        path = os.path.join(directory, f"{table.name}.csv")
+        total += load_file(engine, table, path, chunk_rows)
+
+    elapsed = time.perf_counter() - start
+    log(f"loaded {total} rows in {elapsed:.1f}s "
+        f"({total / elapsed if elapsed else 0:,.0f} rows/sec)")
+
+    if is_postgres(engine):
+        reset_sequences(engine, tables)
+        restore_deferrable(engine)
+
+    log("rebuilding counters and timelines")
+    reconcile_counters()
+    rebuild_timelines()
+    db.session.commit()
+
+    if is_postgres(engine):
+        with engine.connect() as conn:
+            conn.execute("ANALYZE")
+
+    bookkeeping.drop_all(bind=engine)
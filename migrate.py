@@ -0,0 +1,238 @@
+"""Versioned schema migrations.
+
+Each file in migrations/ is named <version>_<name>.py and defines
+upgrade(conn), which makes its schema change on a connection, plus
+optionally
+
+- backfill(): fills in data afterwards, through db.session (committed by
+  the runner, and run after all the pending schema changes), and
+- TRANSACTIONAL = False, to run upgrade() outside a transaction (which
+  CREATE INDEX CONCURRENTLY needs).
+
+`flask migrate` applies the ones whose version isn't yet recorded in the
+`schema_version` table, in order; `flask schema-version` lists them. A new
+database gets the whole schema from db.create_all() and is recorded as up to
+date, and a database that predates migrations (it has tables but no
+`schema_version`) gets all of them. Migrations check what's already there
+(see the helpers below), since those were created by create_all() at
+whatever point the models were at.
+
+models.py stays the description of the current schema: a migration changing
+the schema changes the models to match.
+"""
+
+import importlib.util
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy import (MetaData, Table, Column, Integer, Text, DateTime,
+                        inspect, select, text)
+
+from models import db
+
+MIGRATIONS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'migrations')
+
+# (Postgres) advisory lock held while migrating, so two deploys can't both
+LOCK_ID = 0x77617262
+
+# kept out of db.metadata so create_all() / drop_all() leave it alone
+versions = MetaData()
+
+schema_version = Table(
+    'schema_version', versions,
+    Column('version', Integer, primary_key=True),
+    Column('name', Text, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+class Migration:
+    """One file in migrations/."""
+
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+        self._module = None
+
+    @property
+    def module(self):
+        if self._module is None:
+            spec = importlib.util.spec_from_file_location(
+                f'migrations.{self.version:04d}_{self.name}', self.path)
+            self._module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(self._module)
+        return self._module
+
+    @property
+    def transactional(self):
+        return getattr(self.module, 'TRANSACTIONAL', True)
+
+    def __repr__(self):
+        return f"<Migration {self.version:04d} {self.name}>"
+
+
+def discover(folder=MIGRATIONS_FOLDER):
+    """Every migration in `folder`, in order."""
+
+    found = []
+    for filename in os.listdir(folder):
+        match = re.match(r'^(\d+)_(\w+)\.py$', filename)
+        if match:
+            found.append(Migration(int(match.group(1)), match.group(2),
+                                   os.path.join(folder, filename)))
+
+    found.sort(key=lambda migration: migration.version)
+    return found
+
+
+def is_postgres(conn):
+    return conn.dialect.name == 'postgresql'
+
+
+def applied_versions(engine):
+    """Versions recorded as applied (None if there's no schema_version)."""
+
+    if not engine.has_table('schema_version'):
+        return None
+
+    with engine.connect() as conn:
+        rows = conn.execute(select([schema_version.c.version]))
+        return {row[0] for row in rows}
+
+
+def _record(conn, migration):
+    conn.execute(schema_version.insert().values(version=migration.version,
+                                                name=migration.name,
+                                                applied_at=datetime.utcnow()))
+
+
+def stamp(engine, migrations=None):
+    """Record `migrations` (default: all) as applied, without running them."""
+
+    versions.create_all(bind=engine)
+    done = applied_versions(engine)
+
+    with engine.begin() as conn:
+        for migration in migrations or discover():
+            if migration.version not in done:
+                _record(conn, migration)
+
+
+def pending(engine):
+    """The migrations not yet applied, in order."""
+
+    done = applied_versions(engine) or set()
+    return [migration for migration in discover()
+            if migration.version not in done]
+
+
+def _upgrade_schema(engine, migration):
+    if migration.transactional:
+        with engine.begin() as conn:
+            migration.module.upgrade(conn)
+    else:
+        with engine.connect() as conn:
+            migration.module.upgrade(
+                conn.execution_options(isolation_level='AUTOCOMMIT'))
+
+
+def apply(engine, migrations, log=print):
+    """Run `migrations` and record them.
+
+    Backfills use the app's current code, which may need columns from any
+    of them, so they run once every schema change has been made. A
+    migration is recorded once its backfill is done; until then, it's run
+    again next time (which the helpers below make safe).
+    """
+
+    for migration in migrations:
+        log(f"applying {migration.version:04d} {migration.name}")
+        _upgrade_schema(engine, migration)
+
+    for migration in migrations:
+        backfill = getattr(migration.module, 'backfill', None)
+        if backfill:
+            log(f"backfilling {migration.version:04d} {migration.name}")
+            backfill()
+            db.session.commit()
+
+        with engine.begin() as conn:
+            _record(conn, migration)
+
+
+def upgrade(engine=None, log=print):
+    """Bring the database up to date. Returns the migrations applied."""
+
+    engine = engine or db.engine
+
+    with engine.connect() as lock:
+        if is_postgres(lock):
+            lock.execute(text('SELECT pg_advisory_lock(:id)'), id=LOCK_ID)
+
+        try:
+            if applied_versions(engine) is None:
+                if not engine.has_table('users'):
+                    log("new database: creating the schema")
+                    db.metadata.create_all(bind=engine)
+                    stamp(engine)
+                    return []
+
+                log("database predates migrations: applying them all")
+                versions.create_all(bind=engine)
+
+            todo = pending(engine)
+            apply(engine, todo, log)
+            return todo
+
+        finally:
+            if is_postgres(lock):
+                lock.execute(text('SELECT pg_advisory_unlock(:id)'),
+                             id=LOCK_ID)
+
+
+##############################################################################
+# Helpers for migrations
+
+
+def add_column(conn, table, name, definition):
+    """ALTER TABLE `table` ADD COLUMN `name` `definition`, unless it's
+    there."""
+
+    if name in {column['name'] for column in inspect(conn).get_columns(table)}:
+        return
+    conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
+
+def create_table(conn, name, definition):
+    """CREATE TABLE `name` (`definition`), unless it's there."""
+
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {name} ({definition})')
+
+
+def create_index(conn, name, table, columns):
+    """Index `table` on `columns`, unless there's an index called `name`.
+
+    On Postgres it's built CONCURRENTLY (without blocking writes), so the
+    migration must not be TRANSACTIONAL; an invalid index left by a build
+    that failed part way is dropped and built again.
+    """
+
+    column_list = ', '.join(columns)
+
+    if not is_postgres(conn):
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({column_list})')
+        return
+
+    invalid = conn.execute(text(
+        "SELECT 1 FROM pg_index "
+        "WHERE indexrelid = to_regclass(:name) AND NOT indisvalid"),
+        name=name).scalar()
+    if invalid:
+        conn.execute(f'DROP INDEX CONCURRENTLY {name}')
+
+    conn.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                 f'ON {table} ({column_list})')
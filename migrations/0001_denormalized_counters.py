@@ -0,0 +1,20 @@
+"""Denormalized like / comment / follow counters (see counters.py)."""
+
+from migrate import add_column
+from counters import reconcile_counters
+
+COUNTERS = {
+    'users': ['messages_count', 'followers_count', 'following_count',
+              'likes_count'],
+    'messages': ['likes_count', 'comments_count'],
+}
+
+
+def upgrade(conn):
+    for table, columns in COUNTERS.items():
+        for column in columns:
+            add_column(conn, table, column, "INTEGER NOT NULL DEFAULT 0")
+
+
+def backfill():
+    reconcile_counters()
@@ -0,0 +1,17 @@
+"""Materialized home timelines (see timeline.py)."""
+
+from migrate import create_table
+from timeline import rebuild_timelines
+
+
+def upgrade(conn):
+    create_table(conn, 'timeline_entries', """
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+        timestamp TIMESTAMP NOT NULL,
+        PRIMARY KEY (user_id, message_id)
+    """)
+
+
+def backfill():
+    rebuild_timelines()
@@ -0,0 +1,7 @@
+"""users.version, which HTTP validators are derived from (see caching.py)."""
+
+from migrate import add_column
+
+
+def upgrade(conn):
+    add_column(conn, 'users', 'version', "INTEGER NOT NULL DEFAULT 0")
@@ -0,0 +1,13 @@
+"""Precomputed who-to-follow suggestions (see recommendations.py)."""
+
+from migrate import create_table
+
+
+def upgrade(conn):
+    create_table(conn, 'suggested_follows', """
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        suggested_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        score DOUBLE PRECISION NOT NULL,
+        via INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, suggested_id)
+    """)
@@ -0,0 +1,31 @@
+"""Indexes for the feeds, counts, liker badges, comment threads and cascades.
+
+- messages (user_id, timestamp, id): profile feeds, read newest first by
+  keyset, and the celebrity messages merged into home timelines
+- timeline_entries (user_id, timestamp, message_id): home timelines
+- likes (message_id, user_id): liker badges, like counts, deleting messages
+- comments (message_id, timestamp, id): comment threads, deleting messages
+- follows (follower_id, followee_id): followers lists and fan-out (the
+  primary key only covers the other direction)
+
+Built CONCURRENTLY on Postgres, so they don't block writes while they build.
+"""
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+INDEXES = [
+    ('ix_messages_user_id_timestamp', 'messages',
+     ['user_id', 'timestamp', 'id']),
+    ('ix_timeline_entries_user_id_timestamp', 'timeline_entries',
+     ['user_id', 'timestamp', 'message_id']),
+    ('ix_likes_message_id', 'likes', ['message_id', 'user_id']),
+    ('ix_comments_message_id', 'comments', ['message_id', 'timestamp', 'id']),
+    ('ix_follows_follower_id', 'follows', ['follower_id', 'followee_id']),
+]
+
+
+def upgrade(conn):
+    for name, table, columns in INDEXES:
+        create_index(conn, name, table, columns)
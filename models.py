@@ -2,19 +2,30 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
 from flask import jsonify
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hasher
+from replicas import RoutingSQLAlchemy
+
+# (reads can go to a replica; see replicas.py)
+db = RoutingSQLAlchemy()
 
 
 class FollowersFollowee(db.Model):
-    """Connection of a follower <-> followee."""
+    """Connection of a follower <-> followee.
+
+    Note the column names are historical: `followee_id` holds the user doing
+    the following and `follower_id` holds the user being followed (see the
+    `User.followers` / `User.following` relationships below).
+    """
 
     __tablename__ = 'follows'
 
+    # (the primary key already covers lookups by followee_id)
+    __table_args__ = (
+        db.Index('ix_follows_follower_id', 'follower_id', 'followee_id'),
+    )
+
     followee_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -33,6 +44,10 @@ class Like(db.Model):
 
     __tablename__ = 'likes'
 
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id', 'user_id'),
+    )
+
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id'),
@@ -46,6 +61,65 @@ class Like(db.Model):
     )
 
 
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # copied from the message so timelines can be ordered without a join
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class SuggestedFollow(db.Model):
+    """A precomputed who-to-follow suggestion (see recommendations.py)."""
+
+    __tablename__ = 'suggested_follows'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # how many of the people `user_id` follows follow `suggested_id`
+    via = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
 class User(db.Model):
     """User in the system."""
 
@@ -91,6 +165,44 @@ class User(db.Model):
         nullable=False,
     )
 
+    # denormalized counters, kept up to date by counters.py
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # bumped whenever something shown on this user's pages (or to them, as
+    # the viewer) changes; HTTP validators are derived from it (caching.py)
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship(
         'Message',
         backref='user',
@@ -122,14 +234,14 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        follow = FollowersFollowee.query.get((other_user.id, self.id))
+        return follow is not None
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        follow = FollowersFollowee.query.get((self.id, other_user.id))
+        return follow is not None
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -138,7 +250,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -159,13 +271,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the user's hash was made with an old work factor, it's replaced
+        with a new one (the caller commits).
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
@@ -176,6 +293,11 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 'user_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -189,7 +311,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -198,6 +320,21 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # denormalized counters, kept up to date by counters.py
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    comments_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     likes = db.relationship(
         'Like',
         backref='message',
@@ -211,8 +348,7 @@ class Message(db.Model):
     )
 
     def is_liked_by(self, user_id):
-        user_like = [like for like in self.likes if like.user_id == user_id]
-        return len(user_like) > 0
+        return Like.query.get((user_id, self.id)) is not None
 
     def __repr__(self):
         return f"<id: {self.id}\ntext: {self.text}\nuser_id: {self.user_id}>"
@@ -232,6 +368,10 @@ class Comment(db.Model):
 
     __tablename__ = 'comments'
 
+    __table_args__ = (
+        db.Index('ix_comments_message_id', 'message_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -245,7 +385,7 @@ class Comment(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
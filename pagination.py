@@ -0,0 +1,90 @@
+"""Keyset (cursor) pagination for Warbler feeds.
+
+Feeds are ordered newest-first on (timestamp, id). A page ends with a cursor
+naming its last row; the next page is everything strictly older than that, so
+page N costs the same as page 1 (no OFFSET) and ties on timestamp are broken
+by id.
+"""
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+PAGE_SIZE = 20
+
+CURSOR_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+class Page:
+    """One page of a feed: its items and the cursor for the next one."""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+
+def encode_cursor(timestamp, id):
+    """Make an opaque cursor token for the row at (timestamp, id)."""
+
+    raw = f"{timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}|{id}"
+    return urlsafe_b64encode(raw.encode('UTF-8')).decode('ascii')
+
+
+def decode_cursor(token):
+    """Turn a cursor token back into (timestamp, id).
+
+    Returns None for an empty token; raises ValueError for a bad one.
+    """
+
+    if not token:
+        return None
+
+    try:
+        raw = urlsafe_b64decode(token.encode('ascii')).decode('UTF-8')
+        timestamp, id = raw.split('|')
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(id)
+
+    except (UnicodeError, ValueError, TypeError) as e:
+        raise ValueError(f"bad cursor: {token!r}") from e
+
+
+def older_than(timestamp_col, id_col, cursor):
+    """SQL condition for rows after `cursor` in newest-first order."""
+
+    timestamp, id = cursor
+
+    return or_(timestamp_col < timestamp,
+               and_(timestamp_col == timestamp, id_col < id))
+
+
+def page_query(query, timestamp_col, id_col, cursor=None, per_page=PAGE_SIZE):
+    """`query` cut down to the page after `cursor`, newest first, plus one
+    more row if there's a following page."""
+
+    if cursor:
+        query = query.filter(older_than(timestamp_col, id_col, cursor))
+
+    return (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1))
+
+
+def paginate(query, timestamp_col, id_col, cursor=None, per_page=PAGE_SIZE):
+    """Return a Page of `query`, newest first, starting after `cursor`."""
+
+    rows = page_query(query, timestamp_col, id_col, cursor, per_page).all()
+
+    return page_of(rows[:per_page], has_more=len(rows) > per_page)
+
+
+def page_of(messages, has_more):
+    """Wrap a list of messages as a Page, with a cursor if there's more."""
+
+    next_cursor = None
+
+    if has_more and messages:
+        last = messages[-1]
+        next_cursor = encode_cursor(last.timestamp, last.id)
+
+    return Page(messages, next_cursor)
@@ -0,0 +1,251 @@
+"""Password hashing in a process pool, bounded across the machine.
+
+bcrypt is deliberately slow, and hashing inline ties up the request worker
+(and a whole CPU) for the duration. PasswordHasher runs hashes in a small
+per-worker process pool instead. Every hash also takes one of
+PASSWORD_HASH_SLOTS slots, shared by all the workers on the machine (they're
+flock()ed files in PASSWORD_HASH_LOCK_DIR), so N gunicorn workers can't run
+N pools' worth of hashes at once. Hashes that can't get a slot, or an answer,
+within HASH_TIMEOUT seconds raise HasherBusy, as do hashes past the
+per-worker MAX_QUEUED, rather than letting a login burst queue up forever.
+
+The work factor comes from the BCRYPT_LOG_ROUNDS config value. Hashes made
+with a different cost are re-made on the next successful login (see
+User.authenticate).
+"""
+
+import fcntl
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import Lock
+
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+
+# processes in each worker's pool
+WORKERS = 1
+
+# most hashes running at once, across every worker on the machine
+SLOTS = os.cpu_count() or 1
+
+# where the slots' lock files live
+LOCK_DIR = os.path.join(tempfile.gettempdir(), 'warbler-password-slots')
+
+# most hashes waiting for (or running in) the pool at once, per worker
+MAX_QUEUED = 32
+
+# seconds to wait for a hash before giving up
+HASH_TIMEOUT = 10
+
+# seconds between tries for a slot
+SLOT_POLL = 0.01
+
+COST_RE = re.compile(r"^\$2[abxy]?\$(\d\d)\$")
+
+
+class HasherBusy(Exception):
+    """Too many passwords are already waiting to be hashed."""
+
+
+class Slots:
+    """Up to `count` holders at once, across every process on the machine.
+
+    Slot i is an flock() on `directory`/i, so it's let go of when its file is
+    closed (or its process dies).
+    """
+
+    def __init__(self, count, directory):
+        self.count = count
+        self.directory = directory
+
+    def acquire(self, deadline):
+        """A held slot's file descriptor; HasherBusy if none frees up by
+        `deadline` (a time.monotonic() value)."""
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        while True:
+            for i in range(self.count):
+                fd = os.open(os.path.join(self.directory, str(i)),
+                             os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    os.close(fd)
+
+            if time.monotonic() + SLOT_POLL >= deadline:
+                raise HasherBusy()
+
+            time.sleep(SLOT_POLL)
+
+    def release(self, fd):
+        os.close(fd)
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password, hashed)
+
+
+def _in_slot(slots, deadline, fn, *args):
+    """`fn(*args)`, run within one of `slots`.
+
+    (Slots are taken in the process doing the hashing, so that pool processes
+    forked meanwhile don't inherit, and hold on to, the parent's.)
+    """
+
+    if time.monotonic() >= deadline:
+        # (whoever wanted this has stopped waiting)
+        raise HasherBusy()
+
+    slot = slots.acquire(deadline)
+    try:
+        return fn(*args)
+    finally:
+        slots.release(slot)
+
+
+def hash_cost(hashed):
+    """The bcrypt cost (log rounds) a hash was made with, or None."""
+
+    match = COST_RE.match(hashed or "")
+    return int(match.group(1)) if match else None
+
+
+class PasswordHasher:
+    """Hashes and checks passwords, off the request worker if it can.
+
+    With workers=0 everything runs inline (handy for tests and scripts),
+    though still within a slot.
+    """
+
+    def __init__(self, rounds=DEFAULT_ROUNDS, workers=WORKERS, slots=SLOTS,
+                 lock_dir=LOCK_DIR, max_queued=MAX_QUEUED):
+        self.rounds = rounds
+        self.workers = workers
+        self.slots = Slots(slots, lock_dir)
+        self.max_queued = max_queued
+        self.pool = None
+        self.lock = Lock()
+        self.queued = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def init_app(self, app):
+        """Pick up BCRYPT_LOG_ROUNDS / PASSWORD_HASH_WORKERS /
+        PASSWORD_HASH_SLOTS / PASSWORD_HASH_LOCK_DIR from `app`."""
+
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.workers = app.config.setdefault('PASSWORD_HASH_WORKERS',
+                                             self.workers)
+        self.slots = Slots(
+            app.config.setdefault('PASSWORD_HASH_SLOTS', self.slots.count),
+            app.config.setdefault('PASSWORD_HASH_LOCK_DIR',
+                                  self.slots.directory))
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` in the pool, within a slot, and wait (up to
+        HASH_TIMEOUT) for the answer."""
+
+        deadline = time.monotonic() + HASH_TIMEOUT
+
+        with self.lock:
+            if self.queued >= self.max_queued:
+                self.rejected += 1
+                raise HasherBusy()
+
+            if self.workers and self.pool is None:
+                # started lazily so each (forked) worker gets its own
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+
+        if not self.workers:
+            ok = False
+            try:
+                result = _in_slot(self.slots, deadline, fn, *args)
+                ok = True
+                return result
+            except HasherBusy:
+                with self.lock:
+                    self.rejected += 1
+                raise
+            finally:
+                self._finished(ok)
+
+        try:
+            future = self.pool.submit(_in_slot, self.slots, deadline,
+                                      fn, *args)
+        except BaseException:
+            self._finished(ok=False)
+            raise
+
+        # the queue place is held until the hash really finishes, even if we
+        # stop waiting for it
+        future.add_done_callback(
+            lambda future: self._finished(ok=not future.cancelled()
+                                          and future.exception() is None))
+
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except (TimeoutError, HasherBusy):
+            with self.lock:
+                self.rejected += 1
+            raise HasherBusy()
+
+    def _finished(self, ok):
+        with self.lock:
+            self.queued -= 1
+            if ok:
+                self.completed += 1
+
+    def hash(self, password):
+        """Hash `password` with the configured cost."""
+
+        return self._run(_hash, password.encode('UTF-8'), self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self._run(_check,
+                         hashed.encode('UTF-8'),
+                         password.encode('UTF-8'))
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than we use now?"""
+
+        return hash_cost(hashed) != self.rounds
+
+    def stats(self):
+        """Counters describing the pool, for monitoring."""
+
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'slots': self.slots.count,
+                'queued': self.queued,
+                'peak_queued': self.peak_queued,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+    def shutdown(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+
+        # (outside the lock: finishing hashes' callbacks take it)
+        if pool is not None:
+            pool.shutdown()
+
+
+hasher = PasswordHasher()
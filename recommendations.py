@@ -0,0 +1,160 @@
+"""Who-to-follow suggestions from the follows graph.
+
+Suggestions are the people followed by the people you follow: friends of
+friends, found in this worker's in-memory follows graph (graph.py). A
+candidate scores
+
+    sum over the people you follow who follow them of 1 / log(2 + n)
+
+where n is how many people that intermediary follows (following someone who
+follows everybody says little about any one of them), plus FOLLOWS_YOU_BONUS
+if the candidate already follows you. Intermediaries following more than
+MAX_FANOUT people are skipped, which bounds the work per request.
+
+Until the graph has loaded, suggestions come from the `suggested_follows`
+table that `flask precompute-suggestions` fills. The graph only learns of
+follows written by other workers when it's reloaded, so routes filter out
+anyone the viewer already follows in the query that loads the suggested
+users, and never show stale ones."""
+
+import math
+from collections import defaultdict
+from heapq import nlargest
+
+from sqlalchemy import select, and_, exists
+
+from models import db, User, FollowersFollowee, SuggestedFollow
+from graph import social_graph
+
+# intermediaries following more people than this are ignored
+MAX_FANOUT = 5000
+
+# added to the score of candidates who already follow you
+FOLLOWS_YOU_BONUS = 1.0
+
+SUGGESTIONS = 10
+
+# suggestions stored per user by precompute_suggestions()
+PRECOMPUTED_SUGGESTIONS = 50
+
+# rows per INSERT when precomputing
+BATCH_SIZE = 1000
+
+follows = FollowersFollowee.__table__
+suggested = SuggestedFollow.__table__
+
+
+def suggest(user_id, limit=SUGGESTIONS):
+    """[(candidate id, score, via)] for `user_id` from the follows graph
+    (which must be loaded), best first; `via` is how many of the people they
+    follow follow the candidate."""
+
+    following = social_graph.following_ids(user_id)
+    scores = defaultdict(float)
+    via = defaultdict(int)
+
+    for friend in following:
+        fanout = social_graph.following_count(friend)
+        if fanout > MAX_FANOUT:
+            continue
+
+        weight = 1 / math.log(2 + fanout)
+        for candidate in social_graph.following_ids(friend):
+            scores[candidate] += weight
+            via[candidate] += 1
+
+    for follower in social_graph.followers_ids(user_id):
+        scores[follower] += FOLLOWS_YOU_BONUS
+
+    for known in following:
+        scores.pop(known, None)
+    scores.pop(user_id, None)
+
+    if not scores:
+        # nothing to go on yet: the most-followed people
+        known = set(following)
+        return [(id, 0.0, 0)
+                for id in social_graph.most_followed(limit + len(known) + 1)
+                if id != user_id and id not in known][:limit]
+
+    best = nlargest(limit, scores, key=lambda id: (scores[id], -id))
+    return [(id, scores[id], via.get(id, 0)) for id in best]
+
+
+def stored_suggestions(user_id, limit=SUGGESTIONS):
+    """[(user id, score, via)] precomputed for `user_id`, best first."""
+
+    rows = db.session.execute(
+        select([suggested.c.suggested_id, suggested.c.score, suggested.c.via])
+        .where(suggested.c.user_id == user_id)
+        .order_by(suggested.c.score.desc(), suggested.c.suggested_id)
+        .limit(limit))
+    return [tuple(row) for row in rows]
+
+
+def suggestions_for(app, user_id, limit=SUGGESTIONS):
+    """[(user id, score, via)] to suggest to `user_id`: from this worker's
+    graph if it's loaded, otherwise the precomputed ones."""
+
+    if social_graph.ready(app):
+        return suggest(user_id, limit)
+
+    return stored_suggestions(user_id, limit)
+
+
+def precompute_suggestions(limit=PRECOMPUTED_SUGGESTIONS):
+    """Reload the graph and store `limit` suggestions for every user who
+    follows or is followed by anyone. Returns how many rows were stored."""
+
+    social_graph.rebuild()
+
+    db.session.execute(suggested.delete())
+
+    rows = []
+    stored = 0
+
+    for user_id in social_graph.users():
+        rows += [{'user_id': user_id,
+                  'suggested_id': id,
+                  'score': score,
+                  'via': via}
+                 for id, score, via in suggest(user_id, limit)]
+
+        if len(rows) >= BATCH_SIZE:
+            db.session.execute(suggested.insert(), rows)
+            stored += len(rows)
+            rows = []
+
+    if rows:
+        db.session.execute(suggested.insert(), rows)
+        stored += len(rows)
+
+    return stored
+
+
+class Suggestion:
+    """A user to suggest, and how many of the viewer's followees follow
+    them."""
+
+    def __init__(self, user, via):
+        self.user = user
+        self.via = via
+
+    def __repr__(self):
+        return f"<Suggestion #{self.user.id}: via {self.via}>"
+
+
+def load_suggestions(user_id, found, skip=(), limit=SUGGESTIONS):
+    """Suggestions with their User rows for `found` (from suggestions_for()),
+    in one query, leaving out `skip` and anyone `user_id` now follows."""
+
+    # (in `follows`, followee_id is the follower; see models.py)
+    followed = exists().where(and_(follows.c.followee_id == user_id,
+                                   follows.c.follower_id == User.id))
+
+    ids = [id for id, _, _ in found if id not in skip]
+    users = {user.id: user
+             for user in User.query.filter(User.id.in_(ids), ~followed)}
+
+    return [Suggestion(users[id], via) for id, _, via in found
+            if id in users][:limit]
@@ -0,0 +1,254 @@
+"""Read replicas.
+
+Routes marked @replica_reads send their SQL to a read replica (one of
+SQLALCHEMY_REPLICA_URIS, taken in turn) when they're answering a GET, which
+takes the feed pages' reads off the primary. Everything else uses the
+primary, and so does a replica route's SQL:
+
+- for a user who has written anything (any non-GET request) in the last
+  REPLICA_STICKY_SECONDS, so they read their own writes; this is kept in
+  their session cookie, so it holds whichever worker they reach next
+- once the request itself has written (a flush or an INSERT / UPDATE /
+  DELETE), for the rest of it
+- when every replica is more than REPLICA_MAX_LAG seconds behind, or can't
+  be reached
+
+Replication lag is checked every LAG_CHECK_INTERVAL seconds per replica, per
+worker, by a background thread, so requests never wait on it (on Postgres,
+from the replica's WAL replay position and receiver status; other databases
+are assumed to be up to date). A replica whose lag isn't known, or hasn't
+been checked for LAG_STALE_AFTER seconds, is treated as too far behind.
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.expression import TextClause, UpdateBase
+
+# reads stay on the primary for this long after a user writes (seconds)
+REPLICA_STICKY_SECONDS = 5
+
+# replicas further behind than this aren't used (seconds)
+REPLICA_MAX_LAG = 2
+
+LAG_CHECK_INTERVAL = 1
+
+# lags older than this (seconds) aren't trusted
+LAG_STALE_AFTER = 10
+
+# seconds to wait for a connection to a replica
+REPLICA_CONNECT_TIMEOUT = 2
+
+# infinite when the replica isn't streaming from the primary (it has lost
+# its connection, so it can't know how far behind it is); 0 when it has
+# replayed everything it has received; otherwise how old the last
+# transaction it replayed is
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver
+                         WHERE status = 'streaming')
+            THEN 'Infinity'::float8
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+SESSION_KEY = 'primary_until'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+log = logging.getLogger('warbler.replicas')
+
+
+def replica_reads(view):
+    """Mark a route whose GETs can be answered from a read replica.
+
+    Goes under @app.route, so the route registers the marked function.
+    """
+
+    view.replica_reads = True
+    return view
+
+
+def is_write(clause):
+    """Does `clause` (from Session.get_bind()) change anything?"""
+
+    if isinstance(clause, UpdateBase):
+        return True
+    if isinstance(clause, TextClause):
+        return not clause.text.lstrip().upper().startswith(('SELECT', 'WITH'))
+    return False
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the replica picked for the request
+    (g.replica), until the request writes."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context() and g.get('replica') is not None:
+            if not (self._flushing or is_write(clause)):
+                return g.replica
+
+            # the rest of the request reads what it wrote
+            g.replica = None
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaRouter:
+    """Picks the replica (if any) for each request, and remembers who has
+    written recently."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.engines = {}
+        self.turns = itertools.count()
+
+        # uri -> (when it was checked, seconds behind)
+        self.lags = {}
+        self.checking = None
+        self.pid = None
+
+        self.replica_requests = 0
+        self.sticky_requests = 0
+        self.lagging_requests = 0
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_STICKY_SECONDS', REPLICA_STICKY_SECONDS)
+        app.config.setdefault('REPLICA_MAX_LAG', REPLICA_MAX_LAG)
+
+        # register this before other before_request functions, so their
+        # reads can use the replica
+        app.before_request(self.choose)
+        app.after_request(self.remember_writes)
+
+    def engine(self, uri):
+        with self.lock:
+            if uri not in self.engines:
+                connect_args = {}
+                if make_url(uri).get_backend_name() == 'postgresql':
+                    connect_args['connect_timeout'] = REPLICA_CONNECT_TIMEOUT
+                self.engines[uri] = create_engine(uri, pool_pre_ping=True,
+                                                  connect_args=connect_args)
+            return self.engines[uri]
+
+    def lag(self, uri):
+        """Seconds replica `uri` is behind, as last checked (infinite if it's
+        unreachable, or hasn't been checked lately)."""
+
+        checked = self.lags.get(uri)
+        if not checked or time.monotonic() - checked[0] > LAG_STALE_AFTER:
+            return float('inf')
+        return checked[1]
+
+    def check_lags(self, uris):
+        """Check how far behind each of `uris` is, now."""
+
+        for uri in uris:
+            try:
+                engine = self.engine(uri)
+                if engine.dialect.name == 'postgresql':
+                    with engine.connect() as conn:
+                        lag = float(conn.execute(LAG_SQL).scalar() or 0)
+                else:
+                    lag = 0.0
+            except Exception:
+                log.exception("checking replica lag failed")
+                lag = float('inf')
+
+            self.lags[uri] = (time.monotonic(), lag)
+
+    def watch(self, app):
+        """Start checking `app`'s replicas' lag in the background, if we
+        aren't already."""
+
+        with self.lock:
+            # (started lazily so each forked worker gets its own)
+            if self.checking is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.checking = threading.Thread(
+                    target=self._check_forever, args=(app,),
+                    name='replica-lag', daemon=True)
+                self.checking.start()
+
+    def _check_forever(self, app):
+        while True:
+            self.check_lags(app.config['SQLALCHEMY_REPLICA_URIS'])
+            time.sleep(LAG_CHECK_INTERVAL)
+
+    def pick(self):
+        """A replica engine that's keeping up, or None."""
+
+        uris = current_app.config['SQLALCHEMY_REPLICA_URIS']
+        max_lag = current_app.config['REPLICA_MAX_LAG']
+
+        start = next(self.turns)
+        for i in range(len(uris)):
+            uri = uris[(start + i) % len(uris)]
+            if self.lag(uri) <= max_lag:
+                return self.engine(uri)
+
+        return None
+
+    def choose(self):
+        """before_request: use a replica for this request, if we can."""
+
+        g.replica = None
+
+        view = current_app.view_functions.get(request.endpoint)
+        if (request.method not in SAFE_METHODS
+                or not getattr(view, 'replica_reads', False)
+                or not current_app.config['SQLALCHEMY_REPLICA_URIS']):
+            return
+
+        self.watch(current_app._get_current_object())
+
+        if session.get(SESSION_KEY, 0) > time.time():
+            self.sticky_requests += 1
+            return
+
+        g.replica = self.pick()
+        if g.replica is None:
+            self.lagging_requests += 1
+        else:
+            self.replica_requests += 1
+
+    def remember_writes(self, response):
+        """after_request: keep a user who just wrote on the primary."""
+
+        if (request.method not in SAFE_METHODS
+                and current_app.config['SQLALCHEMY_REPLICA_URIS']):
+            session[SESSION_KEY] = (
+                time.time() + current_app.config['REPLICA_STICKY_SECONDS'])
+
+        return response
+
+    def stats(self):
+        """Requests sent to replicas, and why others weren't, for
+        monitoring."""
+
+        return {
+            'replica_requests': self.replica_requests,
+            'sticky_requests': self.sticky_requests,
+            'lagging_requests': self.lagging_requests,
+            'replicas': len(self.engines),
+        }
+
+
+replicas = ReplicaRouter()
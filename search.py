@@ -0,0 +1,405 @@
+"""In-process search over users and messages.
+
+Searching with `LIKE '%q%'` scans the whole table. Instead each worker keeps
+an inverted index from character trigrams to the users / messages containing
+them, plus a sorted list of usernames for prefix autocomplete. Results are
+ranked by trigram similarity (so typos still match) and paged. Documents
+are looked up only by the query's rarer trigrams (see MAX_POSTINGS), so a
+query made of common ones can't walk the whole corpus.
+
+The index is built from the database, in a background thread, the first
+time it's used (searches meanwhile fall back to `LIKE` queries), and then
+kept up to date incrementally: routes call index_user() / index_message()
+etc. after committing. Users and messages created by *other* workers are
+picked up by id on the next search; profile edits made elsewhere show up
+when the index is next rebuilt (see REBUILD_INTERVAL), which is also done in
+the background, and swapped in when it's ready.
+"""
+
+import re
+import time
+from bisect import bisect_left, insort
+from collections import defaultdict
+from itertools import islice
+
+from sqlalchemy import or_
+
+from background import BackgroundIndex
+from models import db, User, Message
+
+# rebuild from the database this often (seconds), to pick up edits made by
+# other workers
+REBUILD_INTERVAL = 60 * 60
+
+# matches in the username count this much more than matches in the bio
+USERNAME_WEIGHT = 2.0
+
+# ignore results containing less than this fraction of the query's trigrams
+MIN_COVERAGE = 0.5
+
+# trigrams in more documents than this are too common to find documents by
+# (they still count towards the scores of documents found by rarer ones)
+MAX_POSTINGS = 5000
+
+WORD_RE = re.compile(r"\w+")
+
+
+def trigrams(text):
+    """Set of trigrams of `text`, padded per word the way pg_trgm does."""
+
+    grams = set()
+
+    for word in WORD_RE.findall((text or "").lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    return grams
+
+
+class TrigramIndex:
+    """Inverted index from trigrams to document ids.
+
+    Each document's trigram set is replaced, never changed, when it's
+    re-indexed, so score() can read them without the caller's lock; only
+    lookup() needs it.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.docs = {}
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc_id, text):
+        """Index (or re-index) `doc_id` with `text`."""
+
+        self.remove(doc_id)
+        grams = trigrams(text)
+        self.docs[doc_id] = grams
+
+        for gram in grams:
+            self.postings[gram].add(doc_id)
+
+    def remove(self, doc_id):
+        """Drop `doc_id` from the index."""
+
+        for gram in self.docs.pop(doc_id, ()):
+            ids = self.postings[gram]
+            ids.discard(doc_id)
+            if not ids:
+                del self.postings[gram]
+
+    def lookup(self, grams):
+        """{trigram: copy of its posting list} to find documents matching
+        `grams` by: the grams in at most MAX_POSTINGS documents, or if all
+        of them are in more, the first MAX_POSTINGS of the rarest one's."""
+
+        sizes = {gram: len(self.postings.get(gram, ())) for gram in grams}
+        rare = [gram for gram in grams if sizes[gram] <= MAX_POSTINGS]
+
+        if rare:
+            return {gram: list(self.postings.get(gram, ())) for gram in rare}
+
+        rarest = min(grams, key=sizes.get)
+        return {rarest: list(islice(self.postings[rarest], MAX_POSTINGS))}
+
+    def scores(self, grams, found):
+        """{doc_id: similarity to `grams`} for documents in `found` (from
+        lookup()) that match them.
+
+        Similarity is the Jaccard index of the two trigram sets (0 to 1).
+        """
+
+        overlap = defaultdict(int)
+        for ids in found.values():
+            for doc_id in ids:
+                overlap[doc_id] += 1
+
+        common = grams.difference(found)
+        scores = {}
+
+        for doc_id, shared in overlap.items():
+            doc = self.docs.get(doc_id)
+            if doc is None:
+                # (removed since)
+                continue
+
+            shared += len(common & doc)
+            if shared / len(grams) >= MIN_COVERAGE:
+                scores[doc_id] = shared / (len(grams) + len(doc) - shared)
+
+        return scores
+
+
+class SearchResults:
+    """One page of ranked search results."""
+
+    def __init__(self, ids, page, has_more):
+        self.ids = ids
+        self.page = page
+        self.has_more = has_more
+
+
+def _page(scores, page, per_page):
+    """Rank `scores` and cut out page number `page` (1-based)."""
+
+    ranked = sorted(scores, key=lambda doc_id: (-scores[doc_id], doc_id))
+    start = (page - 1) * per_page
+
+    return SearchResults(ranked[start:start + per_page],
+                         page,
+                         has_more=len(ranked) > start + per_page)
+
+
+class Corpus:
+    """Trigram indexes of usernames, bios and message text."""
+
+    def __init__(self):
+        self.usernames = TrigramIndex()
+        self.bios = TrigramIndex()
+        self.messages = TrigramIndex()
+        self.prefixes = []
+        self.username_of = {}
+        self.max_user_id = 0
+        self.max_message_id = 0
+
+    def add_user(self, id, username, bio):
+        old_username = self.username_of.get(id)
+        if old_username is not None:
+            self.prefixes.remove((old_username.lower(), id))
+
+        self.usernames.add(id, username)
+        self.bios.add(id, bio)
+        self.username_of[id] = username
+        insort(self.prefixes, (username.lower(), id))
+        self.max_user_id = max(self.max_user_id, id)
+
+    def remove_user(self, user_id, message_ids=()):
+        username = self.username_of.pop(user_id, None)
+        if username is not None:
+            self.prefixes.remove((username.lower(), user_id))
+
+        self.usernames.remove(user_id)
+        self.bios.remove(user_id)
+
+        for message_id in message_ids:
+            self.messages.remove(message_id)
+
+    def add_message(self, id, text):
+        self.messages.add(id, text)
+        self.max_message_id = max(self.max_message_id, id)
+
+    def remove_message(self, message_id):
+        self.messages.remove(message_id)
+
+
+def _new_users(after):
+    return (db.session
+            .query(User.id, User.username, User.bio)
+            .filter(User.id > after)
+            .order_by(User.id)
+            .yield_per(1000))
+
+
+def _new_messages(after):
+    return (db.session
+            .query(Message.id, Message.text)
+            .filter(Message.id > after)
+            .order_by(Message.id)
+            .yield_per(1000))
+
+
+def _like(column, text, prefix_only=False):
+    """`column` ILIKE '%text%' (or 'text%'), with `text` taken literally."""
+
+    text = (text.replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+    pattern = f"{text}%" if prefix_only else f"%{text}%"
+    return column.ilike(pattern, escape='\\')
+
+
+class SearchIndex(BackgroundIndex):
+    """This worker's Corpus, loaded lazily (see background.py) and kept up
+    to date, with `LIKE` queries standing in until it's first loaded."""
+
+    def __init__(self):
+        super().__init__('search-index', REBUILD_INTERVAL)
+        self.corpus = None
+
+        # changes made while the corpus is being (re)loaded, as
+        # (Corpus method name, args), to replay on the new one
+        self.missed = None
+
+    @property
+    def loaded(self):
+        return self.corpus is not None
+
+    def load_failed(self):
+        self.missed = None
+
+    def rebuild(self):
+        """Load everything from the database into a new Corpus, and swap it
+        in. (Searches keep using the old one meanwhile.)"""
+
+        with self.lock:
+            self.missed = []
+
+        corpus = Corpus()
+        for id, username, bio in _new_users(0):
+            corpus.add_user(id, username, bio)
+        for id, text in _new_messages(0):
+            corpus.add_message(id, text)
+
+        with self.lock:
+            # the load may have started before some of these were committed
+            for name, args in self.missed:
+                getattr(corpus, name)(*args)
+            self.missed = None
+
+            self.corpus = corpus
+            self.built_at = time.monotonic()
+
+    def _change(self, name, *args):
+        """Apply Corpus.<name>(*args) to the corpus, and to the one being
+        loaded, if there is one."""
+
+        with self.lock:
+            if self.missed is not None:
+                self.missed.append((name, args))
+            if self.corpus is not None:
+                getattr(self.corpus, name)(*args)
+
+    def _catch_up(self):
+        """Index users and messages newer than the newest we've seen."""
+
+        with self.lock:
+            corpus = self.corpus
+            after_user, after_message = (corpus.max_user_id,
+                                         corpus.max_message_id)
+
+        users = _new_users(after_user).all()
+        messages = _new_messages(after_message).all()
+
+        with self.lock:
+            # (another thread may have caught up meanwhile)
+            for id, username, bio in users:
+                if id > corpus.max_user_id:
+                    corpus.add_user(id, username, bio)
+            for id, text in messages:
+                if id > corpus.max_message_id:
+                    corpus.add_message(id, text)
+
+    def _loaded(self):
+        """The corpus, caught up, or None if it isn't loaded yet."""
+
+        if not self.ready():
+            return None
+
+        self._catch_up()
+        return self.corpus
+
+    def index_user(self, user):
+        """Add or update a user (after signup / profile edit)."""
+
+        self._change('add_user', user.id, user.username, user.bio)
+
+    def remove_user(self, user_id, message_ids=()):
+        """Drop a deleted user and their messages."""
+
+        self._change('remove_user', user_id, tuple(message_ids))
+
+    def index_message(self, msg):
+        """Add a newly-posted message."""
+
+        self._change('add_message', msg.id, msg.text)
+
+    def remove_message(self, message_id):
+        """Drop a deleted message."""
+
+        self._change('remove_message', message_id)
+
+    def search_users(self, query, page=1, per_page=20):
+        """Ids of users matching `query`, best first, as SearchResults."""
+
+        corpus = self._loaded()
+        if corpus is None:
+            return _like_page(db.session.query(User.id)
+                              .filter(or_(_like(User.username, query),
+                                          _like(User.bio, query)))
+                              .order_by(User.id),
+                              page, per_page)
+
+        grams = trigrams(query)
+        if not grams:
+            return _page({}, page, per_page)
+
+        with self.lock:
+            usernames = corpus.usernames.lookup(grams)
+            bios = corpus.bios.lookup(grams)
+
+        scores = defaultdict(float)
+        for id, score in corpus.usernames.scores(grams, usernames).items():
+            scores[id] += USERNAME_WEIGHT * score
+        for id, score in corpus.bios.scores(grams, bios).items():
+            scores[id] += score
+
+        return _page(scores, page, per_page)
+
+    def search_messages(self, query, page=1, per_page=20):
+        """Ids of messages matching `query`, best first, as SearchResults."""
+
+        corpus = self._loaded()
+        if corpus is None:
+            return _like_page(db.session.query(Message.id)
+                              .filter(_like(Message.text, query))
+                              .order_by(Message.id.desc()),
+                              page, per_page)
+
+        grams = trigrams(query)
+        if not grams:
+            return _page({}, page, per_page)
+
+        with self.lock:
+            found = corpus.messages.lookup(grams)
+
+        return _page(corpus.messages.scores(grams, found), page, per_page)
+
+    def autocomplete(self, prefix, limit=10):
+        """Up to `limit` (id, username) pairs whose username starts with
+        `prefix`."""
+
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+
+        corpus = self._loaded()
+        if corpus is None:
+            return [tuple(row) for row in
+                    db.session.query(User.id, User.username)
+                    .filter(_like(User.username, prefix, prefix_only=True))
+                    .order_by(User.username)
+                    .limit(limit)]
+
+        with self.lock:
+            start = bisect_left(corpus.prefixes, (prefix, 0))
+            found = []
+
+            for username, id in corpus.prefixes[start:start + limit]:
+                if not username.startswith(prefix):
+                    break
+                found.append((id, corpus.username_of[id]))
+
+            return found
+
+
+def _like_page(query, page, per_page):
+    """Page number `page` of `query`'s ids, as SearchResults (unranked)."""
+
+    ids = [row[0] for row in query.offset((page - 1) * per_page)
+           .limit(per_page + 1)]
+    return SearchResults(ids[:per_page], page, has_more=len(ids) > per_page)
+
+
+search_index = SearchIndex()
@@ -1,20 +1,28 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, FollowersFollowee
+Run like:
 
+    python seed.py                  # drop everything, load generator/*.csv
+    python seed.py --resume         # carry on after a load that failed
+    python seed.py --dir staging/   # load CSVs from somewhere else
 
-db.drop_all()
-db.create_all()
+See loader.py for how the load works.
+"""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+import argparse
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from app import app
+from loader import bulk_load, CHUNK_ROWS
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(FollowersFollowee, DictReader(follows))
+parser = argparse.ArgumentParser(description="Load Warbler CSVs.")
+parser.add_argument('--dir', default='generator',
+                    help="directory holding users.csv etc. "
+                         "(default generator/)")
+parser.add_argument('--resume', action='store_true',
+                    help="continue a failed load instead of starting over")
+parser.add_argument('--chunk', type=int, default=CHUNK_ROWS,
+                    help=f"rows per transaction (default {CHUNK_ROWS})")
+args = parser.parse_args()
 
-db.session.commit()
+with app.app_context():
+    bulk_load(args.dir, resume=args.resume, chunk_rows=args.chunk)
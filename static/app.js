@@ -21,30 +21,36 @@ $(function() {
     $('.modal-body').text(res.text);
     $('#msg-comments').empty();
     $('#message-id').val(res.id);
-    
-    
+
     if (res.comments.length) {
-      for (let comment of res.comments) {
-        let formattedComment = makeHtml(comment);
-        $('#msg-comments').append(formattedComment);
-      }
+      appendComments(res);
     } else {
       let noComments = `<p class="empty-comments"><small><em>No comments to show</em></small></p>`;
       $('#msg-comments').append(noComments);
     }
   }
 
-  function makeHtml(obj) {
+  // add a page of comments, and remember where the next one starts
+  function appendComments(res) {
+    for (let comment of res.comments) {
+      let user = res.users[comment.user_id];
+      $('#msg-comments').append(makeHtml(comment, user));
+    }
+
+    $('#msg-comments').data('next-cursor', res.next_cursor);
+  }
+
+  function makeHtml(obj, user) {
     return `
       <div class="card m-2">
         <div class="card-body">
           <p>${obj.text}</p>
           <div class="d-flex align-items-center">
             <a href="/users/${obj.user_id}">
-              <img src="${ obj.image_url }" alt="${obj.username}" class="timeline-image user-cmnt-badge mr-3"/>
+              <img src="${ user.image_url }" alt="${user.username}" class="timeline-image user-cmnt-badge mr-3"/>
             </a>
-            <a href="/users/${obj.user_id}">@${obj.username}</a>
-            <cite class="ml-3" title="Source Title">${obj.timestamp.slice(0,16)}</cite>
+            <a href="/users/${obj.user_id}">@${user.username}</a>
+            <cite class="ml-3" title="Source Title">${obj.timestamp.slice(0,16).replace('T', ' ')}</cite>
           </div>
         </div>
       </div>`;
@@ -57,6 +63,26 @@ $(function() {
     $(`#${res.msg_id}-num-comments`).text(numComments);
   }
 
+  function handleLoadMore(html, status, xhr) {
+    $('#messages').append(html);
+
+    let nextCursor = xhr.getResponseHeader('X-Next-Cursor');
+    if (nextCursor) {
+      $('#load-more').attr('data-cursor', nextCursor);
+      $('#load-more').attr('href', `?before=${nextCursor}`);
+    } else {
+      $('#load-more').remove();
+    }
+  }
+
+  function handleAutocomplete(res) {
+    $('#search-suggestions').empty();
+
+    for (let user of res) {
+      $('#search-suggestions').append($('<option>').attr('value', user.username));
+    }
+  }
+
   function handleCommentError(res) {
     let text = $('#comment-text').val();
     
@@ -74,7 +100,7 @@ $(function() {
 
   $('[data-toggle="tooltip"]').tooltip();
 
-  $('.trash-btn').on('click', (e) => {
+  $('#messages').on('click', '.trash-btn', (e) => {
     e.preventDefault();
 
     //get message_id
@@ -88,7 +114,7 @@ $(function() {
     });
   });
 
-  $('.like-btn').on('click', (e) => {
+  $('#messages').on('click', '.like-btn', (e) => {
     e.preventDefault();
     //get message_id
     const msg_id = e.target.getAttribute('data-msg');
@@ -121,19 +147,74 @@ $(function() {
   });
 
   // button to populate message info
-  $('.comment-btn').on('click', (e) => {
+  $('#messages').on('click', '.comment-btn', (e) => {
     e.preventDefault();
     const msg_id = e.target.type === 'button'
       ? $(e.target).children()[0].getAttribute('data-msg')
       :  e.target.getAttribute('data-msg');
     
+    // a GET, so the browser can revalidate its cached copy
     $.ajax({
-      type: 'POST',
+      type: 'GET',
       url: `/messages/${msg_id}`,
+      dataType: 'json',
       success: populateModal
     });
   });
 
+  // fetch more comments as the modal is scrolled to the bottom
+  let loadingComments = false;
+
+  $('#commentModalLong').on('scroll', (e) => {
+    const modal = e.target;
+    const cursor = $('#msg-comments').data('next-cursor');
+    const nearBottom = modal.scrollTop + modal.clientHeight >= modal.scrollHeight - 200;
+
+    if (!cursor || loadingComments || !nearBottom) return;
+
+    const msg_id = $('#message-id').val();
+
+    loadingComments = true;
+    $.ajax({
+      type: 'GET',
+      url: `/messages/${msg_id}/comments`,
+      data: { before: cursor },
+      dataType: 'json',
+      success: (res) => {
+        // (unless another message's comments were opened meanwhile)
+        if ($('#message-id').val() === msg_id) appendComments(res);
+      },
+      complete: () => { loadingComments = false; }
+    });
+  });
+
+  // suggest usernames as you type in the search box
+  $('#search').on('input', (e) => {
+    const q = e.target.value;
+    if (!q) return;
+
+    $.ajax({
+      type: 'GET',
+      url: '/users/autocomplete',
+      data: { q },
+      success: handleAutocomplete
+    });
+  });
+
+  // fetch the next page of a feed
+  $('#load-more').on('click', (e) => {
+    e.preventDefault();
+
+    const cursor = e.target.getAttribute('data-cursor');
+
+    $.ajax({
+      type: 'GET',
+      url: window.location.pathname,
+      data: { before: cursor, partial: 1 },
+      success: handleLoadMore
+    });
+  });
+
   // button in modal to create comment
   $('#add-comment-btn').on('click', (e) => {
     e.preventDefault();
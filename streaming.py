@@ -0,0 +1,68 @@
+"""Streamed rendering of feed pages.
+
+render_template() builds the whole page as one string before sending a byte.
+stream_template() sends it while Jinja renders it instead: templates output
+{{ flush }} where what's been rendered so far should go to the client before
+anything slow happens (e.g. just before a FeedStream reads and hydrates the
+next chunk of messages; see _messages.html), and output in between is sent
+in pieces of at least STREAM_BUFFER characters.
+
+{{ flush }} renders as nothing in templates rendered the usual way.
+
+The session is saved before a streamed body is rendered, so flashed messages
+are popped from it up front.
+"""
+
+from flask import current_app, get_flashed_messages, stream_with_context
+from markupsafe import Markup
+
+# send rendered output once this much of it has built up
+STREAM_BUFFER = 16 * 1024
+
+# (escaped text can't contain this, so it's only ever where a template put it)
+FLUSH = Markup('<!--flush-->')
+
+
+def _pieces(template, context):
+    """The template's output, in pieces to send."""
+
+    buffered = []
+    size = 0
+
+    for output in template.generate(context):
+        *done, output = output.split(FLUSH)
+
+        if done:
+            buffered += done
+            if any(buffered):
+                yield ''.join(buffered)
+            buffered = []
+            size = 0
+
+        buffered.append(output)
+        size += len(output)
+
+        if size >= STREAM_BUFFER:
+            yield ''.join(buffered)
+            buffered = []
+            size = 0
+
+    if any(buffered):
+        yield ''.join(buffered)
+
+
+def stream_template(template_name, **context):
+    """Like render_template(), but returns a Response that streams the
+    page as it's rendered."""
+
+    app = current_app._get_current_object()
+
+    # (the session's saved before the body is rendered)
+    get_flashed_messages()
+
+    app.update_template_context(context)
+    context['flush'] = FLUSH
+    template = app.jinja_env.get_template(template_name)
+
+    return app.response_class(stream_with_context(_pieces(template, context)),
+                              mimetype='text/html')
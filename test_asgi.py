@@ -0,0 +1,210 @@
+"""Async serving (asgi.py) tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_asgi.py
+
+
+import json
+import os
+from unittest import IsolatedAsyncioTestCase, skipUnless
+
+from models import db, User, Message, Like, Comment, FollowersFollowee
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from counters import reconcile_counters  # noqa: E402
+from identity import identity_cache  # noqa: E402
+from writebehind import write_behind  # noqa: E402
+
+try:
+    from asgi import application, async_dsn, asyncpg
+except ImportError:
+    application = None
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Write likes / follows synchronously, so tests can check the database
+
+app.config['WRITE_BEHIND_WINDOW'] = 0
+
+
+def session_cookie(user_id):
+    serializer = app.session_interface.get_signing_serializer(app)
+    return (f"{app.config['SESSION_COOKIE_NAME']}="
+            f"{serializer.dumps({CURR_USER_KEY: user_id})}")
+
+
+async def call(method, path, body=None, user_id=None, root_path=''):
+    """(status, headers, body) of a request sent straight to the ASGI app."""
+
+    headers = [(b'host', b'localhost')]
+    data = b''
+    if body is not None:
+        data = json.dumps(body).encode()
+        headers += [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(data)).encode())]
+    if user_id is not None:
+        headers.append((b'cookie', session_cookie(user_id).encode()))
+
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': method, 'scheme': 'http', 'path': path,
+        'raw_path': path.encode(), 'query_string': b'', 'root_path': root_path,
+        'headers': headers, 'server': ('localhost', 80),
+        'client': ('127.0.0.1', 12345),
+    }
+    incoming = [{'type': 'http.request', 'body': data, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return incoming.pop() if incoming else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await application(scope, receive, send)
+
+    start = sent[0]
+    return (start['status'],
+            {name.decode(): value.decode()
+             for name, value in start['headers']},
+            b''.join(message.get('body', b'') for message in sent[1:]))
+
+
+@skipUnless(application, "needs asgiref")
+class AsyncAppTestCase(IsolatedAsyncioTestCase):
+    """Test the ASGI app, with and without its async handlers."""
+
+    def setUp(self):
+        db.create_all()
+
+        for i in range(4):
+            db.session.add(User.signup(
+                email=f"test{i}@test.com",
+                username=f"testuser{i}",
+                password="HASHED_PASSWORD",
+                image_url="/static/images/default-pic.png"))
+        db.session.commit()
+
+        for i in range(4):
+            db.session.add(Message(text=f"message {i}", user_id=i + 1))
+        db.session.commit()
+
+        db.session.add(Like(user_id=2, message_id=1))
+        db.session.add(FollowersFollowee(followee_id=2, follower_id=1))
+        db.session.commit()
+
+        reconcile_counters()
+        db.session.commit()
+        identity_cache.clear()
+
+    async def asyncSetUp(self):
+        await application.startup()
+
+    async def asyncTearDown(self):
+        await application.shutdown()
+
+    def tearDown(self):
+        db.session.close()
+        db.drop_all()
+
+    async def test_flask_routes(self):
+        """ pages, and requests the handlers don't take, go to Flask """
+
+        status, headers, body = await call('GET', '/users/2')
+        self.assertEqual(status, 200)
+        self.assertIn(b"testuser1", body)
+
+        # (not logged in: Flask's flash and redirect)
+        status, headers, body = await call('POST', '/users/follow/2')
+        self.assertEqual(status, 302)
+        status, headers, body = await call('POST', '/messages/1/delete')
+        self.assertEqual(status, 302)
+
+        # the async handlers read Flask's session cookie
+        scope = {'headers': [(b'cookie', session_cookie(3).encode())]}
+        self.assertEqual(application.session(scope), {CURR_USER_KEY: 3})
+
+        if application.pool is None:
+            # (no asyncpg / Postgres: Flask answers the AJAX routes too)
+            status, headers, body = await call('POST', '/like',
+                                               {'msg-id': 3}, user_id=1)
+            self.assertEqual(json.loads(body)['is-liked'], True)
+
+    @skipUnless(application and asyncpg and async_dsn(
+        app.config['SQLALCHEMY_DATABASE_URI']), "needs asyncpg and Postgres")
+    async def test_async_endpoints(self):
+        """ the AJAX endpoints answer from asyncpg, as the routes do """
+
+        self.assertIsNotNone(application.pool)
+
+        status, headers, body = await call('POST', '/like', {'msg-id': 1},
+                                           user_id=1)
+        resp = json.loads(body)
+        # (static URLs carry their content hash; see caching.py)
+        self.assertRegex(resp.pop('userImg'),
+                         r'^/static/images/default-pic\.png\?v=\w{12}$')
+        self.assertEqual(resp, {'likes': 2, 'is-liked': True, 'msgId': 1})
+
+        # links are built for the request being answered
+        status, headers, body = await call('POST', '/like', {'msg-id': 1},
+                                           user_id=1, root_path='/warbler')
+        self.assertTrue(json.loads(body)['userImg'].startswith(
+            '/warbler/static/images/default-pic.png'))
+
+        status, headers, body = await call('POST', '/users/follow/2',
+                                           user_id=1)
+        self.assertEqual(json.loads(body),
+                         {'followeeId': 2, 'isFollowing': True})
+
+        status, headers, body = await call(
+            'POST', '/messages/comments', {'msgId': 2, 'text': 'hello'},
+            user_id=1)
+        comment = json.loads(body)
+        self.assertEqual((comment['text'], comment['user_id'],
+                          comment['msg_id']), ('hello', 1, 2))
+
+        status, headers, body = await call(
+            'POST', '/messages/comments', {'msgId': 99999999, 'text': 'hi'},
+            user_id=1)
+        self.assertEqual(status, 404)
+
+        status, headers, body = await call('POST', '/messages/2', user_id=1)
+        shown = json.loads(body)
+        self.assertEqual(shown['username'], 'testuser1')
+        self.assertEqual([c['text'] for c in shown['comments']], ['hello'])
+        self.assertEqual(shown['users']['1']['username'], 'testuser0')
+
+        # someone else's message is Flask's to refuse
+        status, headers, body = await call('POST', '/messages/2/delete',
+                                           user_id=1)
+        self.assertEqual(status, 403)
+
+        status, headers, body = await call('POST', '/messages/99999999/delete',
+                                           user_id=1)
+        self.assertEqual(status, 404)
+
+        status, headers, body = await call('POST', '/messages/1/delete',
+                                           user_id=1)
+        self.assertEqual(json.loads(body), 1)
+
+        # and it all reached the database, with the counters kept right
+        db.session.expire_all()
+        self.assertEqual(write_behind.stats()['pending'], 0)
+        self.assertIsNone(Message.query.get(1))
+        self.assertEqual(Comment.query.filter_by(message_id=2).count(), 1)
+        self.assertEqual(User.query.get(1).following_count, 1)
+        self.assertEqual(User.query.get(2).likes_count, 0)
+        self.assertEqual(reconcile_counters(), (0, 0))
@@ -0,0 +1,68 @@
+"""CSV generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+
+import filecmp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from models import db
+import loader
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py')
+
+
+def generate(out, *options):
+    subprocess.run([sys.executable, GENERATOR, '--users', '300',
+                    '--out', out, *options],
+                   check=True, stderr=subprocess.DEVNULL)
+
+
+class GeneratorTestCase(TestCase):
+    """Test generating the seed CSVs."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shards_agree(self):
+        """ Same seed, same files, however the users are split up """
+
+        one = os.path.join(self.dir, 'one')
+        many = os.path.join(self.dir, 'many')
+        generate(one, '--processes', '1', '--shard-size', '300')
+        generate(many, '--processes', '3', '--shard-size', '37')
+
+        names = [f"{kind}.csv" for kind in loader.LOAD_ORDER]
+        self.assertEqual(sorted(os.listdir(one)), sorted(names))
+        self.assertEqual(sorted(os.listdir(many)), sorted(names))
+
+        match, mismatch, errors = filecmp.cmpfiles(one, many, names,
+                                                   shallow=False)
+        self.assertEqual((mismatch, errors), ([], []))
+
+    def test_headers(self):
+        """ Every file has a header seed.py can load, and some rows """
+
+        generate(self.dir, '--processes', '2', '--shard-size', '100')
+
+        for kind in loader.LOAD_ORDER:
+            path = os.path.join(self.dir, f"{kind}.csv")
+            header = loader.read_header(path)
+            loader.check_columns(db.metadata.tables[kind], header, path)
+
+            with open(path) as f:
+                self.assertGreater(sum(1 for _ in f), 1)
+
+        with open(os.path.join(self.dir, 'users.csv')) as f:
+            self.assertEqual(sum(1 for _ in f), 301)
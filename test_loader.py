@@ -0,0 +1,142 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_loader.py
+
+
+import csv
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, FollowersFollowee
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app  # noqa: E402
+import loader  # noqa: E402
+import migrate  # noqa: E402
+
+
+def write_csv(directory, name, header, rows):
+    with open(os.path.join(directory, f"{name}.csv"), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def drop_everything():
+    db.session.close()
+    db.drop_all()
+    loader.bookkeeping.drop_all(bind=db.engine)
+    migrate.versions.drop_all(bind=db.engine)
+
+
+class LoaderTestCase(TestCase):
+    """Test loading the seed CSVs."""
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        drop_everything()
+        self.dir = tempfile.mkdtemp()
+
+        write_csv(self.dir, 'users',
+                  ['email', 'username', 'password', 'bio'],
+                  [[f'{i}@test.com', f'user{i}', 'HASHED_PASSWORD', '']
+                   for i in range(1, 6)])
+        write_csv(self.dir, 'messages',
+                  ['text', 'timestamp', 'user_id'],
+                  [[f'message {i}', '2018-10-18 12:00:00', i % 5 + 1]
+                   for i in range(1, 8)])
+        # user 1 follows users 2 and 3
+        write_csv(self.dir, 'follows',
+                  ['followee_id', 'follower_id'],
+                  [[1, 2], [1, 3]])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        drop_everything()
+        self.context.pop()
+
+    def test_load(self):
+        """ CSVs load with line-number ids, counters filled in """
+
+        loader.bulk_load(self.dir, chunk_rows=3)
+
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Message.query.count(), 7)
+        self.assertEqual(User.query.get(3).username, 'user3')
+        self.assertEqual(Message.query.get(7).text, 'message 7')
+        self.assertEqual(User.query.get(1).following_count, 2)
+        self.assertEqual(FollowersFollowee.query.count(), 2)
+
+    def test_resume(self):
+        """ a load that dies part way resumes after its last committed
+        chunk, without loading anything twice """
+
+        # patch whichever writer load_file() really uses here
+        writer = ('copy_rows' if loader.is_postgres(db.engine)
+                  else 'executemany_rows')
+        write_rows = getattr(loader, writer)
+        calls = []
+        written = []
+
+        def failing(conn, table, columns, rows):
+            calls.append(table.name)
+            if table.name == 'messages' and calls.count('messages') == 2:
+                raise RuntimeError("connection lost")
+            write_rows(conn, table, columns, rows)
+
+        def recording(conn, table, columns, rows):
+            if table.name == 'messages':
+                written.extend(row[columns.index('id')] for row in rows)
+            write_rows(conn, table, columns, rows)
+
+        with patch(f'loader.{writer}', failing):
+            with self.assertRaises(RuntimeError):
+                loader.bulk_load(self.dir, chunk_rows=3)
+
+        # it died on the second chunk of messages, after both of users
+        self.assertEqual(calls, ['users', 'users', 'messages', 'messages'])
+
+        # the users and the first chunk of messages made it
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Message.query.count(), 3)
+        db.session.close()
+
+        with patch(f'loader.{writer}', recording):
+            loader.bulk_load(self.dir, resume=True, chunk_rows=3)
+
+        # only the messages that hadn't been committed were sent again
+        self.assertEqual(written, ['4', '5', '6', '7'])
+
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual([(message.id, message.text) for message in
+                          Message.query.order_by(Message.id)],
+                         [(i, f'message {i}') for i in range(1, 8)])
+        self.assertEqual(User.query.get(1).following_count, 2)
+
+    def test_unknown_columns(self):
+        """ a CSV naming a column its table doesn't have loads nothing """
+
+        write_csv(self.dir, 'follows',
+                  ['followee_id', 'follower_id', 'is_admin'],
+                  [[1, 2, 't']])
+
+        with self.assertRaisesRegex(ValueError, 'is_admin'):
+            loader.bulk_load(self.dir)
+
+        # (nothing was dropped or loaded)
+        self.assertFalse(db.engine.has_table('users'))
@@ -5,10 +5,18 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import gzip
 import os
+import re
+import time
+from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, connect_db, User, Message, Like, FollowersFollowee
+from sqlalchemy import select
+
+from models import (db, connect_db, User, Message, Like, Comment,
+                    FollowersFollowee, TimelineEntry)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -17,10 +25,24 @@ from models import db, connect_db, User, Message, Like, FollowersFollowee
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
+# ... and a second one, standing in for a read replica
+REPLICA_URL = "postgresql:///warbler-test-replica"
+
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from caching import COMMENTERS_MAX_AGE  # noqa: E402
+from counters import reconcile_counters  # noqa: E402
+import timeline as timeline_module  # noqa: E402
+from timeline import (rebuild_timelines, trim_all_timelines,  # noqa: E402
+                      TIMELINE_LENGTH)
+from graph import social_graph  # noqa: E402
+from identity import identity_cache  # noqa: E402
+from instrumentation import sql_stats  # noqa: E402
+import replicas as replicas_module  # noqa: E402
+from replicas import replicas  # noqa: E402
+from writebehind import write_behind  # noqa: E402
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,6 +54,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Write likes / follows synchronously, so tests can check the database
+
+app.config['WRITE_BEHIND_WINDOW'] = 0
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -84,6 +110,14 @@ class MessageViewTestCase(TestCase):
             db.session.add(ff)
 
         db.session.commit()
+
+        # the rows above bypass the counter bookkeeping in counters.py
+        reconcile_counters()
+        db.session.commit()
+
+        # users from earlier tests may still be cached
+        identity_cache.clear()
+
         self.testuser = User.query.get(1)
 
         self.client = app.test_client()
@@ -134,12 +168,637 @@ class MessageViewTestCase(TestCase):
 
         # test that we cannot delete other user's messgae
         resp3 = c.post("/messages/2/delete")
-        self.assertEqual(resp3.status_code, 401)
+        self.assertEqual(resp3.status_code, 403)
+
+        # nor one that isn't there
+        resp4 = c.post("/messages/99999999/delete")
+        self.assertEqual(resp4.status_code, 404)
 
         # test that we can no longer access aforementioned message
         resp2 = c.get("/messages/2")
         self.assertEqual(resp2.status_code, 200)
 
+    def test_home_timeline(self):
+        """ new messages fan out to followers; unfollowing trims them """
+
+        # testuser0 (user 1) follows testuser1 (user 2)
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            c.post("/messages/new", data={"text": "fanned out"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.get("/")
+            self.assertIn(b"fanned out", resp.data)
+
+            # (following nobody now, so there's nothing to query for)
+            c.post("/users/follow/2")
+            with patch('app.feed_query') as feed_query:
+                resp = c.get("/")
+            feed_query.assert_not_called()
+            self.assertNotIn(b"fanned out", resp.data)
+            self.assertEqual(resp.status_code, 200)
+
+            c.post("/users/follow/2")
+            resp = c.get("/")
+            self.assertIn(b"fanned out", resp.data)
+
+    def test_timeline_length(self):
+        """ timelines keep only their newest entries, when messages fan out
+        and when they're rebuilt """
+
+        entries = TimelineEntry.__table__
+        rebuild_timelines()
+
+        def timeline(user_id):
+            return [row[0] for row in db.session.execute(
+                select([entries.c.message_id])
+                .where(entries.c.user_id == user_id)
+                .order_by(entries.c.timestamp.desc(),
+                          entries.c.message_id.desc()))]
+
+        timeline_module.TIMELINE_LENGTH = 3
+        try:
+            # testuser0 (user 1) follows testuser1 (user 2)
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 2
+                for i in range(4):
+                    c.post("/messages/new", data={"text": f"newer {i}"})
+
+            posted = [msg.id for msg in Message.query
+                      .filter(Message.text.like("newer %"))
+                      .order_by(Message.id.desc())]
+            newest = posted[:3]
+
+            # (posting doesn't trim; the periodic trim does)
+            self.assertEqual(timeline(1)[:4], posted)
+            self.assertEqual(trim_all_timelines(batch_size=2), 2)
+            self.assertEqual(timeline(1), newest)
+            self.assertEqual(timeline(2), newest)
+
+            rebuild_timelines(batch_size=2)
+            self.assertEqual(timeline(1), newest)
+            self.assertTrue(all(len(timeline(id)) <= 3 for id in range(1, 7)))
+            self.assertEqual(timeline(6), [6])
+
+        finally:
+            timeline_module.TIMELINE_LENGTH = TIMELINE_LENGTH
+
+    def test_profile_pagination(self):
+        """ profile feed pages with a cursor, even when timestamps tie """
+
+        same_time = datetime(2019, 1, 1)
+        for i in range(25):
+            db.session.add(Message(text=f"paged {i}", user_id=1,
+                                   timestamp=same_time))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/users/1")
+            self.assertEqual(resp.status_code, 200)
+            cursor = re.search(r'data-cursor="([^"]+)"', resp.data.decode())
+            self.assertIsNotNone(cursor)
+
+            resp2 = c.get(f"/users/1?before={cursor.group(1)}&partial=1")
+            self.assertEqual(resp2.status_code, 200)
+            self.assertNotIn("X-Next-Cursor", resp2.headers)
+
+            # every message shows up exactly once across the two pages
+            seen = re.findall(r"paged \d+",
+                              resp.data.decode() + resp2.data.decode())
+            self.assertEqual(len(seen), 25)
+            self.assertEqual(len(set(seen)), 25)
+
+            resp3 = c.get("/users/1?before=garbage")
+            self.assertEqual(resp3.status_code, 400)
+
+    def test_streamed_feeds(self):
+        """ feed pages are sent in pieces: the page shell before any
+        messages, then the messages a chunk at a time """
+
+        for i in range(25):
+            db.session.add(Message(text=f"streamed {i}", user_id=1))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+                sess["_flashes"] = [("success", "Hello again")]
+
+            resp = c.get("/users/1")
+            self.assertTrue(resp.is_streamed)
+            pieces = [piece.decode() for piece in resp.response]
+            resp.close()
+
+            self.assertIn('id="messages"', pieces[0])
+            self.assertNotIn("streamed", pieces[0])
+            self.assertIn("Hello again", pieces[0])
+
+            page = "".join(pieces)
+            self.assertEqual(len(re.findall(r"streamed \d+", page)), 20)
+            self.assertIn('data-cursor="', page)
+
+            # the flash was consumed, even though the session was saved
+            # before the page was rendered
+            self.assertNotIn("Hello again", c.get("/users/1").data.decode())
+
+    def test_compression(self):
+        """ pages and large JSON are gzipped for clients that accept it;
+        JSON is compact, with ISO timestamps """
+
+        for i in range(25):
+            db.session.add(Comment(text=f"comment number {i}", user_id=2,
+                                   message_id=3))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            gzipped = {"Accept-Encoding": "gzip"}
+
+            resp = c.get("/users/1", headers=gzipped)
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+            self.assertIn(b"I love numer 0", gzip.decompress(resp.data))
+
+            resp = c.get("/messages/3/comments", headers=gzipped)
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            page = gzip.decompress(resp.data).decode()
+            self.assertNotIn(", ", page.replace("comment number", ""))
+            self.assertRegex(page,
+                             r'"timestamp":"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d"')
+
+            # too small to be worth it
+            resp = c.post("/messages/comments",
+                          json={"msgId": 3, "text": "hi"}, headers=gzipped)
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertRegex(resp.json["timestamp"],
+                             r"^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d$")
+
+            resp = c.post("/messages/comments",
+                          json={"msgId": 99999999, "text": "hi"})
+            self.assertEqual(resp.status_code, 404)
+            resp = c.post("/messages/comments", json={"msgId": "three"})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.get("/users/1")
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+            # pages that echo the search aren't (BREACH)
+            resp = c.get("/messages/search?q=numer", headers=gzipped)
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_assets(self):
+        """ pages link minified bundles with hashed names, served
+        precompressed and cached for good """
+
+        resp = self.client.get("/signup")
+        html = resp.get_data(as_text=True)
+        css = re.search(r'href="(/assets/app\.\w{12}\.css)"', html).group(1)
+        js = re.search(r'src="(/assets/app\.\w{12}\.js)"', html).group(1)
+
+        resp = self.client.get(css)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "text/css")
+        self.assertEqual(resp.headers["Cache-Control"],
+                         "public, max-age=31536000, immutable")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        plain = resp.data
+        resp.close()
+
+        with open("static/stylesheets/style.css", "rb") as f:
+            self.assertLess(len(plain), len(f.read()))
+        self.assertNotIn(b"\n", plain)
+        self.assertRegex(plain,
+                         rb'url\("/static/images/nav-bg\.png\?v=\w{12}"\)')
+
+        resp = self.client.get(css, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertEqual(gzip.decompress(resp.data), plain)
+        resp.close()
+
+        resp = self.client.get(js, headers={"Accept-Encoding": "gzip"})
+        self.assertIn("javascript", resp.mimetype)
+        script = gzip.decompress(resp.data).decode()
+        resp.close()
+        self.assertNotIn("//remove li from dom", script)
+        self.assertIn("\n      <div class=\"card m-2\">", script)
+
+    def test_read_replicas(self):
+        """ feed pages read from a replica, except just after the user
+        writes or when the replica is behind """
+
+        replica = replicas.engine(REPLICA_URL)
+        db.metadata.drop_all(bind=replica)
+        db.metadata.create_all(bind=replica)
+
+        # the replica has everything, and a message the primary doesn't
+        with replica.begin() as conn:
+            for model in (User, Message):
+                table = model.__table__
+                rows = db.session.execute(table.select()).fetchall()
+                conn.execute(table.insert(), [dict(row) for row in rows])
+                # (copying the ids doesn't move the id sequence)
+                conn.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', "
+                    f"'id'), (SELECT max(id) FROM {table.name}))")
+            conn.execute(Message.__table__.insert().values(
+                text="only on the replica", user_id=2,
+                timestamp=datetime.utcnow()))
+
+        app.config['SQLALCHEMY_REPLICA_URIS'] = [REPLICA_URL]
+        before = replicas.stats()
+
+        # (lags are checked in the background; check once, now, and keep the
+        # checker from overwriting the lag set below)
+        replicas_module.LAG_CHECK_INTERVAL = 60
+        replicas.check_lags([REPLICA_URL])
+        try:
+            with self.client as c:
+                resp = c.get("/users/2")
+                self.assertIn(b"only on the replica", resp.data)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                # writes go to the primary ...
+                c.post("/like", json={"msg-id": 4})
+                self.assertIsNotNone(Like.query.get((self.testuser.id, 4)))
+
+                # ... and the writer's reads follow them there for a while
+                resp = c.get("/users/2")
+                self.assertNotIn(b"only on the replica", resp.data)
+
+                with c.session_transaction() as sess:
+                    sess["primary_until"] = time.time() - 1
+
+                resp = c.get("/users/2")
+                self.assertIn(b"only on the replica", resp.data)
+
+                # a replica that's too far behind isn't used
+                replicas.lags[REPLICA_URL] = (time.monotonic(), 60.0)
+                resp = c.get("/users/2")
+                self.assertNotIn(b"only on the replica", resp.data)
+
+            after = replicas.stats()
+            self.assertEqual(after["replica_requests"]
+                             - before["replica_requests"], 2)
+            self.assertEqual(after["sticky_requests"]
+                             - before["sticky_requests"], 1)
+            self.assertEqual(after["lagging_requests"]
+                             - before["lagging_requests"], 1)
+
+        finally:
+            app.config['SQLALCHEMY_REPLICA_URIS'] = []
+            replicas_module.LAG_CHECK_INTERVAL = 1
+            replicas.lags.clear()
+            db.session.close()
+            db.metadata.drop_all(bind=replica)
+
+    def test_feed_hydration(self):
+        """ feed rows show counts, liked flag and liker badges """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # testuser0 (user 1) likes message 2, written by user 2
+            resp = c.get("/users/2")
+            html = resp.data.decode()
+
+            self.assertIn('<span id="2-num-likes">1</span>', html)
+            self.assertIn('<span id="2-num-comments">0</span>', html)
+            self.assertRegex(html, r'id="like-2"[^>]*class="\s*fas')
+            self.assertIn('user-badge', html)
+
+    def test_counters(self):
+        """ counters follow likes, follows and posts; reconcile fixes drift """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/like", json={"msg-id": 3})
+            self.assertEqual(resp.json["likes"], 2)
+            self.assertEqual(resp.json["is-liked"], True)
+
+            c.post("/users/follow/3")
+            c.post("/messages/new", data={"text": "counted"})
+
+        user = User.query.get(1)
+        self.assertEqual(user.likes_count, 2)
+        self.assertEqual(user.following_count, 2)
+        self.assertEqual(user.messages_count, 2)
+        self.assertEqual(User.query.get(3).followers_count, 2)
+
+        User.query.get(1).messages_count = 99
+        db.session.commit()
+        self.assertEqual(reconcile_counters(), (1, 0))
+        db.session.commit()
+        self.assertEqual(User.query.get(1).messages_count, 2)
+
+    def test_viewer_state(self):
+        """ follow buttons reflect the viewer's follows """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # testuser0 (user 1) follows user 2 but not user 3
+            resp = c.get("/users/2")
+            self.assertIn(b">Unfollow</button>", resp.data)
+
+            resp = c.get("/users/3")
+            self.assertIn(b">Follow</button>", resp.data)
+
+            resp = c.post("/users/follow/3")
+            self.assertEqual(resp.json["isFollowing"], True)
+
+            resp = c.get("/users")
+            self.assertEqual(resp.data.count(b">Unfollow</button>"), 2)
+
+    def test_query_budgets(self):
+        """ the main routes stay within their declared query budgets """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # budgets are for requests that leave writes to the flusher
+            app.config['WRITE_BEHIND_WINDOW'] = 60
+            try:
+                # (streamed pages run some of their SQL as they're read)
+                with sql_stats.assert_within_budget() as requests:
+                    c.get("/").data
+                    c.get("/users/2").data
+                    c.get("/likes").data
+                    c.get("/messages/2")
+                    c.post("/like", json={"msg-id": 3})
+                    c.post("/users/follow/3")
+            finally:
+                app.config['WRITE_BEHIND_WINDOW'] = 0
+                write_behind.flush()
+
+            self.assertEqual(len(requests), 6)
+            self.assertTrue(all(queries.statements for queries in requests))
+
+            with self.assertRaises(AssertionError):
+                with sql_stats.assert_within_budget(budget=1):
+                    c.get("/").data
+
+    def test_metrics(self):
+        """ /metrics reports SQL per endpoint in Prometheus format, to
+        holders of the token """
+
+        sql_stats.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get("/users/2").data
+            c.get("/users/3").data
 
+            # off unless there's a token, and only for those who have it
+            self.assertEqual(c.get("/metrics").status_code, 404)
+
+            app.config['METRICS_TOKEN'] = "s3cret"
+            try:
+                self.assertEqual(c.get("/metrics").status_code, 401)
+                resp = c.get("/metrics",
+                             headers={"Authorization": "Bearer s3cret"})
+            finally:
+                app.config['METRICS_TOKEN'] = None
+            text = resp.data.decode()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(
+                'warbler_requests_total{endpoint="users_show"} 2', text)
+            self.assertIn(
+                'warbler_sql_statements_total{endpoint="users_show"}', text)
+            self.assertIn("warbler_password_hasher_workers", text)
+
+    def test_conditional_requests(self):
+        """ unchanged profiles and message JSON come back as 304s """
+
+        # (profiles change once the follows graph has loaded; see graph.py)
+        social_graph.rebuild()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/users/2")
+            etag = resp.headers["ETag"]
+            self.assertEqual(resp.headers["Cache-Control"],
+                             "private, no-cache")
+
+            resp = c.get("/users/2", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            # a like on user 2's message changes their profile
+            c.post("/like", json={"msg-id": 2})
+            resp = c.get("/users/2", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+            json_headers = {"Accept": "application/json"}
+            resp = c.get("/messages/3", headers=json_headers)
+            self.assertEqual(resp.json["comments"], [])
+            etag = resp.headers["ETag"]
+
+            resp = c.get("/messages/3",
+                         headers=dict(json_headers, **{"If-None-Match": etag}))
+            self.assertEqual(resp.status_code, 304)
+
+            c.post("/messages/comments", json={"msgId": 3, "text": "hi"})
+            resp = c.get("/messages/3",
+                         headers=dict(json_headers, **{"If-None-Match": etag}))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.json["comments"]), 1)
+            etag = resp.headers["ETag"]
+
+            # commenters' profile edits aren't in the stamp, but show once
+            # COMMENTERS_MAX_AGE has passed
+            User.query.get(self.testuser.id).version += 1
+            db.session.commit()
+            resp = c.get("/messages/3",
+                         headers=dict(json_headers, **{"If-None-Match": etag}))
+            self.assertEqual(resp.status_code, 304)
+
+            later = time.time() + COMMENTERS_MAX_AGE
+            with patch('caching.time.time', return_value=later):
+                resp = c.get("/messages/3",
+                             headers=dict(json_headers,
+                                          **{"If-None-Match": etag}))
+            self.assertEqual(resp.status_code, 200)
+
+            resp = c.get("/users/2/followers")
+            etag = resp.headers["ETag"]
+            resp = c.get("/users/2/followers", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_static_caching(self):
+        """ static URLs carry a content hash and are cached as immutable """
+
+        resp = self.client.get("/login")
+        url = re.search(r'src="(/static/images/warbler-logo\.png\?v=\w+)"',
+                        resp.data.decode())
+        self.assertIsNotNone(url)
+
+        resp = self.client.get(url.group(1))
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        resp.close()
+
+        resp = self.client.get("/static/app.js")
+        self.assertEqual(resp.headers["Cache-Control"], "no-cache")
+        resp.close()
+
+    def test_write_behind(self):
+        """ toggles are buffered, coalesced and flushed in one go """
+
+        app.config['WRITE_BEHIND_WINDOW'] = 60
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                # a double click never reaches the database
+                c.post("/like", json={"msg-id": 4})
+                resp = c.post("/like", json={"msg-id": 4})
+                self.assertEqual(resp.json["likes"], 1)
+                self.assertEqual(resp.json["is-liked"], False)
+                self.assertEqual(write_behind.stats()["pending"], 0)
+
+                resp = c.post("/like", json={"msg-id": 4})
+                self.assertEqual(resp.json["likes"], 2)
+                self.assertEqual(resp.json["is-liked"], True)
+
+                # a second submit made before the first was seen doesn't
+                # count the like again
+                with patch.object(write_behind, 'overlay', return_value={}):
+                    resp = c.post("/like", json={"msg-id": 4})
+                self.assertEqual(resp.json["likes"], 2)
+                self.assertEqual(resp.json["is-liked"], True)
+                etag = c.get("/users/4").headers["ETag"]
+                c.post("/users/follow/4")
+
+                # only the user's own toggles go into their ETags
+                self.assertEqual(write_behind.stamp(self.testuser.id),
+                                 ((("follow", 4), True), (("like", 4), True)))
+                self.assertIsNone(write_behind.stamp(2))
+
+                # the buffered state shows before it's written, and isn't
+                # hidden behind a 304
+                self.assertEqual(Like.query.filter_by(user_id=1).count(), 1)
+                resp = c.get("/users/4", headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(b">Unfollow</button>", resp.data)
+                self.assertRegex(resp.data.decode(),
+                                 r'id="like-4"[^>]*class="\s*fas')
+                self.assertIn(b'<span id="4-num-likes">2</span>', resp.data)
+
+        finally:
+            app.config['WRITE_BEHIND_WINDOW'] = 0
+            write_behind.flush()
+
+        self.assertEqual(write_behind.stats()["pending"], 0)
+        self.assertEqual(write_behind.pending_delta("like", 4), 0)
+        self.assertIsNone(write_behind.stamp(self.testuser.id))
+        self.assertEqual(Message.query.get(4).likes_count, 2)
+        self.assertEqual(User.query.get(1).following_count, 2)
+        self.assertEqual(User.query.get(4).followers_count, 2)
+        self.assertEqual(reconcile_counters(), (0, 0))
+
+    def test_comment_pages(self):
+        """ comment threads come a page at a time, authors sent once """
+
+        for i in range(25):
+            db.session.add(Comment(text=f"comment {i}", user_id=i % 2 + 1,
+                                   message_id=3))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with sql_stats.assert_within_budget():
+                resp = c.get("/messages/3",
+                             headers={"Accept": "application/json"})
+
+            first = resp.json
+            self.assertEqual(first["username"], "testuser2")
+            self.assertEqual(len(first["comments"]), 20)
+            self.assertEqual(set(first["users"]), {"1", "2"})
+            self.assertEqual(first["users"]["1"]["username"], "testuser0")
+
+            with sql_stats.assert_within_budget():
+                resp = c.get("/messages/3/comments",
+                             query_string={"before": first["next_cursor"]})
+
+            rest = resp.json
+            self.assertEqual(len(rest["comments"]), 5)
+            self.assertIsNone(rest["next_cursor"])
+
+            texts = [comment["text"]
+                     for comment in first["comments"] + rest["comments"]]
+            self.assertEqual(len(set(texts)), 25)
+
+    def test_follow_lists(self):
+        """ follows lists page, and flag who follows whom in one query """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            # user 2 follows user 1 back
+            c.post("/users/follow/1")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
 
-            
+            # user 3's only follower is user 2, whom user 1 follows
+            with sql_stats.assert_within_budget():
+                resp = c.get("/users/3/followers")
+            html = resp.data.decode()
+            self.assertIn("@testuser1", html)
+            self.assertIn("Follows you", html)
+            self.assertIn(
+                'class="follow-btn btn btn-primary btn-sm">Unfollow', html)
+
+            resp = c.get("/users/3/mutual")
+            self.assertIn("@testuser1", resp.data.decode())
+
+            resp = c.get("/users/4/mutual")
+            self.assertIn("No followers in common", resp.data.decode())
+
+            # 25 more followers for user 6, over two pages
+            # (users flushed first: nothing orders these inserts for us)
+            for i in range(25):
+                db.session.add(User(id=100 + i, email=f"fan{i}@test.com",
+                                    username=f"fan{i}", password="x"))
+            db.session.flush()
+            for i in range(25):
+                db.session.add(FollowersFollowee(followee_id=100 + i,
+                                                 follower_id=6))
+            db.session.commit()
+
+            resp = c.get("/users/6/followers")
+            html = resp.data.decode()
+            self.assertEqual(html.count('class="card-link"'), 20)
+            more = re.search(r'href="(/users/6/followers\?after=\d+)"', html)
+
+            resp = c.get(more.group(1))
+            html2 = resp.data.decode()
+            self.assertEqual(html2.count('class="card-link"'), 6)
+            self.assertNotIn("?after=", html2)
@@ -0,0 +1,287 @@
+"""Schema migration and query plan tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_migrations.py
+
+
+import os
+import random
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import (MetaData, Table, Column, Integer, String, Text,
+                        DateTime, ForeignKey, event, inspect)
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from counters import reconcile_counters  # noqa: E402
+from identity import identity_cache  # noqa: E402
+from timeline import rebuild_timelines  # noqa: E402
+import migrate  # noqa: E402
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Write likes / follows synchronously, so their SQL is explained too
+
+app.config['WRITE_BEHIND_WINDOW'] = 0
+
+# the schema before migrations
+baseline = MetaData()
+
+Table('users', baseline,
+      Column('id', Integer, primary_key=True),
+      Column('email', Text, nullable=False, unique=True),
+      Column('username', Text, nullable=False, unique=True),
+      Column('image_url', Text),
+      Column('header_image_url', Text),
+      Column('bio', Text),
+      Column('location', Text),
+      Column('password', Text, nullable=False))
+
+Table('messages', baseline,
+      Column('id', Integer, primary_key=True),
+      Column('text', String(140), nullable=False),
+      Column('timestamp', DateTime, nullable=False),
+      Column('user_id', Integer,
+             ForeignKey('users.id', ondelete='CASCADE'), nullable=False))
+
+Table('follows', baseline,
+      Column('followee_id', Integer,
+             ForeignKey('users.id', ondelete='cascade'), primary_key=True),
+      Column('follower_id', Integer,
+             ForeignKey('users.id', ondelete='cascade'), primary_key=True))
+
+Table('likes', baseline,
+      Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+      Column('message_id', Integer, ForeignKey('messages.id'),
+             primary_key=True))
+
+Table('comments', baseline,
+      Column('id', Integer, primary_key=True),
+      Column('text', String(140), nullable=False),
+      Column('timestamp', DateTime, nullable=False),
+      Column('user_id', Integer,
+             ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+      Column('message_id', Integer,
+             ForeignKey('messages.id', ondelete='CASCADE'), nullable=False))
+
+# tables big enough that a sequential scan of one is a regression
+INDEXED_TABLES = {'messages', 'timeline_entries', 'likes', 'comments',
+                  'follows'}
+
+# SQLite plans say "SCAN <table>" for a full scan, "SCAN <table> USING ..."
+# for an index scan
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+
+def drop_everything():
+    db.session.close()
+    db.drop_all()
+    migrate.versions.drop_all(bind=db.engine)
+
+
+def seq_scans(conn, statement, parameters):
+    """Names of the tables the plan for `statement` reads sequentially."""
+
+    cursor = conn.connection.cursor()
+
+    if conn.dialect.name == 'postgresql':
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+        # (psycopg2 parses the JSON)
+        plan = cursor.fetchone()[0]
+
+        found = set()
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node['Node Type'] == 'Seq Scan':
+                found.add(node['Relation Name'])
+            nodes += node.get('Plans', [])
+        return found
+
+    cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+    return {match.group(1) for *_, detail in cursor.fetchall()
+            for match in [SQLITE_SCAN.match(detail)] if match}
+
+
+@contextmanager
+def captured_statements():
+    """Collect the (statement, parameters) this thread runs meanwhile (not,
+    say, the social graph loading itself in the background)."""
+
+    statements = []
+    thread = threading.get_ident()
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and threading.get_ident() == thread:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+
+class MigrationTestCase(TestCase):
+    """Test the migrations and the query plans they're for."""
+
+    def setUp(self):
+        drop_everything()
+        identity_cache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        drop_everything()
+
+    def test_new_database(self):
+        """ a new database gets the current schema, recorded as up to date """
+
+        self.assertEqual(migrate.upgrade(log=lambda message: None), [])
+        self.assertEqual(migrate.pending(db.engine), [])
+
+        # the models declare the indexes the migrations create
+        indexes = {index['name']
+                   for table in INDEXED_TABLES
+                   for index in inspect(db.engine).get_indexes(table)}
+        expected = migrate.discover()[-1].module.INDEXES
+        self.assertLessEqual({name for name, _, _ in expected}, indexes)
+
+    def test_upgrade_from_baseline(self):
+        """ a database from before migrations is brought up to date, with
+        its counters and timelines filled in """
+
+        baseline.create_all(bind=db.engine)
+        now = datetime.utcnow()
+
+        with db.engine.begin() as conn:
+            for id in (1, 2, 3):
+                conn.execute(baseline.tables['users'].insert().values(
+                    id=id, email=f'{id}@test.com', username=f'user{id}',
+                    password='HASHED_PASSWORD'))
+            for id in (1, 2, 3):
+                conn.execute(baseline.tables['messages'].insert().values(
+                    id=id, text=f'message {id}', timestamp=now, user_id=2))
+            # user 1 follows user 2
+            conn.execute(baseline.tables['follows'].insert().values(
+                followee_id=1, follower_id=2))
+            conn.execute(baseline.tables['likes'].insert().values(
+                user_id=1, message_id=3))
+
+        applied = migrate.upgrade(log=lambda message: None)
+        self.assertEqual([migration.version for migration in applied],
+                         [migration.version
+                          for migration in migrate.discover()])
+
+        columns = {column['name']
+                   for column in inspect(db.engine).get_columns('users')}
+        self.assertLessEqual({'messages_count', 'followers_count', 'version'},
+                             columns)
+
+        with db.engine.connect() as conn:
+            self.assertEqual(
+                conn.execute("SELECT messages_count, followers_count "
+                             "FROM users WHERE id = 2").first(), (3, 1))
+            self.assertEqual(
+                conn.execute("SELECT likes_count FROM messages "
+                             "WHERE id = 3").scalar(), 1)
+            self.assertEqual(
+                conn.execute("SELECT count(*) FROM timeline_entries "
+                             "WHERE user_id = 1").scalar(), 3)
+
+        indexes = {index['name']
+                   for index in inspect(db.engine).get_indexes('messages')}
+        self.assertIn('ix_messages_user_id_timestamp', indexes)
+
+        # and there's nothing left to do
+        self.assertEqual(migrate.upgrade(log=lambda message: None), [])
+
+        # the app works against the migrated schema
+        db.session.execute("INSERT INTO suggested_follows "
+                           "(user_id, suggested_id, score, via) "
+                           "VALUES (1, 3, 1.0, 0)")
+        db.session.commit()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            resp = c.get("/")
+            self.assertIn(b"message 3", resp.data)
+
+    def test_no_sequential_scans(self):
+        """ the hot routes' SQL uses indexes on a large dataset """
+
+        migrate.upgrade(log=lambda message: None)
+
+        rng = random.Random(23)
+        users, per_user = 1000, 30
+        now = datetime.utcnow()
+
+        tables = db.metadata.tables
+        db.session.execute(tables['users'].insert(), [
+            {'id': id, 'email': f'{id}@test.com', 'username': f'user{id}',
+             'password': 'HASHED_PASSWORD'}
+            for id in range(1, users + 1)])
+        db.session.execute(tables['messages'].insert(), [
+            {'id': id, 'text': f'message {id}', 'user_id': id % users + 1,
+             'timestamp': now - timedelta(minutes=id)}
+            for id in range(1, users * per_user + 1)])
+        db.session.execute(tables['follows'].insert(), [
+            {'followee_id': id, 'follower_id': followed}
+            for id in range(1, users + 1)
+            for followed in rng.sample(range(1, users + 1), 20)
+            if followed != id])
+        db.session.execute(tables['likes'].insert(), [
+            {'user_id': id, 'message_id': message_id}
+            for id in range(1, users + 1)
+            for message_id in rng.sample(range(1, users * per_user), 30)])
+        db.session.execute(tables['comments'].insert(), [
+            {'text': 'nice', 'user_id': rng.randint(1, users),
+             'message_id': rng.randint(1, users * per_user),
+             'timestamp': now}
+            for _ in range(10000)])
+
+        reconcile_counters()
+        rebuild_timelines()
+        db.session.commit()
+        db.session.execute("ANALYZE")
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            with captured_statements() as statements:
+                c.get("/").data
+                c.get("/users/2").data
+                c.get("/likes").data
+                c.post("/like", json={"msg-id": 40})
+
+        self.assertTrue(statements)
+
+        with db.engine.connect() as conn:
+            for statement, parameters in statements:
+                if not statement.lstrip().upper().startswith(
+                        ('SELECT', 'UPDATE', 'DELETE', 'WITH')):
+                    continue
+
+                scanned = seq_scans(conn, statement, parameters)
+                self.assertFalse(scanned & INDEXED_TABLES,
+                                 f"sequential scan of {scanned} in\n"
+                                 f"{statement}")
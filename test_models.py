@@ -6,9 +6,13 @@
 
 
 import os
+import tempfile
+import time
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
 from models import db, User, Message, Like, FollowersFollowee
+import passwords
+from passwords import hasher, hash_cost, PasswordHasher, HasherBusy
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -123,6 +127,55 @@ class UserModelTestCase(TestCase):
         self.assertEqual(User.authenticate("testuser1", "HASHED_PASSWORD"), user_2)
         self.assertEqual(User.authenticate("testuser0", "BAD_PASS"), False)
 
+    def test_rehash_on_login(self):
+        """ logging in re-hashes passwords made with an old work factor """
+
+        user_1 = User.query.get(1)
+        self.assertEqual(hash_cost(user_1.password), hasher.rounds)
+
+        old_rounds = hasher.rounds
+        hasher.rounds = 4
+        try:
+            self.assertEqual(
+                User.authenticate("testuser0", "HASHED_PASSWORD"), user_1)
+            self.assertEqual(hash_cost(user_1.password), 4)
+            self.assertEqual(
+                User.authenticate("testuser0", "HASHED_PASSWORD"), user_1)
+        finally:
+            hasher.rounds = old_rounds
+
+    def test_hasher_slots(self):
+        """ hashes wait for a machine-wide slot, or give up with HasherBusy """
+
+        for workers in (0, 1):
+            with tempfile.TemporaryDirectory() as lock_dir:
+                busy = PasswordHasher(rounds=4, workers=workers, slots=1,
+                                      lock_dir=lock_dir)
+                # (start the pool first, so its process doesn't inherit
+                # the slot held below)
+                busy.hash("password")
+
+                other_worker = passwords.Slots(1, lock_dir)
+                held = other_worker.acquire(time.monotonic())
+
+                old_timeout = passwords.HASH_TIMEOUT
+                passwords.HASH_TIMEOUT = 0.2
+                try:
+                    with self.assertRaises(HasherBusy):
+                        busy.hash("password")
+                finally:
+                    passwords.HASH_TIMEOUT = old_timeout
+                    other_worker.release(held)
+
+                try:
+                    self.assertEqual(hash_cost(busy.hash("password")), 4)
+                finally:
+                    busy.shutdown()
+
+                stats = busy.stats()
+                self.assertEqual((stats['queued'], stats['completed'],
+                                  stats['rejected']), (0, 2, 1))
+
     def test_like_model(self):
         """Does basic model Like work?"""
 
@@ -0,0 +1,472 @@
+"""User View tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_user_views.py
+
+
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from io import BytesIO
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, FollowersFollowee
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from counters import reconcile_counters  # noqa: E402
+from search import search_index  # noqa: E402
+from identity import Identity, IdentityCache, identity_cache  # noqa: E402
+from instrumentation import sql_stats  # noqa: E402
+from recommendations import (suggest,  # noqa: E402
+                             precompute_suggestions, stored_suggestions)
+from graph import Adjacency, social_graph  # noqa: E402
+import images  # noqa: E402
+from images import Image, image_proxy, image_type  # noqa: E402
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Write likes / follows synchronously, so tests can check the database
+
+app.config['WRITE_BEHIND_WINDOW'] = 0
+
+
+def png(width, height):
+    """A plain grey PNG (without needing Pillow)."""
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data)))
+
+    rows = b''.join(b'\0' + b'\x80' * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                         8, 0, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows))
+            + chunk(b'IEND', b''))
+
+
+class UserViewTestCase(TestCase):
+    """Test views for users."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.create_all()
+
+        usernames = ["robin", "robert", "bobby", "wren", "sparrow"]
+
+        for i, username in enumerate(usernames):
+
+            u = User.signup(
+                email=f"test{i}@test.com",
+                username=username,
+                password="HASHED_PASSWORD",
+                image_url="/static/images/default-pic.png"
+            )
+            db.session.add(u)
+        db.session.commit()
+
+        User.query.get(4).bio = "I sing like a robin"
+
+        db.session.add(Message(text="Spring is here, the robins are back",
+                               user_id=1))
+        db.session.add(Message(text="Nothing to see here", user_id=2))
+
+        db.session.add(FollowersFollowee(followee_id=1, follower_id=2))
+        db.session.commit()
+
+        reconcile_counters()
+        db.session.commit()
+
+        # every test starts from a fresh database, so start fresh caches
+        search_index.rebuild()
+        identity_cache.clear()
+
+        self.testuser = User.query.get(1)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+
+        db.session.close()
+        db.drop_all(bind=None)
+
+    def test_search_users(self):
+        """ search is ranked, tolerates typos, and matches bios """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/users?q=robin")
+            html = resp.data.decode()
+
+            # exact username first, then the bio match; no unrelated users
+            self.assertLess(html.index("@robin"), html.index("@wren"))
+            self.assertNotIn("@sparrow", html)
+
+            resp = c.get("/users?q=robrt")
+            self.assertIn("@robert", resp.data.decode())
+
+    def test_search_index_retry(self):
+        """ a failed load of the search index isn't retried straight away """
+
+        failing = patch.object(search_index, 'rebuild',
+                               side_effect=RuntimeError("database down"))
+        search_index.built_at = None
+
+        with app.app_context(), failing as rebuild:
+            for _ in range(3):
+                search_index.ready()
+                thread = search_index.building
+                if thread:
+                    thread.join()
+
+        self.assertEqual(rebuild.call_count, 1)
+        self.assertIsNotNone(search_index.failed_at)
+
+        # (so the next test's setUp loads it again)
+        search_index.failed_at = None
+
+    def test_search_messages(self):
+        """ message search finds text and picks up new messages """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/messages/search?q=robins")
+            self.assertIn(b"the robins are back", resp.data)
+            self.assertNotIn(b"Nothing to see", resp.data)
+
+            c.post("/messages/new", data={"text": "Robins everywhere"})
+            resp = c.get("/messages/search?q=robins")
+            self.assertIn(b"Robins everywhere", resp.data)
+
+            # too common to find messages by, but they still count towards
+            # the scores of those the rarer trigrams find
+            with patch("search.MAX_POSTINGS", 1):
+                resp = c.get("/messages/search?q=robins+everyw")
+            self.assertIn(b"Robins everywhere", resp.data)
+
+    def test_autocomplete(self):
+        """ autocomplete matches username prefixes, including new users """
+
+        resp = self.client.get("/users/autocomplete?q=rob")
+        self.assertEqual([u["username"] for u in resp.json],
+                         ["robert", "robin"])
+
+        self.client.post("/signup", data={"username": "robot",
+                                          "password": "password",
+                                          "email": "robot@test.com"})
+
+        resp = self.client.get("/users/autocomplete?q=rob")
+        self.assertEqual([u["username"] for u in resp.json],
+                         ["robert", "robin", "robot"])
+
+    def test_list_users_pages(self):
+        """ listing without a query is paged by id """
+
+        resp = self.client.get("/users?after=3")
+        html = resp.data.decode()
+
+        self.assertNotIn("@robin", html)
+        self.assertIn("@wren", html)
+        self.assertIn("@sparrow", html)
+
+    def test_identity_cache_invalidation(self):
+        """ editing your profile refreshes your cached identity """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get("/")
+            self.assertIsNotNone(identity_cache.get(1))
+
+            c.post("/users/profile", data={"username": "robin2",
+                                           "email": "test0@test.com",
+                                           "password": "HASHED_PASSWORD"})
+            self.assertIsNone(identity_cache.get(1))
+
+            resp = c.get("/")
+            self.assertIn(b"@robin2", resp.data)
+
+    def test_identity_cache_lru(self):
+        """ the identity cache evicts least recently used and stale entries """
+
+        cache = IdentityCache(size=2, ttl=60)
+        for user in User.query.order_by(User.id).limit(3):
+            cache.put(Identity.of(user))
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(3).username, "bobby")
+
+        expired = IdentityCache(ttl=-1)
+        expired.put(Identity.of(self.testuser))
+        self.assertIsNone(expired.get(1))
+
+    def test_who_to_follow(self):
+        """ suggestions are friends of friends, ranked by overlap, and kept
+        up to date as people follow """
+
+        # robin follows robert and bobby; both follow wren, robert follows
+        # sparrow
+        # (in `follows`, followee_id is the follower; see models.py)
+        for followee_id, follower_id in [(1, 3), (2, 4), (2, 5), (3, 4)]:
+            db.session.add(FollowersFollowee(followee_id=followee_id,
+                                             follower_id=follower_id))
+        db.session.commit()
+        social_graph.rebuild()
+
+        self.assertEqual([id for id, _, _ in suggest(1)], [4, 5])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with sql_stats.assert_within_budget():
+                resp = c.get("/users/suggestions")
+            html = resp.data.decode()
+            self.assertLess(html.index("@wren"), html.index("@sparrow"))
+            self.assertIn("Followed by 2 people you follow", html)
+            self.assertNotIn("@bobby", html)
+
+            c.post("/users/follow/4")
+            resp = c.get("/users/suggestions")
+            self.assertNotIn("@wren", resp.data.decode())
+            self.assertIn("@sparrow", resp.data.decode())
+
+        precompute_suggestions()
+        db.session.commit()
+        self.assertEqual([id for id, _, _ in stored_suggestions(1)], [5])
+
+        # nobody to go on but the people who follow wren
+        self.assertEqual([id for id, _, _ in stored_suggestions(4)],
+                         [1, 2, 3])
+
+    def test_social_graph(self):
+        """ the follows graph answers from its arrays and overlay, and keeps
+        up with follows, unfollows and deleted users """
+
+        adjacency = Adjacency([3, 1, 3, 1], [9, 5, 2, 7])
+        adjacency.add(1, 6)
+        adjacency.remove(1, 7)
+
+        self.assertEqual(list(adjacency.neighbours_of(1)), [5, 6])
+        self.assertEqual(list(adjacency.neighbours_of(3, after=2)), [9])
+        self.assertEqual(adjacency.degree(1), 2)
+
+        # robin, bobby and wren follow robert; robin and wren follow sparrow
+        # (in `follows`, followee_id is the follower; see models.py)
+        for followee_id, follower_id in [(3, 2), (4, 2), (1, 5), (4, 5)]:
+            db.session.add(FollowersFollowee(followee_id=followee_id,
+                                             follower_id=follower_id))
+        db.session.commit()
+        social_graph.rebuild()
+
+        self.assertTrue(social_graph.is_following(1, 2))
+        self.assertFalse(social_graph.is_following(2, 1))
+        self.assertEqual(social_graph.followers_count(2), 3)
+        self.assertEqual(social_graph.following_ids(1), [2, 5])
+        self.assertEqual(social_graph.following_ids(2), [])
+        self.assertEqual(social_graph.followers_ids(2, after=1, limit=1), [3])
+        self.assertEqual(social_graph.common_followers(2, 5), [1, 4])
+        self.assertEqual(social_graph.most_followed(1), [2])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 5
+
+            c.post("/users/follow/2")
+            self.assertEqual(social_graph.followers_ids(2), [1, 3, 4, 5])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 4
+
+            c.post("/users/follow/2")
+            c.post("/users/delete")
+
+        self.assertEqual(social_graph.followers_ids(2), [1, 3, 5])
+        self.assertEqual(social_graph.common_followers(2, 5), [1])
+        self.assertEqual(social_graph.following_count(4), 0)
+
+        # robin follows sparrow, who now follows robert
+        self.assertEqual(social_graph.followees_following(1, 2), [5])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.get("/users/2")
+            self.assertIn("Followed by 1 person you follow",
+                          resp.data.decode())
+
+        # a user deleted while the graph is reloading stays deleted
+        execute = db.session.execute
+
+        def load_then_delete(*args, **kwargs):
+            rows = execute(*args, **kwargs).fetchall()
+            social_graph.remove_user(3)
+            return rows
+
+        with patch.object(db.session, 'execute', load_then_delete):
+            social_graph.rebuild()
+
+        self.assertEqual(social_graph.followers_ids(2), [1, 5])
+
+    def test_image_proxy(self):
+        """ pictures are fetched once through the proxy, resized, cached on
+        disk (least recently used evicted first) and by the browser """
+
+        origin = tempfile.mkdtemp()
+        cache = tempfile.mkdtemp()
+        for name, size in [("big.png", 800), ("other.png", 600)]:
+            with open(os.path.join(origin, name), "wb") as f:
+                f.write(png(size, size))
+
+        fetched = []
+        hosts = []
+
+        class Origin(SimpleHTTPRequestHandler):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=origin, **kwargs)
+
+            def log_message(self, *args):
+                fetched.append(self.path)
+                hosts.append(self.headers["Host"])
+
+        server = HTTPServer(("127.0.0.1", 0), Origin)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}"
+
+        app.config.update(IMAGE_CACHE_DIR=cache,
+                          IMAGE_PROXY_ALLOW_PRIVATE=True)
+        try:
+            user = User.query.get(1)
+            user.image_url = f"{base}/big.png"
+            user.header_image_url = f"{base}/missing.png"
+            db.session.commit()
+            identity_cache.clear()
+
+            page = self.client.get("/users/1").get_data(as_text=True)
+            avatar = re.search(r'src="(/images/avatar/[^"]+)"', page).group(1)
+            header = re.search(r'src="(/images/header/[^"]+)"', page).group(1)
+            self.assertNotIn(base, page)
+
+            resp = self.client.get(avatar.replace("&amp;", "&"))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, image_type(resp.data))
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertEqual(Image.open(BytesIO(resp.data)).size, (400, 400))
+            resp.close()
+
+            resp = self.client.get(avatar.replace("&amp;", "&"))
+            self.assertEqual(resp.status_code, 200)
+            resp.close()
+            self.assertEqual(fetched.count("/big.png"), 1)
+
+            # a broken picture falls back to the default
+            resp = self.client.get(header.replace("&amp;", "&"))
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn("/static/images/warbler-hero.jpg", resp.location)
+
+            # only URLs the app signed are fetched
+            resp = self.client.get(f"/images/avatar/0000000000000000"
+                                   f"?url={base}/other.png")
+            self.assertEqual(resp.status_code, 404)
+
+            # private addresses aren't, unless allowed
+            app.config["IMAGE_PROXY_ALLOW_PRIVATE"] = False
+            User.query.get(1).image_url = f"{base}/other.png"
+            db.session.commit()
+            identity_cache.clear()
+
+            page = self.client.get("/users/1").get_data(as_text=True)
+            avatar = re.search(r'src="(/images/avatar/[^"]+)"', page).group(1)
+            resp = self.client.get(avatar.replace("&amp;", "&"))
+            self.assertEqual(resp.status_code, 302)
+            self.assertNotIn("/other.png", fetched)
+
+            # a cache with room for one picture keeps the newest
+            image_proxy.failed.clear()
+            app.config.update(IMAGE_PROXY_ALLOW_PRIVATE=True,
+                              IMAGE_CACHE_SIZE=1)
+            resp = self.client.get(avatar.replace("&amp;", "&"))
+            self.assertEqual(resp.status_code, 200)
+            resp.close()
+
+            self.assertEqual(sum(len(files) for _, _, files in os.walk(cache)),
+                             1)
+            self.assertGreaterEqual(image_proxy.stats()["evicted"], 1)
+
+            # requests don't wait long for a picture, but get it once it's in
+            images.MISS_WAIT = 0
+            with app.test_request_context():
+                badge = images.img_url(f"{base}/big.png?again", "badge")
+            resp = self.client.get(badge)
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.headers["Cache-Control"], "no-store")
+            for loading in list(image_proxy.fetching.values()):
+                loading.result()
+            resp = self.client.get(badge)
+            self.assertEqual(resp.status_code, 200)
+            resp.close()
+
+            # only the newest MAX_FAILED failures are remembered
+            images.MAX_FAILED = 2
+            with image_proxy.lock:
+                for path in ("a", "b", "c"):
+                    image_proxy.remember_failure(path)
+            self.assertEqual(list(image_proxy.failed), ["b", "c"])
+
+            # fetches connect to the address that was checked, whatever the
+            # host resolves to by then, but still name the host
+            conn = images._PinnedHTTPConnection(
+                "pictures.invalid", server.server_port, address="127.0.0.1",
+                timeout=5)
+            conn.request("GET", "/other.png")
+            self.assertEqual(conn.getresponse().status, 200)
+            conn.close()
+            self.assertEqual(hosts[-1],
+                             f"pictures.invalid:{server.server_port}")
+
+            # and get FETCH_DEADLINE seconds in all
+            images.FETCH_DEADLINE = 0
+            with self.assertRaises(images.FetchError):
+                images.fetch(f"{base}/other.png", allow_private=True)
+
+        finally:
+            images.FETCH_DEADLINE = 15
+            images.MISS_WAIT = 2
+            images.MAX_FAILED = 10000
+            app.config.pop("IMAGE_CACHE_DIR")
+            app.config.update(IMAGE_PROXY_ALLOW_PRIVATE=False,
+                              IMAGE_CACHE_SIZE=256 * 1024 * 1024)
+            image_proxy.size = None
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(origin)
+            shutil.rmtree(cache)
@@ -0,0 +1,269 @@
+"""Materialized home timelines (fan-out-on-write).
+
+Every user has rows in `timeline_entries` for the recent messages of the
+people they follow, plus their own. Posting a message pushes it into the
+author's followers' timelines, and following / unfollowing backfills or trims
+the follower's timeline, so the homepage is a single bounded read. Timelines
+are cut back to their newest TIMELINE_LENGTH entries (so the homepage goes
+back that far, plus whatever celebrities posted), however long the user has
+been following people: after a backfill, on rebuilds, and by
+trim_all_timelines() (`flask trim-timelines`, run periodically), rather
+than on every post, which only ever adds one entry to each.
+
+Authors with CELEBRITY_FOLLOWERS or more followers are never fanned out (one
+post would mean that many writes); their messages are merged in when a
+timeline is read instead.
+"""
+
+from heapq import merge
+
+from sqlalchemy import select, literal, and_, exists, func, tuple_
+
+from models import db, User, FollowersFollowee, Message, TimelineEntry
+from pagination import older_than
+
+# entries kept per timeline
+TIMELINE_LENGTH = 800
+
+# how many of a followee's messages are copied in when you follow them
+BACKFILL_LENGTH = TIMELINE_LENGTH
+
+# users per transaction in rebuild_timelines() / trim_all_timelines()
+REBUILD_BATCH_USERS = 1000
+
+CELEBRITY_FOLLOWERS = 10000
+
+entries = TimelineEntry.__table__
+
+
+def is_celebrity(user_id):
+    """Is `user_id` followed by too many people to fan out to?"""
+
+    followers = (db.session
+                 .query(User.followers_count)
+                 .filter(User.id == user_id)
+                 .scalar())
+
+    return (followers or 0) >= CELEBRITY_FOLLOWERS
+
+
+def _ranked(rows):
+    """`rows` (user_id, message_id, timestamp) with each row's rank in its
+    user's timeline, newest first, as a subquery."""
+
+    rows = rows.alias('candidates')
+    rank = func.row_number().over(
+        partition_by=rows.c.user_id,
+        order_by=(rows.c.timestamp.desc(), rows.c.message_id.desc()))
+
+    return select([rows.c.user_id, rows.c.message_id, rows.c.timestamp,
+                   rank.label('rank')]).alias('ranked')
+
+
+def trim_timelines(users, length=None):
+    """Delete all but the newest `length` (default TIMELINE_LENGTH) entries
+    of the timelines of `users`, a condition on timeline_entries.user_id."""
+
+    length = length or TIMELINE_LENGTH
+
+    ranked = _ranked(select([entries.c.user_id, entries.c.message_id,
+                             entries.c.timestamp]).where(users))
+    stale = (select([ranked.c.user_id, ranked.c.message_id])
+             .where(ranked.c.rank > length))
+
+    db.session.execute(entries.delete().where(
+        tuple_(entries.c.user_id, entries.c.message_id).in_(stale)))
+
+
+def fan_out_message(msg):
+    """Push a new (flushed) message into its author's and followers'
+    timelines."""
+
+    db.session.execute(entries.insert().values(
+        user_id=msg.user_id,
+        message_id=msg.id,
+        timestamp=msg.timestamp,
+    ))
+
+    if is_celebrity(msg.user_id):
+        return
+
+    followers = (select([FollowersFollowee.followee_id,
+                         literal(msg.id),
+                         literal(msg.timestamp)])
+                 .where(and_(FollowersFollowee.follower_id == msg.user_id,
+                             FollowersFollowee.followee_id != msg.user_id)))
+
+    db.session.execute(entries.insert().from_select(
+        ['user_id', 'message_id', 'timestamp'], followers))
+
+
+def backfill_follow(user_id, followee_id):
+    """Copy `followee_id`'s recent messages into `user_id`'s timeline."""
+
+    if user_id == followee_id or is_celebrity(followee_id):
+        return
+
+    already_there = exists().where(and_(entries.c.user_id == user_id,
+                                        entries.c.message_id == Message.id))
+
+    recent = (select([literal(user_id), Message.id, Message.timestamp])
+              .where(and_(Message.user_id == followee_id, ~already_there))
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(BACKFILL_LENGTH))
+
+    db.session.execute(entries.insert().from_select(
+        ['user_id', 'message_id', 'timestamp'], recent))
+
+    trim_timelines(entries.c.user_id == user_id)
+
+
+def trim_unfollow(user_id, followee_id):
+    """Remove `followee_id`'s messages from `user_id`'s timeline."""
+
+    if user_id == followee_id:
+        return
+
+    followee_msgs = select([Message.id]).where(Message.user_id == followee_id)
+
+    db.session.execute(entries.delete().where(and_(
+        entries.c.user_id == user_id,
+        entries.c.message_id.in_(followee_msgs),
+    )))
+
+
+def _celebrity_followee_ids(user_id):
+    """Ids of the celebrities `user_id` follows (they're merged at read
+    time)."""
+
+    celebrities = (select([User.id])
+                   .select_from(FollowersFollowee.__table__.join(
+                       User.__table__,
+                       User.id == FollowersFollowee.follower_id))
+                   .where(and_(FollowersFollowee.followee_id == user_id,
+                               User.followers_count >= CELEBRITY_FOLLOWERS)))
+
+    return [row[0] for row in db.session.execute(celebrities)]
+
+
+def home_timeline_ids(user_id, limit, before=None):
+    """Ids of the newest `limit` messages on `user_id`'s home timeline.
+
+    If `before` is a (timestamp, id) cursor, start after that message.
+    """
+
+    stored = (select([entries.c.timestamp, entries.c.message_id])
+              .where(entries.c.user_id == user_id)
+              .order_by(entries.c.timestamp.desc(),
+                        entries.c.message_id.desc())
+              .limit(limit))
+
+    if before:
+        stored = stored.where(older_than(entries.c.timestamp,
+                                         entries.c.message_id,
+                                         before))
+
+    stored = db.session.execute(stored).fetchall()
+
+    celebrity_ids = _celebrity_followee_ids(user_id)
+    pulled = []
+
+    if celebrity_ids:
+        pulled = (select([Message.timestamp, Message.id])
+                  .where(Message.user_id.in_(celebrity_ids))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(limit))
+
+        if before:
+            pulled = pulled.where(older_than(Message.timestamp,
+                                             Message.id,
+                                             before))
+
+        pulled = db.session.execute(pulled).fetchall()
+
+    ids = []
+    seen = set()
+    for _, message_id in merge(stored, pulled, key=tuple, reverse=True):
+        if message_id not in seen:
+            seen.add(message_id)
+            ids.append(message_id)
+        if len(ids) == limit:
+            break
+
+    return ids
+
+
+def trim_all_timelines(batch_size=REBUILD_BATCH_USERS):
+    """Cut every timeline longer than TIMELINE_LENGTH back to that length;
+    returns how many timelines were trimmed.
+
+    Works through the users `batch_size` at a time, committing each batch.
+    """
+
+    last_id = db.session.query(func.max(User.id)).scalar() or 0
+    trimmed = 0
+
+    for start in range(1, last_id + 1, batch_size):
+        too_long = (select([entries.c.user_id])
+                    .where(entries.c.user_id.between(start,
+                                                     start + batch_size - 1))
+                    .group_by(entries.c.user_id)
+                    .having(func.count() > TIMELINE_LENGTH))
+
+        user_ids = [row[0] for row in db.session.execute(too_long)]
+        if user_ids:
+            trim_timelines(entries.c.user_id.in_(user_ids))
+            trimmed += len(user_ids)
+
+        db.session.commit()
+
+    return trimmed
+
+
+def rebuild_timelines(batch_size=REBUILD_BATCH_USERS):
+    """Recompute every home timeline from scratch (e.g. after seeding).
+
+    Works through the users `batch_size` at a time, committing each batch,
+    so no transaction holds more than that many timelines. Needs accurate
+    follower counts; see counters.reconcile_counters().
+    """
+
+    last_id = db.session.query(func.max(User.id)).scalar() or 0
+
+    for start in range(1, last_id + 1, batch_size):
+        _rebuild_users(start, start + batch_size)
+        db.session.commit()
+
+
+def _rebuild_users(start, stop):
+    """Rebuild the timelines of users with ids in [start, stop)."""
+
+    db.session.execute(entries.delete().where(
+        entries.c.user_id.between(start, stop - 1)))
+
+    own = (select([Message.user_id.label('user_id'),
+                   Message.id.label('message_id'),
+                   Message.timestamp.label('timestamp')])
+           .where(Message.user_id.between(start, stop - 1)))
+
+    celebrities = (select([User.id])
+                   .where(User.followers_count >= CELEBRITY_FOLLOWERS))
+
+    followed = (select([FollowersFollowee.followee_id,
+                        Message.id,
+                        Message.timestamp])
+                .select_from(FollowersFollowee.__table__.join(
+                    Message.__table__,
+                    Message.user_id == FollowersFollowee.follower_id))
+                .where(and_(
+                    FollowersFollowee.followee_id.between(start, stop - 1),
+                    FollowersFollowee.followee_id != Message.user_id,
+                    ~FollowersFollowee.follower_id.in_(celebrities))))
+
+    ranked = _ranked(own.union_all(followed))
+    newest = (select([ranked.c.user_id, ranked.c.message_id,
+                      ranked.c.timestamp])
+              .where(ranked.c.rank <= TIMELINE_LENGTH))
+
+    db.session.execute(entries.insert().from_select(
+        ['user_id', 'message_id', 'timestamp'], newest))
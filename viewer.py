@@ -0,0 +1,83 @@
+"""What the logged-in user follows and likes, for the page being rendered.
+
+Templates ask "does the viewer follow this user?" / "has the viewer liked
+this message?" once per card or message. Rather than scanning the viewer's
+relationship collections each time, a ViewerState is loaded once per request,
+limited to the users and messages on the page, and answers from sets.
+"""
+
+from sqlalchemy import select, and_
+
+from models import db, Like, FollowersFollowee
+from writebehind import write_behind, LIKE, FOLLOW
+
+follows = FollowersFollowee.__table__
+likes = Like.__table__
+
+
+def _id(obj):
+    """Accept either a model instance or its id."""
+
+    return getattr(obj, 'id', obj)
+
+
+class ViewerState:
+    """The viewer's follows and likes among the page's users / messages."""
+
+    def __init__(self, viewer_id=None, followee_ids=(), liked_ids=()):
+        self.viewer_id = viewer_id
+        self.followee_ids = set(followee_ids)
+        self.liked_ids = set(liked_ids)
+
+    def __repr__(self):
+        return (f"<ViewerState #{self.viewer_id}: "
+                f"{len(self.followee_ids)} follows, "
+                f"{len(self.liked_ids)} likes>")
+
+    def is_following(self, user):
+        """Does the viewer follow `user` (a User or user id)?"""
+
+        return _id(user) in self.followee_ids
+
+    def has_liked(self, message):
+        """Has the viewer liked `message` (a Message or message id)?"""
+
+        return _id(message) in self.liked_ids
+
+
+def load_viewer(viewer_id, user_ids=(), message_ids=()):
+    """Load the ViewerState for a page showing `user_ids` and `message_ids`.
+
+    Costs at most two queries, however many ids there are.
+    """
+
+    followee_ids = ()
+    liked_ids = ()
+
+    if viewer_id is not None and user_ids:
+        # (in `follows`, followee_id is the follower; see models.py)
+        followee_ids = [row[0] for row in db.session.execute(
+            select([follows.c.follower_id])
+            .where(and_(follows.c.followee_id == viewer_id,
+                        follows.c.follower_id.in_(list(user_ids)))))]
+
+    if viewer_id is not None and message_ids:
+        liked_ids = [row[0] for row in db.session.execute(
+            select([likes.c.message_id])
+            .where(and_(likes.c.user_id == viewer_id,
+                        likes.c.message_id.in_(list(message_ids)))))]
+
+    state = ViewerState(viewer_id, followee_ids, liked_ids)
+
+    if viewer_id is not None:
+        # toggles this worker hasn't written yet (see writebehind.py)
+        for ids, kind, targets in [(state.followee_ids, FOLLOW, user_ids),
+                                   (state.liked_ids, LIKE, message_ids)]:
+            for target, on in write_behind.overlay(kind, viewer_id,
+                                                   targets).items():
+                if on:
+                    ids.add(target)
+                else:
+                    ids.discard(target)
+
+    return state
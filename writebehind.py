@@ -0,0 +1,388 @@
+"""Write-behind buffering for like and follow toggles.
+
+Clicking like / follow used to be a transaction of its own, against the
+hottest rows we have (a viral message's like count, a celebrity's follower
+count). Instead, toggles are buffered per worker for WRITE_BEHIND_WINDOW
+seconds:
+
+- toggling the same (user, target) again within the window just flips the
+  buffered state, and flipping it back to what's in the database drops it
+  (double clicks never reach the database)
+- a background thread flushes everything buffered in one transaction: set-
+  based inserts / deletes of the edges, then one executemany per counter
+  column (counters.py), then the home timelines (timeline.py); once it's
+  committed, the follows go into this worker's follows graph (graph.py)
+- routes answer straight away from the buffered view: the new state, and
+  counts adjusted by whatever this worker has buffered (pending_delta()),
+  and load_viewer() overlays buffered toggles so the user's next page load
+  agrees with them; the viewer's buffered toggles, stamp(), go into the
+  ETags of the pages they see (caching.py), since the versions those are
+  built from only change once the toggles are written
+
+A window of 0 flushes synchronously inside the request (use it in tests).
+Toggles still buffered when a worker dies are lost; reconcile_counters()
+repairs the counters of any half-applied batch.
+"""
+
+import atexit
+import logging
+import os
+import threading
+from collections import Counter
+
+from flask import current_app
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import db, User, Message, Like, FollowersFollowee
+from counters import likes_changed, follows_changed
+from timeline import backfill_follow, trim_unfollow
+from identity import identity_cache
+from graph import social_graph
+
+WRITE_BEHIND_WINDOW = 0.1
+
+# flush early once this many toggles are buffered
+MAX_PENDING = 1000
+
+# edges per INSERT / DELETE statement
+BATCH_SIZE = 500
+
+# give up on a batch (and log it) after this many failed flushes
+MAX_ATTEMPTS = 3
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+log = logging.getLogger('warbler.writebehind')
+
+likes = Like.__table__
+follows = FollowersFollowee.__table__
+
+# (table, user column, target column, table the target is in) per kind;
+# in `follows`, followee_id is the follower (see models.py)
+EDGES = {
+    LIKE: (likes, likes.c.user_id, likes.c.message_id, Message.__table__),
+    FOLLOW: (follows, follows.c.followee_id, follows.c.follower_id,
+             User.__table__),
+}
+
+
+def _chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def insert_edges(kind, pairs):
+    """Insert (user id, target id) edges; returns those actually inserted.
+
+    Edges that already exist, or whose user / target has been deleted, are
+    skipped.
+    """
+
+    table, user_col, target_col, targets = EDGES[kind]
+    users = User.__table__
+    inserted = []
+
+    for chunk in _chunks(pairs):
+        live_users = {row[0] for row in db.session.execute(
+            select([users.c.id]).where(
+                users.c.id.in_({user_id for user_id, _ in chunk})))}
+        live_targets = {row[0] for row in db.session.execute(
+            select([targets.c.id]).where(
+                targets.c.id.in_({target for _, target in chunk})))}
+        chunk = [(user_id, target) for user_id, target in chunk
+                 if user_id in live_users and target in live_targets]
+
+        if not chunk:
+            continue
+
+        rows = [{user_col.name: user_id, target_col.name: target}
+                for user_id, target in chunk]
+
+        if db.engine.dialect.name == 'postgresql':
+            result = db.session.execute(
+                pg_insert(table).values(rows)
+                .on_conflict_do_nothing()
+                .returning(user_col, target_col))
+            inserted += [tuple(row) for row in result]
+
+        else:
+            existing = {tuple(row) for row in db.session.execute(
+                select([user_col, target_col])
+                .where(tuple_(user_col, target_col).in_(chunk)))}
+            rows = [row for row, pair in zip(rows, chunk)
+                    if pair not in existing]
+            if rows:
+                db.session.execute(table.insert(), rows)
+            inserted += [pair for pair in chunk if pair not in existing]
+
+    return inserted
+
+
+def delete_edges(kind, pairs):
+    """Delete (user id, target id) edges; returns those actually deleted."""
+
+    table, user_col, target_col, _ = EDGES[kind]
+    deleted = []
+
+    for chunk in _chunks(pairs):
+        matching = tuple_(user_col, target_col).in_(chunk)
+
+        if db.engine.dialect.name == 'postgresql':
+            result = db.session.execute(
+                table.delete().where(matching).returning(user_col, target_col))
+            deleted += [tuple(row) for row in result]
+
+        else:
+            existing = [tuple(row) for row in db.session.execute(
+                select([user_col, target_col]).where(matching))]
+            if existing:
+                db.session.execute(table.delete().where(
+                    tuple_(user_col, target_col).in_(existing)))
+            deleted += existing
+
+    return deleted
+
+
+class WriteBehind:
+    """Per-worker buffer of like / follow toggles."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+        # (kind, user id, target id) -> [state in the database, wanted state,
+        #                                 failed flushes]
+        self.pending = {}
+        self.in_flight = {}
+
+        # (kind, target id) -> net change buffered (pending or in flight)
+        self.deltas = Counter()
+
+        self.thread = None
+        self.pid = None
+        self.flushed = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @staticmethod
+    def window():
+        return current_app.config.get('WRITE_BEHIND_WINDOW',
+                                      WRITE_BEHIND_WINDOW)
+
+    def toggle(self, kind, user_id, target_id, current):
+        """Flip the edge; `current` is its state as the user sees it now
+        (e.g. from the ViewerState). Returns (the new state, whether that
+        changed anything): if `current` was out of date, e.g. on a double
+        submit, the flip is already buffered and counted in pending_delta()."""
+
+        key = (kind, user_id, target_id)
+        wanted = not current
+        delta = 1 if wanted else -1
+
+        with self.lock:
+            entry = self.pending.get(key)
+
+            if entry is None:
+                self.pending[key] = [current, wanted, 0]
+            elif entry[1] == wanted:
+                # already buffered (`current` was out of date)
+                return wanted, False
+            else:
+                # back to what the database has; nothing to write
+                del self.pending[key]
+                self.coalesced += 1
+
+            self.deltas[(kind, target_id)] += delta
+            size = len(self.pending)
+
+        window = self.window()
+        if not window:
+            self.flush()
+        else:
+            self._start(current_app._get_current_object(), window)
+            if size >= MAX_PENDING:
+                self.wake.set()
+
+        return wanted, True
+
+    def pending_delta(self, kind, target_id):
+        """Net change to `target_id`'s count that hasn't been written yet."""
+
+        with self.lock:
+            return self.deltas.get((kind, target_id), 0)
+
+    def stamp(self, user_id):
+        """`user_id`'s buffered toggles, ((kind, target id), state) in
+        order, or None if they have none."""
+
+        states = {}
+
+        with self.lock:
+            for buffer in (self.in_flight, self.pending):
+                for (kind, user, target), entry in buffer.items():
+                    if user == user_id:
+                        states[(kind, target)] = entry[1]
+
+        return tuple(sorted(states.items())) or None
+
+    def overlay(self, kind, user_id, ids):
+        """{target id: buffered state} for `user_id`'s toggles among `ids`."""
+
+        ids = set(ids)
+        states = {}
+
+        with self.lock:
+            for buffer in (self.in_flight, self.pending):
+                for (k, user, target), entry in buffer.items():
+                    if k == kind and user == user_id and target in ids:
+                        states[target] = entry[1]
+
+        return states
+
+    def flush(self):
+        """Write everything buffered, in one transaction."""
+
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.in_flight.update(batch)
+
+        if not batch:
+            return
+
+        try:
+            changes = self._write(batch)
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+            log.exception("write-behind flush of %d toggles failed",
+                          len(batch))
+            self._retry(batch)
+            return
+
+        # (in one go, so pending_delta() never counts a toggle twice, or
+        # not at all)
+        with self.lock:
+            for key, entry in batch.items():
+                kind, _, target_id = key
+                self.in_flight.pop(key, None)
+                self.deltas[(kind, target_id)] -= 1 if entry[1] else -1
+                if not self.deltas[(kind, target_id)]:
+                    del self.deltas[(kind, target_id)]
+            self.flushed += len(batch)
+
+        changed = {user_id for user_id, _ in changes[LIKE]}
+        for user_id, followee_id in changes[FOLLOW]:
+            changed.update((user_id, followee_id))
+        identity_cache.invalidate(*changed)
+
+        social_graph.follows_changed(changes[FOLLOW])
+
+    def _write(self, batch):
+        """Apply a batch; returns {kind: {(user id, target id): +1 / -1}}
+        for the edges actually inserted / deleted."""
+
+        changes = {}
+
+        for kind in EDGES:
+            adding = [(user_id, target) for (k, user_id, target), entry
+                      in batch.items() if k == kind and entry[1]]
+            removing = [(user_id, target) for (k, user_id, target), entry
+                        in batch.items() if k == kind and not entry[1]]
+
+            changes[kind] = dict.fromkeys(insert_edges(kind, adding), 1)
+            changes[kind].update(dict.fromkeys(delete_edges(kind, removing),
+                                               -1))
+
+        likes_changed(changes[LIKE])
+        follows_changed(changes[FOLLOW])
+
+        for (user_id, followee_id), delta in changes[FOLLOW].items():
+            if delta > 0:
+                backfill_follow(user_id, followee_id)
+            else:
+                trim_unfollow(user_id, followee_id)
+
+        return changes
+
+    def _retry(self, batch):
+        """Put a failed batch back, unless it's been toggled since."""
+
+        with self.lock:
+            self.failed += 1
+
+            for key, entry in batch.items():
+                self.in_flight.pop(key, None)
+                entry[2] += 1
+                kind, _, target_id = key
+
+                newer = self.pending.get(key)
+                if newer is not None:
+                    # toggled again since, starting from our unwritten state
+                    if newer[1] == entry[0]:
+                        del self.pending[key]
+                    else:
+                        newer[0] = entry[0]
+                    continue
+
+                if entry[2] < MAX_ATTEMPTS:
+                    self.pending[key] = entry
+                    continue
+
+                self.dropped += 1
+                self.deltas[(kind, target_id)] -= 1 if entry[1] else -1
+                if not self.deltas[(kind, target_id)]:
+                    del self.deltas[(kind, target_id)]
+                log.error("dropped write-behind toggle %r -> %s",
+                          key, entry[1])
+
+    def _start(self, app, window):
+        """Start this worker's flusher thread, if it isn't running."""
+
+        if self.thread is not None and self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+
+            # (re)started lazily so each forked worker gets its own
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run,
+                                           args=(app, window),
+                                           name='write-behind', daemon=True)
+            self.thread.start()
+            atexit.register(self._flush_in, app)
+
+    def _run(self, app, window):
+        while True:
+            self.wake.wait(window)
+            self.wake.clear()
+            self._flush_in(app)
+
+    def _flush_in(self, app):
+        with app.app_context():
+            try:
+                self.flush()
+            finally:
+                db.session.remove()
+
+    def stats(self):
+        """Counters describing the buffer, for monitoring."""
+
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'in_flight': len(self.in_flight),
+                'flushed': self.flushed,
+                'coalesced': self.coalesced,
+                'failed': self.failed,
+                'dropped': self.dropped,
+            }
+
+
+write_behind = WriteBehind()